@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Compare the memory used by the book stores of the list model.
+
+Run from the repository root with
+
+    python benchmarks/memory_backends.py [sizes...]
+
+For each size, a synthetic list is put into each store and the memory that
+the store is left holding is measured with tracemalloc.
+
+"""
+
+import os
+import sys
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from book_store import Book, book_stores, ordinal_to_date
+
+default_sizes = [10000, 100000, 1000000]
+
+def synthetic_books(count, seed=0):
+    """Generate count books with a realistic amount of author repetition and dates
+    spread over a few decades.
+
+    """
+    rng = random.Random(seed)
+    authors = [u"Author {0} {1}".format(rng.choice(u"ABCDEFGHIJKLMNOPQRSTUVWXYZ"), i) for i in range(max(1, count // 20))]
+    words = [u"the", u"of", u"history", u"life", u"war", u"peace", u"on", u"a", u"mind", u"theory", u"origin", u"prince", u"robot", u"species", u"liberty"]
+    first_day = 719163 # 1970/01/01
+    for i in range(count):
+        title = u" ".join(rng.choice(words) for _ in range(rng.randint(1, 6))).capitalize() + u" {0}".format(i)
+        yield Book.view(title, rng.choice(authors), ordinal_to_date(first_day + rng.randint(0, 50 * 365)))
+
+def measure(store_class, count):
+    """Returns the bytes retained by a store holding count books, and the peak while
+    filling it.
+
+    """
+    tracemalloc.start()
+    store = store_class()
+    store.extend(synthetic_books(count))
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return retained, peak
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or default_sizes
+
+    print("{0:>10} {1:>10} {2:>14} {3:>14} {4:>12}".format("rows", "store", "retained (MB)", "peak (MB)", "bytes/row"))
+    for count in sizes:
+        for name in sorted(book_stores):
+            retained, peak = measure(book_stores[name], count)
+            print("{0:>10} {1:>10} {2:>14.1f} {3:>14.1f} {4:>12.1f}".format(count, name, retained / 1e6, peak / 1e6, retained / float(count)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""Time the operations of the list model, the filter proxy and the list file which
+get slow on large lists.
+
+Run from the repository root with
+
+    python benchmarks/run_benchmarks.py [--sizes 1000 10000 ...] [--store list|columnar] [-o FILE]
+
+For each size, a synthetic list file is generated with a fixed seed, loaded
+into a BookListModel behind a MultiColumnFilterProxyModel sorted by date as
+in the window, and each operation is timed in turn on the offscreen Qt
+platform. Every benchmark is run --repeat times and the best wall time is
+kept, then once more under tracemalloc to find the peak memory it
+allocates.
+
+The results are written as JSON, by default to benchmarks/results/ named
+after the current git commit, so runs on two commits can be compared with
+
+    python benchmarks/run_benchmarks.py --compare OLD.json NEW.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt, QModelIndex, QT_VERSION_STR, PYQT_VERSION_STR
+
+from book_log import logger
+from book_store import Book, book_stores, write_json_list, convert_list_file
+from book_list import BookListModel, BinaryBookListModel
+from memory_backends import synthetic_books
+
+default_sizes = [1000, 10000, 100000]
+
+# Number of rows each lookup, edit and data benchmark works on
+sample_rows = 1000
+
+# Roles the table view asks the model for
+data_roles = [("display", Qt.DisplayRole), ("edit", Qt.EditRole), ("background", Qt.BackgroundRole), ("tooltip", Qt.ToolTipRole), ("font", Qt.FontRole), ("alignment", Qt.TextAlignmentRole)]
+
+# The QApplication the models and the proxy need, which only has to exist, not
+# run. PyQt deletes it as soon as nothing refers to it, so it is kept here
+application = None
+
+# Filter strings, typed in this order, so the second refines the first
+filter_strings = [("filter plain", u"histor"), ("filter refined", u"history"), ("filter regexp", u"^war.*[0-9]$"), ("filter clear", u"")]
+
+class Benchmark(object):
+    """A model and proxy on a fresh copy of a synthetic list, which the benchmarks
+    of one size run against.
+
+    """
+
+    def __init__(self, list_file, store_class):
+        self.list_file = list_file
+        self.store_class = store_class
+        self.model = None
+        self.proxy = None
+        self.rng = random.Random(1)
+
+    def load(self, model_class=BookListModel, list_file=None):
+        self.close()
+        self.model = model_class(store_class=self.store_class)
+        self.proxy = model_class.proxy_class()
+        self.proxy.setSourceModel(self.model)
+        self.proxy.sort(2, Qt.DescendingOrder)
+        self.model.list_file = list_file or self.list_file
+        self.model.read_book_list()
+        self.model.finish_loading()
+
+    def binary_file(self):
+        """A copy of the list in the binary format, made the first time.
+
+        """
+        binary_file = os.path.splitext(self.list_file)[0] + BinaryBookListModel.extension
+        if not os.path.exists(binary_file):
+            convert_list_file(self.list_file, binary_file)
+        return binary_file
+
+    def load_binary(self):
+        self.load(BinaryBookListModel, self.binary_file())
+
+    def close(self):
+        if self.model is not None:
+            self.model.journal.discard()
+            self.model.journal.close()
+            self.model = None
+
+    def model_call(self, name, *args):
+        return lambda: getattr(self.model, name)(*args)
+
+    def proxy_call(self, name, *args):
+        return lambda: getattr(self.proxy, name)(*args)
+
+    def sample(self, fraction=1):
+        """Random rows of the list, at most sample_rows or fraction of the list.
+
+        """
+        rows = len(self.model.books)
+        return [self.rng.randrange(rows) for _ in range(min(sample_rows, int(rows * fraction)))]
+
+def benchmarks(bench):
+    """Yields (name, setup, run) for each benchmark. setup is called before run and
+    isn't timed.
+
+    """
+    def nothing():
+        pass
+
+    yield "read_book_list", bench.close, bench.load
+    def setup_binary():
+        bench.close()
+        bench.binary_file()
+    yield "read_binary_list", setup_binary, bench.load_binary
+
+    yield "write_book_list", bench.load, bench.model_call("write_book_list")
+
+    def lookups():
+        books = [bench.model.books[row] for row in bench.sample()]
+        missing = [Book.view(book.title + u" missing", book.author, book.date) for book in books]
+        return books + missing
+
+    state = {}
+    def setup_has_book():
+        bench.load()
+        state["books"] = lookups()
+    def has_book():
+        for book in state["books"]:
+            bench.model.has_book(book)
+    yield "has_book", setup_has_book, has_book
+
+    def setup_add_book():
+        bench.load()
+        state["books"] = [Book.view(u"Added " + book.title, book.author, book.date) for book in lookups()[:sample_rows]]
+    def add_book():
+        for book in state["books"]:
+            bench.model.add_book(book)
+    yield "add_book", setup_add_book, add_book
+
+    def remove_rows():
+        for row in bench.sample(0.1):
+            bench.model.removeRows(min(row, len(bench.model.books) - 1), 1, QModelIndex())
+    yield "removeRows", bench.load, remove_rows
+
+    for name, role in data_roles:
+        def setup_data():
+            if bench.model is None:
+                bench.load()
+            state["indexes"] = [bench.model.index(row, column) for row in bench.sample() for column in range(3)]
+        def data(role=role):
+            for index in state["indexes"]:
+                bench.model.data(index, role)
+        yield "data " + name, setup_data, data
+
+    for name, text in filter_strings:
+        yield name, nothing, bench.proxy_call("set_filter_string", text)
+
+    for column in range(3):
+        yield "sort column {0}".format(column), nothing, bench.proxy_call("sort", column, Qt.AscendingOrder)
+
+def run(sizes, store_name, repeat, memory):
+    store_class = book_stores[store_name]
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for count in sizes:
+            list_file = os.path.join(directory, "books{0}.txt".format(count))
+            write_json_list(list_file, synthetic_books(count))
+            bench = Benchmark(list_file, store_class)
+            seconds = {}
+            peaks = {}
+            passes = repeat + (1 if memory else 0)
+            for attempt in range(passes):
+                traced = memory and attempt == passes - 1
+                bench.close()
+                for name, setup, benchmark in benchmarks(bench):
+                    setup()
+                    if traced:
+                        tracemalloc.start()
+                        benchmark()
+                        peaks[name] = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                    else:
+                        start = time.perf_counter()
+                        benchmark()
+                        elapsed = time.perf_counter() - start
+                        seconds[name] = min(elapsed, seconds.get(name, elapsed))
+            bench.close()
+
+            for name, _, _ in benchmarks(bench):
+                result = {"benchmark": name, "rows": count, "seconds": seconds[name], "peak_bytes": peaks.get(name)}
+                results.append(result)
+                print("{0:>10} {1:<20} {2:>12.4f} {3:>12}".format(count, name, result["seconds"], "" if result["peak_bytes"] is None else "{0:.1f}".format(result["peak_bytes"] / 1e6)))
+            bench.close()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def git_commit():
+    """Returns (commit, dirty) for the working tree, or (None, None) outside git.
+
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    old_results = dict(((r["benchmark"], r["rows"]), r) for r in old["results"])
+    print("{0} -> {1}".format((old["commit"] or "?")[:10], (new["commit"] or "?")[:10]))
+    print("{0:>10} {1:<20} {2:>12} {3:>12} {4:>8}".format("rows", "benchmark", "old (s)", "new (s)", "ratio"))
+    for result in new["results"]:
+        previous = old_results.get((result["benchmark"], result["rows"]))
+        if previous is None:
+            continue
+        ratio = result["seconds"] / previous["seconds"] if previous["seconds"] else float("inf")
+        print("{0:>10} {1:<20} {2:>12.4f} {3:>12.4f} {4:>8.2f}".format(result["rows"], result["benchmark"], previous["seconds"], result["seconds"], ratio))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the list model, filter proxy and list files.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes, help="numbers of books to benchmark with, up to a few million")
+    parser.add_argument("--store", choices=sorted(book_stores), default="list")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run each benchmark, the best time is kept")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="don't measure peak memory, which needs another pass")
+    parser.add_argument("-o", "--output", help="file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    logger.disabled = True # keep logging out of the timings
+    global application
+    application = QApplication(sys.argv[:1])
+
+    print("{0:>10} {1:<20} {2:>12} {3:>12}".format("rows", "benchmark", "seconds", "peak (MB)"))
+    results = run(args.sizes, args.store, args.repeat, args.memory)
+
+    commit, dirty = git_commit()
+    output = args.output
+    if output is None:
+        output = os.path.join(root, "benchmarks", "results", "{0}{1}.json".format((commit or "unknown")[:10], "-dirty" if dirty else ""))
+        if not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "dirty": dirty,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "qt": QT_VERSION_STR,
+            "pyqt": PYQT_VERSION_STR,
+            "platform": platform.platform(),
+            "store": args.store,
+            "repeat": args.repeat,
+            "results": results,
+        }, f, indent=1)
+    print("wrote {0}".format(output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Compare how long it takes to get to a loaded list through the GUI and through
+the command line tool.
+
+Run from the repository root with
+
+    python benchmarks/startup.py [sizes...]
+
+For each size, a synthetic list file is written and each path is run a few
+times in a fresh interpreter, taking the best time. The GUI path imports
+book_list, creates the application and main window on the offscreen platform
+and waits for the list to finish loading. The headless path runs
+book_cli.py list. An empty size-0 list shows the fixed startup cost.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+from book_store import write_json_list
+from memory_backends import synthetic_books
+
+default_sizes = [0, 10000, 100000]
+
+repeats = 5
+
+gui_script = """
+import sys
+from PyQt5.QtWidgets import QApplication
+from book_list import BookList
+app = QApplication(sys.argv[:1])
+gui = BookList(sys.argv[1])
+gui.book_model.finish_loading()
+"""
+
+def best_time(command, env):
+    """Best wall clock time of repeats runs of command, in seconds.
+
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.check_call(command, env=env, cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return min(times)
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or default_sizes
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    directory = tempfile.mkdtemp()
+    try:
+        print("{0:>10} {1:>10} {2:>14} {3:>10}".format("rows", "gui (ms)", "headless (ms)", "speedup"))
+        for count in sizes:
+            list_file = os.path.join(directory, "books{0}.txt".format(count))
+            write_json_list(list_file, synthetic_books(count))
+
+            gui = best_time([sys.executable, "-c", gui_script, list_file], env)
+            headless = best_time([sys.executable, os.path.join(root, "book_cli.py"), list_file, "list"], env)
+            print("{0:>10} {1:>10.0f} {2:>14.0f} {3:>10.1f}".format(count, gui * 1000, headless * 1000, gui / headless))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
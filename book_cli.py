@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""Command line access to book lists, for scripts and scheduled jobs. This only
+imports the Qt-free parts of the program, so it starts quickly and doesn't need
+a display.
+
+    python book_cli.py LIST add --title TITLE --author AUTHOR [--date yyyy/MM/dd]
+    python book_cli.py LIST list [--sort title|author|date]
+    python book_cli.py LIST search QUERY
+    python book_cli.py LIST dedupe [--remove]
+    python book_cli.py LIST export [--format json|csv] [-o FILE]
+    python book_cli.py LIST split DIRECTORY
+    python book_cli.py DIRECTORY merge LIST
+    python book_cli.py LIST convert OUTPUT
+    python book_cli.py LIST import FILE [--all]
+
+LIST is a JSON list file, a binary list file with the .bkl extension or an
+SQLite database with the .sqlite extension. DIRECTORY is a list sharded by
+year, see ShardedList.
+
+"""
+
+import sys
+import os
+import io
+import csv
+import locale
+import datetime
+import argparse
+import logging
+
+import book_profile
+from book_import import BookImport, split_duplicates
+
+from book_log import logger, start_logging, log
+from book_store import Book, DuplicateIndex, SortKeyIndex, SearchIndex, BookJournal, BookKeys, SqliteBookDatabase, date_to_ordinal, apply_journal, load_list_file, dump_json_list, write_json_list, write_list_file, ShardedList, split_list_file, merge_sharded_list, convert_list_file
+
+sort_fields = ["title", "author", "date"]
+
+def is_database(list_file):
+    return os.path.splitext(list_file)[1] == ".sqlite"
+
+def read_books(list_file):
+    """Returns all the books in list_file, in the order they were added.
+
+    """
+    if is_database(list_file):
+        database = SqliteBookDatabase(list_file)
+        books = list(database.iter_books())
+        database.close()
+        return books
+    if ShardedList.is_sharded(list_file):
+        return list(ShardedList(list_file).iter_books())
+    return load_list_file(list_file, stale_journal=True)
+
+def parse_date(date):
+    """Accept yyyy/MM/dd or yyyy-MM-dd, returning the date in the list format.
+
+    """
+    date = date.replace("-", "/")
+    if date_to_ordinal(date) is None:
+        raise argparse.ArgumentTypeError("not a valid yyyy/MM/dd date: {0}".format(date))
+    return date
+
+def print_books(books):
+    for book in books:
+        print(u"{0}\t{1}\t{2}".format(book.title, book.author, book.date))
+
+def split_new_books(list_file, books):
+    """Split books into those which are new to the list and those which are the
+    same as or very similar to a book in the list or earlier in books. Returns
+    (new, duplicates).
+
+    """
+    if is_database(list_file):
+        database = SqliteBookDatabase(list_file)
+        try:
+            return split_duplicates(books, database.has_similar_book)
+        finally:
+            database.close()
+
+    if not ShardedList.is_sharded(list_file) and not os.path.exists(list_file):
+        io.open(list_file, 'w').close()
+    duplicates = DuplicateIndex()
+    duplicates.reset(read_books(list_file))
+    return split_duplicates(books, duplicates.contains_similar)
+
+def append_books(list_file, books):
+    """Add books to the end of a list, touching as little of it as possible.
+
+    """
+    if is_database(list_file):
+        database = SqliteBookDatabase(list_file)
+        try:
+            database.insert(books)
+        finally:
+            database.close()
+        return
+
+    if ShardedList.is_sharded(list_file):
+        shards = ShardedList(list_file)
+        added = {}
+        for book in books:
+            added.setdefault(ShardedList.shard_key(book), []).append(book)
+        shards.write(dict((key, (list(shards.load(key)) if key in shards.counts else []) + new) for key, new in added.items()))
+        return
+
+    # The books are only appended to the journal, the list file itself is
+    # rewritten the next time the journal is compacted
+    if not os.path.exists(list_file):
+        io.open(list_file, 'w').close()
+    base = None
+    entries, journal_file = BookJournal.read(list_file)
+    if journal_file is None:
+        # A new journal keeps the keys of the books in the list file, so that it
+        # can be merged if the file is changed by someone else. A journal kept
+        # for an earlier version of the file is merged into it now.
+        current = load_list_file(list_file)
+        entries, journal_file, merged = BookJournal.recover(list_file, current)
+        if merged:
+            apply_journal(current, entries)
+            current.extend(books)
+            write_list_file(list_file, current)
+            BookJournal().open(list_file) # the journal was folded into the new file
+            return
+        base = BookKeys(current)
+
+    journal = BookJournal()
+    journal.open(list_file, journal_file, len(entries), base)
+    journal.rows_inserted(None, books) # the journal records books by value, not row
+    journal.close()
+
+def add(args):
+    book = Book(args.title, args.author, args.date)
+    if not args.force and split_new_books(args.list_file, [book])[1]:
+        print(u"{0} - {1} is already in the list, use --force to add it anyway".format(book.author, book.title), file=sys.stderr)
+        return 1
+
+    append_books(args.list_file, [book])
+    return 0
+
+def import_books(args):
+    """Add the books in a CSV file, Goodreads export or another list, leaving out
+    those which are already in the list unless --all is given.
+
+    """
+    book_import = BookImport(args.file).read()
+    new, duplicates = split_new_books(args.list_file, book_import.books)
+    books = book_import.books if args.all else new
+    append_books(args.list_file, books)
+
+    print("added {0} of {1} books, {2} duplicates{3}, {4} rows skipped, {5} dates not understood".format(len(books), len(book_import.books), len(duplicates), " included" if args.all else " left out", book_import.skipped, book_import.bad_dates), file=sys.stderr)
+    return 0
+
+def list_books(args):
+    books = read_books(args.list_file)
+    if args.sort:
+        column = sort_fields.index(args.sort)
+        books = sorted(books, key=lambda book: SortKeyIndex.sort_key(book, column))
+    print_books(books)
+    return 0
+
+def search(args):
+    if is_database(args.list_file):
+        database = SqliteBookDatabase(args.list_file)
+        where, params = database.filter_clause(args.query)
+        rows = database.fetch(2, False, where, params, limit=-1)
+        database.close()
+        print_books(Book.view(title, author, date) for _, title, author, date, _ in rows)
+        return 0
+
+    books = read_books(args.list_file)
+    index = SearchIndex([0, 1, 2])
+    index.reset(books)
+    accepted = index.match(index.snapshot(), args.query)
+    print_books(book for book, match in zip(books, accepted) if match)
+    return 0
+
+def dedupe(args):
+    """Print books which are the same as or very similar to an earlier book, and
+    remove them with --remove.
+
+    """
+    if is_database(args.list_file):
+        database = SqliteBookDatabase(args.list_file)
+        ids = database.duplicate_ids()
+        if args.remove:
+            database.delete(ids)
+        database.close()
+        print("{0} duplicate books{1}".format(len(ids), " removed" if args.remove else ""), file=sys.stderr)
+        return 0
+
+    books = read_books(args.list_file)
+    seen = set()
+    keep = []
+    duplicates = []
+    for book in books:
+        key = DuplicateIndex.near_key(book)
+        if key in seen:
+            duplicates.append(book)
+        else:
+            seen.add(key)
+            keep.append(book)
+
+    print_books(duplicates)
+    if args.remove and duplicates:
+        log("removing {0} duplicates from {1}".format(len(duplicates), args.list_file))
+        if ShardedList.is_sharded(args.list_file):
+            shards = ShardedList(args.list_file)
+            rewritten = dict((key, []) for key in shards.counts)
+            for book in keep:
+                rewritten[ShardedList.shard_key(book)].append(book)
+            shards.write(rewritten)
+        else:
+            write_list_file(args.list_file, keep)
+            BookJournal().open(args.list_file) # the journal was folded into the new file
+    print("{0} duplicate books{1}".format(len(duplicates), " removed" if args.remove else ""), file=sys.stderr)
+    return 0
+
+def export(args):
+    books = read_books(args.list_file)
+    if args.format == "json":
+        if args.output:
+            write_json_list(args.output, books)
+        else:
+            dump_json_list(sys.stdout, books)
+        return 0
+
+    f = io.open(args.output, 'w', encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(f)
+        writer.writerow(Book.fields)
+        for book in books:
+            writer.writerow([book.title, book.author, book.date])
+    finally:
+        if args.output:
+            f.close()
+    return 0
+
+def split(args):
+    if os.path.exists(args.directory):
+        print("{0} already exists".format(args.directory), file=sys.stderr)
+        return 1
+    count = split_list_file(args.list_file, args.directory)
+    print("split {0} books into {1}".format(count, args.directory), file=sys.stderr)
+    return 0
+
+def merge(args):
+    if os.path.exists(args.output):
+        print("{0} already exists".format(args.output), file=sys.stderr)
+        return 1
+    count = merge_sharded_list(args.list_file, args.output)
+    print("merged {0} books into {1}".format(count, args.output), file=sys.stderr)
+    return 0
+
+def convert(args):
+    if os.path.exists(args.output):
+        print("{0} already exists".format(args.output), file=sys.stderr)
+        return 1
+    count = convert_list_file(args.list_file, args.output)
+    print("converted {0} books into {1}".format(count, args.output), file=sys.stderr)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain a list of books you've read, without the GUI.")
+    parser.add_argument("list_file", help="JSON list file, binary list file with the .bkl extension, or SQLite database with the .sqlite extension")
+    parser.add_argument("--log-level", help="one of DEBUG, INFO, WARNING, ERROR")
+    parser.add_argument("--log-file", help="file to write the log to, nothing is logged if not given")
+    parser.add_argument("--profile", action="store_true", help="write a cProfile profile of the command, also switched on by setting BOOKLIST_PROFILE=1")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    add_parser = commands.add_parser("add", help="add a book")
+    add_parser.add_argument("--title", required=True)
+    add_parser.add_argument("--author", required=True)
+    add_parser.add_argument("--date", type=parse_date, default=datetime.date.today().strftime("%Y/%m/%d"), help="date the book was read, defaults to today")
+    add_parser.add_argument("--force", action="store_true", help="add the book even if a similar book is in the list")
+    add_parser.set_defaults(run=add)
+
+    list_parser = commands.add_parser("list", help="print the books, one per line with tab separated fields")
+    list_parser.add_argument("--sort", choices=sort_fields)
+    list_parser.set_defaults(run=list_books)
+
+    search_parser = commands.add_parser("search", help="print the books matching a filter string, as in the filter box")
+    search_parser.add_argument("query")
+    search_parser.set_defaults(run=search)
+
+    dedupe_parser = commands.add_parser("dedupe", help="print books which duplicate an earlier book")
+    dedupe_parser.add_argument("--remove", action="store_true", help="remove the duplicates from the list")
+    dedupe_parser.set_defaults(run=dedupe)
+
+    export_parser = commands.add_parser("export", help="write the books as JSON or CSV")
+    export_parser.add_argument("--format", choices=["json", "csv"], default="json")
+    export_parser.add_argument("-o", "--output", help="file to write to, defaults to standard output")
+    export_parser.set_defaults(run=export)
+
+    split_parser = commands.add_parser("split", help="copy a list file into a new directory with one shard per year")
+    split_parser.add_argument("directory", help="directory to create, conventionally with the {0} extension".format(ShardedList.extension))
+    split_parser.set_defaults(run=split)
+
+    merge_parser = commands.add_parser("merge", help="copy a sharded list into a new single list file")
+    merge_parser.add_argument("output", help="list file to create")
+    merge_parser.set_defaults(run=merge)
+
+    convert_parser = commands.add_parser("convert", help="copy a list file into a new list file in another format")
+    convert_parser.add_argument("output", help="list file to create, binary if it has the .bkl extension and JSON otherwise")
+    convert_parser.set_defaults(run=convert)
+
+    import_parser = commands.add_parser("import", help="add the books in a CSV file, Goodreads export or another list")
+    import_parser.add_argument("file", help="CSV file with a header row, or a list file")
+    import_parser.add_argument("--all", action="store_true", help="add books which are already in the list as well")
+    import_parser.set_defaults(run=import_books)
+
+    args = parser.parse_args(argv)
+    try:
+        locale.setlocale(locale.LC_COLLATE, "")
+    except locale.Error:
+        pass
+    if args.log_level:
+        logger.setLevel(getattr(logging, args.log_level.upper(), logging.INFO))
+    if args.log_file:
+        start_logging(args.log_file)
+
+    if args.profile or book_profile.enabled:
+        return book_profile.Capture(args.command).run(args.run, args)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
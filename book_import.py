@@ -0,0 +1,143 @@
+"""Reading books to import from CSV files, Goodreads exports and other book lists.
+Like book_store, nothing here depends on Qt, so imports can be read on a worker
+thread or from the command line tool.
+
+"""
+
+import os
+import io
+import csv
+import datetime
+
+from book_log import log
+from book_store import Book, DuplicateIndex, SqliteBookDatabase, load_list_file
+
+# Formats normalize_date understands, tried in order. Dates like 05/06/2016
+# could be day or month first, so formats with the year last aren't accepted.
+date_formats = ["%Y/%m/%d", "%Y-%m-%d", "%Y.%m.%d", "%Y%m%d", "%d %B %Y", "%d %b %Y", "%B %d, %Y", "%b %d, %Y", "%B %d %Y", "%b %d %Y"]
+
+# Names of the CSV columns holding each field, casefolded, in order of
+# preference. Goodreads exports have "Title", "Author", "Date Read" and
+# "Date Added", and an "Exclusive Shelf" which is "read" for books read.
+title_columns = ["title", "book title", "name"]
+author_columns = ["author", "authors", "author name", "creator"]
+date_columns = ["date", "date read", "read", "date finished", "finished", "date added"]
+shelf_column = "exclusive shelf"
+
+# Number of rows read between calls to the progress callback
+progress_rows = 1000
+
+def normalize_date(text):
+    """Convert a date in one of date_formats, optionally followed by a time, into the
+    yyyy/MM/dd format of the list. Returns None if the date isn't understood.
+
+    """
+    text = text.strip()
+    for candidate in (text, text.split("T")[0], text.split(" ")[0]):
+        for date_format in date_formats:
+            try:
+                date = datetime.datetime.strptime(candidate, date_format)
+            except ValueError:
+                continue
+            return u"{0:04d}/{1:02d}/{2:02d}".format(date.year, date.month, date.day)
+    return None
+
+def split_duplicates(books, contains_similar):
+    """Split books into those to add and those which would duplicate a book in the
+    list, according to contains_similar, or an earlier book in books. Returns
+    (new, duplicates).
+
+    """
+    seen = set()
+    new = []
+    duplicates = []
+    for book in books:
+        key = DuplicateIndex.near_key(book)
+        if key in seen or contains_similar(book):
+            duplicates.append(book)
+        else:
+            seen.add(key)
+            new.append(book)
+    return new, duplicates
+
+class BookImport(object):
+    """The books read from a file to import, along with the number of rows which
+    were skipped because they have no title or, in Goodreads exports, aren't on
+    the read shelf, and the number of dates which weren't understood. Those
+    dates are kept as they were.
+
+    CSV files need a header row naming the columns, see title_columns. Other
+    files are read as book lists, JSON, binary or SQLite.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.books = []
+        self.skipped = 0
+        self.bad_dates = 0
+
+    def read(self, progress=None):
+        """Read the file. progress, if given, is called every progress_rows rows with
+        the number of books read so far. Returns self.
+
+        """
+        extension = os.path.splitext(self.path)[1].lower()
+        if extension == ".csv":
+            self._read_csv(progress)
+        elif extension == ".sqlite":
+            database = SqliteBookDatabase(self.path)
+            try:
+                for book in database.iter_books():
+                    self._add(book.title, book.author, book.date, progress)
+            finally:
+                database.close()
+        else:
+            for book in load_list_file(self.path):
+                self._add(book.title, book.author, book.date, progress)
+
+        log("read {0} books to import from {1}, {2} rows skipped, {3} dates not understood".format(len(self.books), self.path, self.skipped, self.bad_dates))
+        return self
+
+    def _add(self, title, author, date, progress):
+        title = title.strip()
+        if not title:
+            self.skipped += 1
+            return
+
+        normalized = normalize_date(date) if date.strip() else u""
+        if normalized is None:
+            self.bad_dates += 1
+            normalized = date
+        self.books.append(Book.view(title, author.strip(), normalized))
+        if progress is not None and len(self.books) % progress_rows == 0:
+            progress(len(self.books))
+
+    @staticmethod
+    def _find_columns(header, names):
+        folded = [name.strip().casefold() for name in header]
+        return [folded.index(name) for name in names if name in folded]
+
+    def _read_csv(self, progress):
+        with io.open(self.path, 'r', encoding="utf-8-sig", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            titles = BookImport._find_columns(header, title_columns)
+            if not titles:
+                raise ValueError("{0} has no title column".format(self.path))
+            authors = BookImport._find_columns(header, author_columns)
+            dates = BookImport._find_columns(header, date_columns)
+            shelves = BookImport._find_columns(header, [shelf_column])
+
+            def first(row, columns):
+                # first of the columns with a value in this row
+                for column in columns:
+                    if column < len(row) and row[column].strip():
+                        return row[column]
+                return u""
+
+            for row in reader:
+                if shelves and first(row, shelves).strip().casefold() != "read":
+                    self.skipped += 1
+                    continue
+                self._add(first(row, titles), first(row, authors), first(row, dates), progress)
@@ -3,22 +3,27 @@
 import sys
 import os
 import signal
-import json
+import io
+import locale
 import functools
 import itertools
-import datetime
-
-from PyQt5.QtWidgets import QApplication, QWidget, QFileDialog, QPushButton, QMessageBox, QLineEdit, QMainWindow, QGridLayout, QVBoxLayout, QDesktopWidget, QAction, QHBoxLayout, QLabel, QShortcut, QCheckBox, QTabWidget, QTableWidget, QTableWidgetItem, QSpacerItem, QMainWindow, QDateEdit, QHeaderView, QItemDelegate, QTableView
+import collections
+import argparse
+import logging
+import re
+import bisect
+import concurrent.futures
+
+import book_store
+import book_profile
+from book_import import BookImport, split_duplicates
+from book_log import log_file, logger, start_logging, flush_log, log
+from book_store import iter_json_array, Book, row_ranges, BookStore, MappedBookStore, book_stores, BookIndex, DuplicateIndex, SortKeyIndex, ReadingStats, TrigramIndex, PrefixIndex, SearchIndex, BookQuery, write_list_file, replay_journal, BookJournal, BookKeys, list_file_fingerprint, load_list_file, SqliteBookDatabase, migrate_list_to_sqlite, ShardedList, DirtyShards
+
+from PyQt5.QtWidgets import QApplication, QDockWidget, QCompleter, QWidget, QFileDialog, QPushButton, QMessageBox, QLineEdit, QMainWindow, QGridLayout, QVBoxLayout, QDesktopWidget, QAction, QHBoxLayout, QLabel, QShortcut, QCheckBox, QTabWidget, QTableWidget, QTableWidgetItem, QSpacerItem, QMainWindow, QDateEdit, QHeaderView, QItemDelegate, QTableView, QStyle
 from PyQt5.QtCore import *
 from PyQt5.QtGui import QColor, QKeySequence
 
-logging_enabled = True
-
-def log(string):
-    if logging_enabled:
-        with open("booklist.log", 'a+') as f:
-            f.write("{0}: {1}\n".format(datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S.%f"), string))
-
 class CalendarDelegate(QItemDelegate):
 
     def createEditor(self, parent, option, index):
@@ -41,51 +46,616 @@ class CalendarDelegate(QItemDelegate):
     def updateEditorGeometry(self, editor, option, index):
         editor.setGeometry(option.rect)
 
-class MultiColumnFilterProxyModel(QSortFilterProxyModel):
+class EditedRows(BookIndex):
+    """Keeps the book each edited row held before the edit, until the proxy has
+    moved the row, so that the proxy can find it by the key it was sorted on.
+
+    """
+
+    def __init__(self):
+        self.old_books = {} # source row -> its book before the edit
+
+    def reset(self, books):
+        self.old_books.clear()
+
+    def rows_inserted(self, row, books):
+        self.old_books.clear()
+
+    def rows_removed(self, row, books):
+        self.old_books.clear()
+
+    def row_changed(self, row, old_book, new_book):
+        self.old_books.setdefault(row, old_book)
+
+class MultiColumnFilterProxyModel(QAbstractProxyModel):
+    """Proxy which shows the books where any of filter_columns matches the filter
+    string. The matching is done by a SearchIndex registered with the source
+    model, and the proxy shows the rows it accepts. Rows are sorted on the keys
+    kept by the model's SortKeyIndex, which the model also gives out for
+    BookListModel.sort_role.
+
+    The proxy keeps the order of all the rows for the sort column, worked out
+    once with SortKeyIndex.order, and the rows it shows are the accepted ones
+    taken from that order. So changing the filter never sorts anything, and
+    only the rows which appear or disappear are removed from or inserted into
+    the views, or the whole layout is changed at once if they are scattered
+    over more than max_change_ranges ranges. Edited and added rows are put in
+    their place with a binary search, and an edited row is found by one on the
+    key it had before the edit, which EditedRows keeps for it.
+
+    Rows removed from the source are taken out of the rows shown straight
+    away, but the remaining source rows are only renumbered when the proxy
+    next needs their numbers, so removing many ranges of rows renumbers them
+    once.
+
+    In fuzzy mode, the filter string is looked up in the model's TrigramIndex
+    instead, which tolerates typos, and the rows are ranked by how well they
+    match, falling back to the sort column for equally good matches.
+
+    request_filter matches large lists on a worker thread against a snapshot
+    of the index, and applies the result in one go when it is ready. A
+    request supersedes any which are still running, and those stop at the
+    next chunk of rows they check.
+
+    While the source model is loading a list, the chunks it inserts are added
+    at the end unsorted, and the rows are sorted once when it has finished.
+
+    """
+
+    # Lists with fewer rows than this are filtered on the GUI thread
+    background_filter_rows = 20000
+
+    # Number of rows a filter worker checks between looking for cancellation
+    filter_chunk_rows = 50000
+
+    # Changes touching more separate ranges of rows than this are shown by
+    # changing the whole layout, rather than inserting or removing each range
+    max_change_ranges = 100
+
+    # Table picking the rows which stay or become shown out of the changes
+    # worked out by _refilter
+    _now_shown = bytes.maketrans(b"\x02\x03", b"\x00\x01")
+
+    # Emitted with the filter string once the proxy shows its result
+    filter_applied = pyqtSignal(str)
+
+    # Emitted by the worker thread with the generation and index version it
+    # ran for, the filter string and the accepted rows
+    _filter_done = pyqtSignal(int, int, str, object)
 
     def __init__(self, parent=None):
         super(MultiColumnFilterProxyModel, self).__init__(parent)
         self.filter_columns = [0, 1, 2]
+        self.search_index = SearchIndex(self.filter_columns)
+        self.sort_key_index = None
+        self._sort_column = -1
+        self._sort_keys = None # keys of the sort column
+        self._ascending = True
+        self.trigram_index = None
+        self.fuzzy = False
+
+        self._order = [] # every source row, in the order of the sort column
+        self._rows = [] # the source row shown in each row of the proxy
+        self._shown = bytearray() # 1 for each source row which is shown
+        self._proxy_rows = None # the proxy row of each source row, built when needed
+        self._rows_ranked = False # the rows are ranked by a fuzzy query, not in order
+        self._unsorted = False # rows were added unsorted while the list was loading
+        self._removal = None # layout change waiting for rows to be removed
+        self._removed = [] # (first, count) of source rows removed since renumbering, last first
+        self._edited = EditedRows()
+        self._moving = {} # source row -> the sort key it had before it was edited
+        self._index_wait = None # (generation, text) of a fuzzy filter waiting for the index
+
+        self._filter_generation = 0 # incremented with every filter request
+        self._filter_executor = None
+        self._filter_done.connect(self._apply_filter)
+
+    def setSourceModel(self, model):
+        self.beginResetModel()
+        super(MultiColumnFilterProxyModel, self).setSourceModel(model)
+        model.add_index(self.search_index)
+        model.add_index(self._edited)
+        self.sort_key_index = model.sort_key_index
+        self.trigram_index = model.trigram_index
+        model.modelAboutToBeReset.connect(self.beginResetModel)
+        model.modelReset.connect(self._source_reset)
+        model.rowsInserted.connect(self._source_rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self._source_rows_about_to_be_removed)
+        model.rowsRemoved.connect(self._source_rows_removed)
+        model.dataChanged.connect(self._source_data_changed)
+        model.load_finished.connect(self._load_finished)
+        model.trigram_index_built.connect(self._trigram_index_built)
+        model.list_closed.connect(self._source_closed)
+        self._rebuild()
+        self.endResetModel()
+
+    def set_fuzzy(self, fuzzy):
+        """Switch fuzzy mode on or off. The filter needs to be set again afterwards.
 
-    def filterAcceptsRow(self, row_num, parent):
-        """http://www.dayofthenewdan.com/2013/02/09/Qt_QSortFilterProxyModel.html
         """
-        model = self.sourceModel()
-        filter_regexp = self.filterRegExp()
-        filter_regexp.setCaseSensitivity(Qt.CaseInsensitive)
-        tests = [filter_regexp.lastIndexIn(model.index(row_num, col, parent).data().lower()) >= 0 for col in self.filter_columns]
+        self.fuzzy = fuzzy
+        if not fuzzy:
+            self.trigram_index.set_query(u"")
 
-        return any(tests)
+    def set_filter_string(self, text):
+        """Filter on the GUI thread and update the proxy immediately. A fuzzy filter
+        needs the trigram index, and if that is still being built, the filter
+        is only applied once it is ready.
 
-class Book(object):
+        """
+        self._filter_generation += 1
+        if self.fuzzy and text and not self.trigram_index.built():
+            # set again once the model has built the index in the background,
+            # showing every row until then
+            self._index_wait = self._filter_generation, text
+            self.sourceModel().build_trigram_index()
+            text = u""
+
+        if self.fuzzy:
+            self.search_index.set_query(u"")
+            self.trigram_index.set_query(text)
+        else:
+            self.search_index.set_query(text)
+        self._refilter()
+        self.filter_applied.emit(text)
+
+    def request_filter(self, text):
+        """Filter in the background if the list is large enough for it to matter.
+
+        """
+        index = self.search_index
+        # Date ranges are looked up in the date index, which is only kept for the
+        # current rows, but they rarely leave many rows for the other terms
+        book_query = BookQuery.parse(text)
+        dated = book_query is not None and any(term.dates is not None for term in book_query.terms)
+        if not text or self.fuzzy or dated or len(index.snapshot()) < self.background_filter_rows:
+            self.set_filter_string(text)
+            return
+
+        self._filter_generation += 1
+        candidates = bytes(index.accepted) if index.refines(text) else None
+        if self._filter_executor is None:
+            self._filter_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self._filter_executor.submit(self._run_filter, self._filter_generation, index.version, text, list(index.snapshot()), candidates)
+
+    def _run_filter(self, generation, version, text, haystacks, candidates):
+        """Runs on the worker thread.
+
+        """
+        accepted = bytearray()
+        chunk = self.filter_chunk_rows
+        for start in range(0, len(haystacks), chunk):
+            if generation != self._filter_generation:
+                return
+            accepted += self.search_index.match(haystacks[start:start + chunk], text, candidates[start:start + chunk] if candidates is not None else None)
+
+        self._filter_done.emit(generation, version, text, accepted)
+
+    def _apply_filter(self, generation, version, text, accepted):
+        if generation != self._filter_generation:
+            return
+
+        if version != self.search_index.version:
+            # the books changed while the worker was running
+            self.request_filter(text)
+            return
+
+        self.search_index.set_accepted(text, accepted)
+        self._refilter()
+        self.filter_applied.emit(text)
+
+    def _source_closed(self):
+        # any filter still running is for the list which was closed
+        self._filter_generation += 1
+        if self._filter_executor is not None:
+            self._filter_executor.shutdown(wait=False)
+            self._filter_executor = None
+
+    def _ranked(self):
+        return self.fuzzy and bool(self.trigram_index.query)
+
+    def _accepts(self, row):
+        if self.fuzzy:
+            return self.trigram_index.accepts(row)
+        return self.search_index.accepts(row)
+
+    def _accepted(self):
+        # 1 for each source row the filter accepts
+        accepted = self.trigram_index.accepted_rows() if self.fuzzy else self.search_index.accepted_rows()
+        if accepted is None:
+            return bytearray(b"\x01") * self.sourceModel().rowCount(QModelIndex())
+        return bytearray(map(bool, accepted))
+
+    def _shown_rows(self):
+        """The source rows to show, in order.
+
+        """
+        rows = list(itertools.compress(self._order, map(self._shown.__getitem__, self._order)))
+        self._rows_ranked = self._ranked()
+        if self._rows_ranked:
+            # stable, so equally good matches stay in the order of the sort column
+            rows.sort(key=self.trigram_index.scores.__getitem__, reverse=True)
+        return rows
+
+    def _sorted_order(self):
+        if self._sort_column < 0:
+            return list(range(len(self._shown)))
+        return self.sort_key_index.order(self._sort_column, not self._ascending)
+
+    def _key(self, row):
+        # the key the row is sorted on where it is now, which for an edited row
+        # which hasn't been moved yet is the one it had before the edit
+        if row in self._moving:
+            return self._moving[row]
+        return self._sort_keys[row]
+
+    def _position(self, rows, row):
+        """Index at which the source row belongs in rows, which are in the order of
+        the sort column, after any rows with the same key.
 
-    def __init__(self, title, author, date):
-        self.title = title
-        self.author = author
-        self.date = date
-        log(u"created book {0}".format(self.__repr__()))
+        """
+        keys = self._sort_keys
+        key = keys[row] if keys is not None else row
+        low, high = 0, len(rows)
+        while low < high:
+            middle = (low + high) // 2
+            other = self._key(rows[middle]) if keys is not None else rows[middle]
+            if (key < other) if self._ascending else (other < key):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _find(self, rows, row):
+        """Index of the source row in rows, which are in the order of the sort
+        column, found with a binary search on the key the row is sorted on.
 
-    def set_title(self, title):
-        self.title = title
+        """
+        if self._unsorted:
+            return rows.index(row)
+        if self._sort_keys is None:
+            return bisect.bisect_left(rows, row)
+        key = self._key(row)
+        low, high = 0, len(rows)
+        while low < high:
+            middle = (low + high) // 2
+            other = self._key(rows[middle])
+            if (other < key) if self._ascending else (key < other):
+                low = middle + 1
+            else:
+                high = middle
+        # the row is among those with the same key
+        while low < len(rows) and rows[low] != row and self._key(rows[low]) == key:
+            low += 1
+        if low < len(rows) and rows[low] == row:
+            return low
+        return rows.index(row)
+
+    def _rebuild(self):
+        self._shown = self._accepted()
+        self._order = self._sorted_order()
+        self._rows = self._shown_rows()
+        self._proxy_rows = None
+        self._unsorted = False
+        self._removed = []
+        self._moving = {}
+
+    def _renumber(self):
+        """Renumber the source rows in the order and the rows shown after rows have
+        been removed from the source, in one pass however many ranges of rows
+        were removed.
 
-    def set_author(self, author):
-        self.author = author
+        """
+        if not self._removed:
+            return
+        # the new number of each source row before the removals, -1 for those
+        # which were removed
+        numbers = []
+        removed = 0
+        end = 0
+        for first, count in reversed(self._removed):
+            numbers.extend(range(end - removed, first - removed))
+            numbers.extend([-1] * count)
+            removed += count
+            end = first + count
+        numbers.extend(range(end - removed, len(self._shown)))
+        self._removed = []
+        self._order = [row for row in map(numbers.__getitem__, self._order) if row >= 0]
+        self._rows = [row for row in map(numbers.__getitem__, self._rows) if row >= 0]
+        self._proxy_rows = None
+
+    def _begin_relayout(self):
+        """Start a change of the layout, returning the persistent indexes along with
+        the (source row, column) each of them is on.
 
-    def set_date(self, date):
-        self.date = date
+        """
+        self._renumber()
+        self.layoutAboutToBeChanged.emit()
+        indexes = self.persistentIndexList()
+        return indexes, [(self._rows[index.row()], index.column()) for index in indexes]
 
-    def contains(self, string):
-        """Check if any of the elements of this book contain the given string.
+    def _end_relayout(self, indexes, sources):
+        """Move the persistent indexes to where their source rows are now shown. Those
+        whose rows are gone, given as -1, or not shown any more become invalid.
 
         """
+        self._proxy_rows = None
+        if indexes:
+            positions = self._proxy_positions(set(row for row, _ in sources if row >= 0 and self._shown[row]))
+            self.changePersistentIndexList(indexes, [self.index(positions.get(row, -1), column) for row, column in sources])
+        self.layoutChanged.emit()
 
-        return string in self.title or string in self.author or string in self.date
+    def _relayout(self, rows):
+        indexes, sources = self._begin_relayout()
+        self._rows = rows
+        self._end_relayout(indexes, sources)
 
-    def __eq__(self, other):
-        return self.title == other.title and self.author == other.author and self.date == other.date
+    def _refilter(self):
+        """Show the rows accepted by the filter as it is now.
 
-    def __repr__(self):
-        return u"{0}: {1} - {2}".format(self.date, self.author, self.title)
+        """
+        self._renumber()
+        shown = self._accepted()
+        if self._ranked() or self._rows_ranked or len(shown) != len(self._shown):
+            self._shown = shown
+            self._relayout(self._shown_rows())
+            return
+        if shown == self._shown:
+            return
+
+        # Both sets of rows are taken from the same order, so the changes are
+        # runs of rows to hide (2) and to show (1) in it, among rows which stay
+        # shown (3) or hidden (0). The masks only hold 0s and 1s, so they can be
+        # combined a byte at a time as integers.
+        order = self._order
+        combined = (int.from_bytes(self._shown, "little") << 1 | int.from_bytes(shown, "little")).to_bytes(len(shown), "little")
+        changes = bytes(map(combined.__getitem__, order))
+        self._shown = shown
+        runs = list(itertools.islice(re.finditer(b"\x02+|\x01+", changes), self.max_change_ranges + 1))
+        if len(runs) > self.max_change_ranges:
+            self._relayout(list(itertools.compress(order, changes.translate(MultiColumnFilterProxyModel._now_shown))))
+            return
+
+        for run in reversed(runs):
+            if run.group()[0] == 2:
+                # rows shown before the run, none of which have been removed yet
+                position = changes.count(b"\x02", 0, run.start()) + changes.count(b"\x03", 0, run.start())
+                self.beginRemoveRows(QModelIndex(), position, position + len(run.group()) - 1)
+                del self._rows[position:position + len(run.group())]
+                self._proxy_rows = None
+                self.endRemoveRows()
+
+        for run in runs:
+            if run.group()[0] == 1:
+                # rows still shown before the run, including those inserted already
+                position = changes.count(b"\x01", 0, run.start()) + changes.count(b"\x03", 0, run.start())
+                self.beginInsertRows(QModelIndex(), position, position + len(run.group()) - 1)
+                self._rows[position:position] = order[run.start():run.end()]
+                self._proxy_rows = None
+                self.endInsertRows()
+
+    def _source_reset(self):
+        self._rebuild()
+        self.endResetModel()
+
+    def _source_rows_inserted(self, parent, first, last):
+        self._renumber()
+        count = last - first + 1
+        if first < len(self._shown):
+            self._order = [row + count if row >= first else row for row in self._order]
+            self._rows = [row + count if row >= first else row for row in self._rows]
+        self._shown[first:first] = bytearray(count)
+        self._proxy_rows = None
+        new_rows = range(first, last + 1)
+
+        if self.sourceModel().is_loading():
+            # sorting each chunk into the rows loaded so far would take longer
+            # than sorting them all at the end
+            self._order.extend(new_rows)
+            self._unsorted = True
+            shown = [row for row in new_rows if self._accepts(row)]
+            for row in shown:
+                self._shown[row] = 1
+            if shown:
+                self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(shown) - 1)
+                self._rows.extend(shown)
+                self.endInsertRows()
+        elif count > self.max_change_ranges or self._rows_ranked:
+            for row in new_rows:
+                self._shown[row] = self._accepts(row)
+            if self._sort_keys is not None:
+                # the order is already sorted, so this only merges in the new rows
+                self._order = sorted(self._order + list(new_rows), key=self._sort_keys.__getitem__, reverse=not self._ascending)
+            else:
+                self._order[first:first] = new_rows
+            self._relayout(self._shown_rows())
+        else:
+            for row in new_rows:
+                self._order.insert(self._position(self._order, row), row)
+                if self._accepts(row):
+                    self._shown[row] = 1
+                    position = self._position(self._rows, row)
+                    self.beginInsertRows(QModelIndex(), position, position)
+                    self._rows.insert(position, row)
+                    self._proxy_rows = None
+                    self.endInsertRows()
+
+    def _source_rows_about_to_be_removed(self, parent, first, last):
+        if self._removed and last >= self._removed[-1][0]:
+            # the rows aren't below those removed already, whose numbers they
+            # would have to be worked out among
+            self._renumber()
+        if last - first < self.max_change_ranges:
+            positions = self._proxy_positions([row for row in range(first, last + 1) if self._shown[row]]).values()
+        else:
+            positions = [position for position, row in enumerate(self._rows) if first <= row <= last]
+        ranges = row_ranges(positions)
+        if len(ranges) > self.max_change_ranges:
+            # finished once the source has removed the rows
+            self._removal = self._begin_relayout()
+            return
+
+        for position, count in reversed(ranges):
+            self.beginRemoveRows(QModelIndex(), position, position + count - 1)
+            del self._rows[position:position + count]
+            self._proxy_rows = None
+            self.endRemoveRows()
+
+    def _source_rows_removed(self, parent, first, last):
+        count = last - first + 1
+        self._removed.append((first, count))
+        del self._shown[first:last + 1]
+        self._proxy_rows = None
+
+        if self._removal is not None:
+            indexes, sources = self._removal
+            self._removal = None
+            self._renumber()
+            sources = [(-1 if first <= row <= last else row - count if row > last else row, column) for row, column in sources]
+            self._end_relayout(indexes, sources)
+
+    def _source_data_changed(self, top_left, bottom_right, roles=()):
+        self._renumber()
+        first, last = top_left.row(), bottom_right.row()
+        old_books = self._edited.old_books
+        if last - first >= self.max_change_ranges or self._rows_ranked:
+            old_books.clear()
+            for row in range(first, last + 1):
+                self._shown[row] = self._accepts(row)
+            if self._sort_keys is not None:
+                self._order.sort(key=self._sort_keys.__getitem__, reverse=not self._ascending)
+            self._relayout(self._shown_rows())
+            return
+
+        for row in range(first, last + 1):
+            old_book = old_books.pop(row, None)
+            if old_book is not None and self._sort_keys is not None:
+                self._moving[row] = SortKeyIndex.sort_key(old_book, self._sort_column)
+        for row in range(first, last + 1):
+            self._update_row(row, top_left.column(), bottom_right.column(), roles)
+
+    def _update_row(self, row, first_column, last_column, roles):
+        """Move a changed source row to where it now sorts, and show or hide it if the
+        filter changed its mind about it.
+
+        """
+        order = self._order
+        rows = self._rows
+        del order[self._find(order, row)]
+        old = self._find(rows, row) if self._shown[row] else -1
+        self._moving.pop(row, None)
+        order.insert(self._position(order, row), row)
+
+        shown, accepted = self._shown[row], self._accepts(row)
+        self._shown[row] = accepted
+        if shown:
+            del rows[old]
+            new = self._position(rows, row)
+            rows.insert(old, row)
+            if not accepted:
+                self.beginRemoveRows(QModelIndex(), old, old)
+                del rows[old]
+                self._proxy_rows = None
+                self.endRemoveRows()
+                return
+            if new != old:
+                self.beginMoveRows(QModelIndex(), old, old, QModelIndex(), new if new < old else new + 1)
+                del rows[old]
+                rows.insert(new, row)
+                self._proxy_rows = None
+                self.endMoveRows()
+            self.dataChanged.emit(self.index(new, first_column), self.index(new, last_column), roles)
+        elif accepted:
+            new = self._position(rows, row)
+            self.beginInsertRows(QModelIndex(), new, new)
+            rows.insert(new, row)
+            self._proxy_rows = None
+            self.endInsertRows()
+
+    def _trigram_index_built(self):
+        if self._index_wait is not None:
+            generation, text = self._index_wait
+            self._index_wait = None
+            if generation == self._filter_generation and self.fuzzy:
+                self.set_filter_string(text)
+
+    def _load_finished(self):
+        self._renumber()
+        if self._unsorted:
+            self._unsorted = False
+            self._order = self._sorted_order()
+            self._relayout(self._shown_rows())
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self._sort_column = column
+        self._sort_keys = self.sort_key_index.keys(column) if column >= 0 else None
+        self._ascending = order == Qt.AscendingOrder
+        self._renumber()
+        self._order = self._sorted_order()
+        self._relayout(self._shown_rows())
+
+    def _proxy_positions(self, rows):
+        """Returns a dict with the proxy row of each of the given source rows, which
+        have to be shown. A few rows are looked for in the list of rows shown,
+        which is quicker than building the map of every source row.
+
+        """
+        if len(rows) > self.max_change_ranges:
+            proxy_rows = self._proxy_row_map()
+            return dict((row, proxy_rows[row]) for row in rows)
+        return dict((row, self._rows.index(row)) for row in rows)
+
+    def _proxy_row_map(self):
+        # the proxy row of each source row, -1 for those not shown
+        if self._proxy_rows is None:
+            # numbered as in _rows, which may be before rows were removed
+            self._proxy_rows = [-1] * (len(self._shown) + sum(count for _, count in self._removed))
+            for position, row in enumerate(self._rows):
+                self._proxy_rows[row] = position
+        return self._proxy_rows
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or not 0 <= row < len(self._rows) or not 0 <= column < self.columnCount():
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index):
+        return QModelIndex()
+
+    def sibling(self, row, column, index):
+        return self.index(row, column)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid() or self.sourceModel() is None:
+            return 0
+        return self.sourceModel().columnCount(QModelIndex())
+
+    def mapToSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        self._renumber()
+        return self.sourceModel().index(self._rows[index.row()], index.column())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        self._renumber()
+        return self.index(self._proxy_row_map()[index.row()], index.column())
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if self.sourceModel() is None:
+            return QVariant()
+        if orientation == Qt.Vertical and 0 <= section < len(self._rows):
+            self._renumber()
+            section = self._rows[section]
+        return self.sourceModel().headerData(section, orientation, role)
+
+    def filtered_count(self):
+        return self.rowCount(QModelIndex())
 
 class BookListModel(QAbstractTableModel):
 
@@ -93,13 +663,95 @@ class BookListModel(QAbstractTableModel):
     # Background colour for table items which are from a new book
     new_bg_item_colour = QColor(40,150,190)
 
-    def __init__(self, list_file=None, parent=None):
+    extension = ".txt"
+    proxy_class = MultiColumnFilterProxyModel
+
+    # Role giving the key to sort a cell by, see SortKeyIndex
+    sort_role = Qt.UserRole + 1
+
+    # Number of books inserted into the model at a time while loading a list
+    load_chunk_size = 2000
+
+    # Removing more separate ranges of rows than this at once resets the model
+    max_remove_ranges = 100
+
+    # The journal is folded into the list file in the background this often (ms)
+    compact_interval = 5 * 60 * 1000
+
+    # save folds the journal into the list file once it has this many changes
+    compact_entries = 500
+
+    # Milliseconds to wait after the list file changes on disk before merging
+    # the changes, as sync clients may write it in several goes
+    reload_delay = 500
+
+    # Emitted while a list is loading with the number of bytes read so far and
+    # the size of the file
+    load_progress = pyqtSignal(int, int)
+    load_finished = pyqtSignal()
+
+    # Emitted with the number of changes merged after the list file was changed
+    # by another program
+    list_reloaded = pyqtSignal(int)
+
+    # Emitted once the trigram index has been built in the background
+    trigram_index_built = pyqtSignal()
+
+    # Emitted once the list has been saved and closed
+    list_closed = pyqtSignal()
+
+    # Emitted by the index worker with the version of the rows it built the
+    # trigram index for and the index
+    _trigram_index_done = pyqtSignal(int, object)
+
+    def __init__(self, list_file=None, parent=None, store_class=BookStore):
         super(BookListModel, self).__init__(parent)
-        self.books = [] # all books, old and new
-        self.new_books = [] # only new books
+        self.store_class = store_class
+        self.books = store_class() # all books, old and new
+        self.new_rows = bytearray() # 1 for each row holding a book added in this session
+        self.new_count = 0 # number of books added in this session
         self.deleted_books = []
         self.list_file = list_file
 
+        self.indexes = [] # BookIndex objects which are notified of changes to the books
+        self.duplicate_index = DuplicateIndex()
+        self.add_index(self.duplicate_index)
+        self.sort_key_index = SortKeyIndex()
+        self.add_index(self.sort_key_index)
+        self.reading_stats = ReadingStats()
+        self.add_index(self.reading_stats)
+        self.trigram_index = TrigramIndex([0, 1])
+        self.add_index(self.trigram_index)
+        self._index_executor = None
+        self._building_trigrams = False
+        self._trigram_index_done.connect(self._adopt_trigram_index)
+        self.load_finished.connect(self.build_trigram_index)
+        self.prefix_indexes = [PrefixIndex(0), PrefixIndex(1)] # completions for the title and author boxes
+        for prefix_index in self.prefix_indexes:
+            self.add_index(prefix_index)
+        self.journal = BookJournal()
+        self.add_index(self.journal)
+
+        self.compact_timer = QTimer(self)
+        self.compact_timer.setInterval(self.compact_interval)
+        self.compact_timer.timeout.connect(self.compact_journal)
+        self.compact_timer.start()
+
+        # The list file and its directory are watched for changes made by
+        # other programs, such as a sync client, see reload_list_file
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.list_file_changed)
+        self.watcher.directoryChanged.connect(self.list_file_changed)
+        self.reload_timer = QTimer(self)
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(self.reload_delay)
+        self.reload_timer.timeout.connect(self.reload_list_file)
+
+        self._loader = None # generator producing chunks of books from the list file
+        self._load_generation = 0 # used to discard chunks from a superseded load
+        self.load_position = 0
+        self.load_size = 0
+
     def columnCount(self, parent):
         return 3
 
@@ -108,16 +760,12 @@ class BookListModel(QAbstractTableModel):
 
     def data(self, index, role):
         if role == Qt.DisplayRole or role == Qt.EditRole:
-            book = self.books[index.row()]
-            if index.column() == 0:
-                return book.title
-            elif index.column() == 1:
-                return book.author
-            elif index.column() == 2:
-                return book.date
+            return self.books.field(index.row(), index.column())
         if role == Qt.BackgroundRole:
-            if self.books[index.row()] in self.new_books:
+            if self.new_rows[index.row()]:
                 return BookListModel.new_bg_item_colour
+        if role == BookListModel.sort_role:
+            return self.sort_key_index.key(index.row(), index.column())
 
         return QVariant()
 
@@ -135,13 +783,12 @@ class BookListModel(QAbstractTableModel):
 
     def setData(self, index, value, role):
         if role == Qt.EditRole:
-            book = self.books[index.row()]
-            if index.column() == 0:
-                book.title = value
-            elif index.column() == 1:
-                book.author = value
-            elif index.column() == 2:
-                book.date = value
+            old_book = self.books[index.row()].copy()
+            self.books.set_field(index.row(), index.column(), value)
+            new_book = self.books[index.row()]
+            for book_index in self.indexes:
+                book_index.row_changed(index.row(), old_book, new_book)
+            self.dataChanged.emit(index, index)
 
         return True
 
@@ -154,31 +801,175 @@ class BookListModel(QAbstractTableModel):
 
     def removeRows(self, row, count, parent):
         self.beginRemoveRows(QModelIndex(), row, row + count - 1)
-        to_del = self.books[row:row + count] # can't delete and loop
+        self._remove_rows(row, count)
+        self.endRemoveRows()
+        return True
+
+    def _remove_rows(self, row, count):
+        to_del = [self.books[r] for r in range(row, row + count)] # can't delete and loop
+        self.books.delete(row, count)
+        for book_index in self.indexes:
+            book_index.rows_removed(row, to_del)
+
+        self.new_count -= self.new_rows.count(1, row, row + count)
+        del self.new_rows[row:row + count]
+
         for book in to_del:
             self.deleted_books.append(book)
-            self.books.remove(book)
+            log("removed book {0}", book, level=logging.DEBUG)
 
-            if book in self.new_books:
-                self.new_books.remove(book)
-            log("removed book {0}".format(book.__repr__()))
+    def remove_books(self, rows):
+        """Remove the books at the given rows of this model. Runs of consecutive rows
+        are removed with a single removeRows, working from the end of the list so
+        that the rows still to be removed keep their positions. Returns the number
+        of books removed.
 
-        self.endRemoveRows()
-        return True
+        Views and proxies do work for every removeRows, so if the rows are
+        scattered over more than max_remove_ranges ranges, they are all removed
+        inside a single model reset instead.
+
+        """
+        ranges = row_ranges(rows)
+        reset = len(ranges) > self.max_remove_ranges
+        if reset:
+            self.beginResetModel()
+
+        for row, count in reversed(ranges):
+            if reset:
+                self._remove_rows(row, count)
+            else:
+                self.removeRows(row, count, QModelIndex())
+
+        if reset:
+            self.endResetModel()
+
+        log("removed {0} books in {1} ranges".format(sum(count for _, count in ranges), len(ranges)))
+        return sum(count for _, count in ranges)
+
+    def add_index(self, book_index):
+        """Register a BookIndex to be kept up to date with the books in the model.
+
+        """
+        self.indexes.append(book_index)
+        book_index.reset(self.books)
+
+    def _insert_books(self, books, new):
+        """Append books to the model with a single insertion.
+
+        """
+        first = len(self.books)
+        self.beginInsertRows(QModelIndex(), first, first + len(books) - 1)
+        self.books.extend(books)
+        if new:
+            self.new_rows.extend(b"\x01" * len(books))
+            self.new_count += len(books)
+        else:
+            self.new_rows.extend(bytes(len(books)))
+        for book_index in self.indexes:
+            book_index.rows_inserted(first, books)
+        self.endInsertRows()
+
+    def _replace_book(self, row, book):
+        old_book = self.books[row].copy()
+        for column, field in enumerate(Book.fields):
+            self.books.set_field(row, column, getattr(book, field))
+        for book_index in self.indexes:
+            book_index.row_changed(row, old_book, self.books[row])
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(Book.fields) - 1))
 
     def add_book(self, book):
         log("adding book")
-        self.books.append(book)
-        self.new_books.append(book)
-        self.insertRows(len(self.books) - 1, 1, QModelIndex())
+        self._insert_books([book], True)
+
+    def add_books(self, books):
+        """Add many books at once, with a single insertion.
+
+        """
+        if books:
+            log("adding {0} books".format(len(books)))
+            self._insert_books(list(books), True)
+
+    def split_duplicates(self, books):
+        """Split books into those which are new and those which are similar to a book
+        already in the list or earlier in books. Returns (new, duplicates).
+
+        """
+        return split_duplicates(books, self.duplicate_index.contains_similar)
+
+    def book_count(self):
+        return len(self.books)
+
+    def statistics(self):
+        return self.reading_stats
+
+    def suggest_titles(self, text, limit=10):
+        """Titles in the list which are similar to text, best first. There are none
+        until the trigram index has been built in the background.
+
+        """
+        if not self.trigram_index.built():
+            self.build_trigram_index()
+            return []
+        return [title for _, title in self.trigram_index.search(text, limit, column=0)]
+
+    def build_trigram_index(self):
+        """Build the trigram index on a worker thread, from a snapshot of the titles and
+        authors, unless it is built or being built already. This is started
+        once a list has loaded, so that the first fuzzy search or suggestion
+        doesn't have to build it on the GUI thread. If the rows change before
+        the index is ready, it is built again.
+
+        """
+        if self.trigram_index.built() or self._building_trigrams:
+            return
+
+        version, texts = self.trigram_index.snapshot()
+        if self._index_executor is None:
+            self._index_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._building_trigrams = True
+        self._index_executor.submit(self._build_trigram_index, version, texts)
+
+    def _build_trigram_index(self, version, texts):
+        """Runs on the worker thread.
+
+        """
+        self._trigram_index_done.emit(version, TrigramIndex.from_texts(self.trigram_index.columns, texts))
+
+    def _adopt_trigram_index(self, version, index):
+        self._building_trigrams = False
+        if not self.trigram_index.adopt(version, index):
+            self.build_trigram_index()
+            return
+
+        log("built trigram index of {0} books".format(len(self.books)))
+        self.trigram_index_built.emit()
+
+    def complete(self, column, text, limit=10):
+        """Titles (column 0) or authors (column 1) in the list starting with text,
+        ignoring case, the most used first.
+
+        """
+        return self.prefix_indexes[column].complete(text, limit)
 
     def has_book(self, new_book):
-        for book in self.books:
-            title_match = new_book.title.lower() == book.title.lower()
-            author_match = new_book.author.lower() == book.author.lower()
-            if author_match and title_match:
-                log("Book exists in list")
-                return True
+        """Check whether there is a book with the same title and author in the list,
+        ignoring case.
+
+        """
+        if self.duplicate_index.contains(new_book):
+            log("Book exists in list")
+            return True
+
+        return False
+
+    def has_similar_book(self, new_book):
+        """Like has_book, but also ignores punctuation and whitespace in the title and
+        author.
+
+        """
+        if self.duplicate_index.contains_similar(new_book):
+            log("Similar book exists in list")
+            return True
 
         return False
 
@@ -189,7 +980,7 @@ class BookListModel(QAbstractTableModel):
         """
         log("changing list file, current is {0}".format(list_file))
         if self.list_file:
-            self.write_book_list()
+            self.save()
 
         self.list_file = list_file
         log("list file set to {0}".format(self.list_file))
@@ -201,16 +992,172 @@ class BookListModel(QAbstractTableModel):
         will write them to the file before reading a new set of books. The books
         are read from file in a json format.
 
+        The file is parsed incrementally, and the books are inserted into the
+        model a chunk at a time from the event loop, so the table is usable
+        while a large list is still loading. load_progress is emitted after
+        each chunk and load_finished once the whole file has been read. Use
+        finish_loading to read the rest of the file immediately.
+
+        Once the file has been read, changes recorded in its journal are
+        applied, and the journal carries on recording.
+
+        """
+        if self.journal.recording: # make sure changes are saved before resetting
+            self.save()
+        self.journal.close()
+        self._clear_books()
+
+        self._load_generation += 1
+        self._loader = self._read_chunks(self.list_file)
+        self.load_position = 0
+        self.load_size = os.path.getsize(self.list_file)
+        QTimer.singleShot(0, functools.partial(self._load_next_chunk, self._load_generation))
+
+    def _clear_books(self):
+        self.beginResetModel()
+        self.books.clear()
+        self.new_rows = bytearray()
+        self.new_count = 0
+        for book_index in self.indexes:
+            book_index.reset(self.books)
+        self.endResetModel()
+
+    def _read_chunks(self, list_file):
+        """Generator which yields lists of at most load_chunk_size books read from the
+        list file, along with the number of bytes read so far.
+
+        """
+        with io.open(list_file, 'rb') as f:
+            chunk = []
+            for book_json, position in iter_json_array(f):
+                chunk.append(Book(book_json["title"], book_json["author"], book_json["date"]))
+                if len(chunk) == self.load_chunk_size:
+                    yield chunk, position
+                    chunk = []
+
+            if chunk:
+                yield chunk, self.load_size
+
+    def _load_next_chunk(self, generation=None):
+        """Insert the next chunk of books from the list file into the model. Returns
+        False once there is nothing left to load.
+
+        """
+        if self._loader is None or (generation is not None and generation != self._load_generation):
+            return False
+
+        try:
+            books, self.load_position = next(self._loader)
+        except StopIteration:
+            self._loader = None
+            self.load_position = self.load_size
+            log("finished loading {0} books from {1}".format(len(self.books), self.list_file))
+            self._apply_journal()
+            self.load_finished.emit()
+            return False
+
+        self._insert_books(books, False)
+        self.load_progress.emit(self.load_position, self.load_size)
+
+        if generation is not None:
+            QTimer.singleShot(0, functools.partial(self._load_next_chunk, generation))
+
+        return True
+
+    def is_loading(self):
+        return self._loader is not None
+
+    def finish_loading(self):
+        """Load whatever is left of the list file without returning to the event loop.
+
         """
-        if self.new_books: # if there are new books, write them to file before resetting
+        while self._load_next_chunk():
+            pass
+
+    def _apply_journal(self):
+        """Apply the changes recorded in the journal of the list file, and start
+        recording new ones.
+
+        """
+        base = BookKeys(self.books) # what the list file holds
+        entries, journal_file, merged = BookJournal.recover(self.list_file, self.books)
+        if entries:
+            log("replaying {0} changes from {1}".format(len(entries), journal_file))
+            self._apply_changes(entries)
+
+        self.journal.open(self.list_file, journal_file, len(entries), base)
+        if merged:
+            # the journal was kept for an earlier version of the list file, so it
+            # is only removed once the merged list has been written
             self.write_book_list()
+        self.watch_list_file()
 
-        self.books = []
-        self.new_books = []
+    def _apply_changes(self, entries):
+        """Apply changes in the form of journal entries to the books, with a signal
+        for each row changed, inserted or removed.
 
-        with open(self.list_file, 'r') as f:
-            for book_json in json.loads(f.read()):
-                self.books.append(Book(book_json["title"], book_json["author"], book_json["date"]))
+        """
+        edited, added, removed = replay_journal(entries, self.books)
+        for row, book in edited.items():
+            self._replace_book(row, book)
+        if added:
+            self._insert_books(added, False)
+        self.remove_books(removed)
+
+    def watch_list_file(self):
+        self.stop_watching()
+        self.watcher.addPaths([self.list_file, os.path.dirname(os.path.abspath(self.list_file))])
+
+    def stop_watching(self):
+        self.reload_timer.stop()
+        paths = self.watcher.files() + self.watcher.directories()
+        if paths:
+            self.watcher.removePaths(paths)
+
+    def list_file_changed(self, path):
+        self.reload_timer.start()
+
+    def reload_list_file(self):
+        """Merge changes made to the list file by another program into the model.
+
+        The file is compared with the books it held when it was last read or
+        written, and only the books which differ are removed, inserted or
+        changed, so the view keeps its selection and filter. Changes made in
+        this session are kept, and where both sides changed the same book, the
+        change made here wins. If the model has changes the file doesn't, the
+        merged list is written back, otherwise the journal starts afresh on
+        the new file. Our own writes are recognised by the fingerprint of the
+        file, and ignored.
+
+        """
+        if not self.journal.recording or self.journal.base is None:
+            return
+        if self.is_loading() or self.journal.compacting():
+            self.reload_timer.start()
+            return
+
+        if self.list_file not in self.watcher.files() and os.path.exists(self.list_file):
+            self.watcher.addPath(self.list_file) # replacing a file drops its watch
+
+        try:
+            if list_file_fingerprint(self.list_file) == self.journal.base_fingerprint:
+                return
+            theirs = load_list_file(self.list_file, self.store_class)
+            their_entries, _ = BookJournal.read(self.list_file)
+        except (IOError, OSError, ValueError) as e:
+            # missing or half written, wait for the next change
+            log("couldn't read changed list file {0}: {1}".format(self.list_file, e))
+            return
+
+        entries = self.journal.base.diff(theirs, itertools.chain(self.books, self.journal.recorded_books()))
+        log("list file {0} changed on disk, merging {1} changes".format(self.list_file, len(entries)))
+        local_changes = self.journal.entries
+        self.journal.close() # the merged changes are in the file already
+        self._apply_changes(entries)
+        self.journal.open(self.list_file, base=BookKeys(theirs))
+        if local_changes or their_entries:
+            self.write_book_list()
+        self.list_reloaded.emit(len(entries))
 
     def write_book_list(self):
         """Write the books to file. This writes books that existed in the file when it
@@ -218,22 +1165,879 @@ class BookListModel(QAbstractTableModel):
         we automatically transfer modifications to any books without having to
         check which books were modified and just changing those bits.
 
+        This always rewrites the whole file, use save to only write out what
+        has changed.
+
         """
+        # never overwrite the file with a partially loaded list
+        self.finish_loading()
+        self.journal.wait()
+
         log("writing book list to {0}".format(self.list_file))
-        with open(self.list_file, 'w') as f:
-            book_dicts = []
-            for book in self.books:
-                log("wrote {0}".format(book.__dict__))
-                book_dicts.append(book.__dict__)
+        write_list_file(self.list_file, self.books)
+        self.journal.discard()
+        if self.journal.recording:
+            self.journal.rebase(self.books)
+
+    def save(self):
+        """Make sure all changes are on disk. Usually this only needs to sync the
+        journal, but once the journal gets long it is folded into the list file.
+        Changes made to the file by another program are merged first.
+
+        """
+        self.finish_loading()
+        self.reload_list_file()
+        if self.journal.entries >= self.compact_entries:
+            self.journal.wait()
+            self.journal.compact(self.books, background=False)
+        else:
+            self.journal.sync()
+
+    def compact_journal(self):
+        """Fold the journal into the list file in the background.
+
+        """
+        if not self.is_loading():
+            self.journal.compact(self.books)
+
+    def close_list(self):
+        """Save and stop recording changes to the list file.
+
+        """
+        if self.list_file:
+            self.save()
+        self.journal.close()
+        self.stop_watching()
+        if self._index_executor is not None:
+            # an index still being built is for the rows of this list
+            self._index_executor.shutdown(wait=False)
+            self._index_executor = None
+        self.list_closed.emit()
+
+class ShardedProxyModel(MultiColumnFilterProxyModel):
+    """Proxy for a ShardedBookListModel. Shards are only loaded as the view scrolls
+    down to them, so before filtering, all of them are loaded.
+
+    """
+
+    def set_filter_string(self, text):
+        if text:
+            self.sourceModel().finish_loading()
+        super(ShardedProxyModel, self).set_filter_string(text)
+
+    def request_filter(self, text):
+        if text:
+            self.sourceModel().finish_loading()
+        super(ShardedProxyModel, self).request_filter(text)
+
+    def filtered_count(self):
+        if not self.search_index.query and not self._ranked():
+            return self.sourceModel().book_count() # including the shards not loaded yet
+        return super(ShardedProxyModel, self).filtered_count()
+
+class ShardedBookListModel(BookListModel):
+    """Model for a list kept as a directory of yearly shards, see ShardedList. The
+    newest shard is loaded when the list is opened, and older ones as the view
+    asks for more rows with fetchMore, or all at once when the list is
+    filtered or checked for duplicates.
+
+    There is no journal. Instead the shards which have changed are written out
+    shortly after the change, which only costs as much as the years edited.
+
+    """
+
+    extension = ShardedList.extension
+    proxy_class = ShardedProxyModel
+
+    # Changed shards are written this long after the last change (ms)
+    save_delay = 2000
+
+    def __init__(self, list_file=None, parent=None, store_class=BookStore):
+        super(ShardedBookListModel, self).__init__(list_file, parent, store_class)
+        self.shards = None
+        self.pending_shards = [] # keys of the shards which haven't been loaded, newest first
+
+        self.save_timer = QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(self.save_delay)
+        self.save_timer.timeout.connect(self.save)
+        self.dirty_shards = DirtyShards(self.save_timer.start)
+        self.add_index(self.dirty_shards)
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and bool(self.pending_shards)
+
+    def fetchMore(self, parent):
+        if self.pending_shards:
+            self._load_shard(self.pending_shards[0])
+
+    def read_book_list(self):
+        """Read the manifest of the sharded list and load the newest shard.
+
+        """
+        if self.shards is not None:
+            self.save()
+        self._clear_books()
+
+        self.shards = ShardedList(self.list_file)
+        self.pending_shards = self.shards.keys()
+        log("opened {0} with {1} books in {2} shards".format(self.list_file, self.shards.total(), len(self.pending_shards)))
+        self.fetchMore(QModelIndex())
+        if not self.pending_shards:
+            self.load_finished.emit()
+
+    def _load_shard(self, key):
+        self.pending_shards.remove(key)
+        books = self.shards.load(key, self.store_class)
+        self.dirty_shards.recording = False
+        if len(books):
+            self._insert_books(list(books), False)
+        self.dirty_shards.recording = True
+        log("loaded {0} books from shard {1}".format(len(books), key))
+
+        loaded = len(self.shards.counts) - len(self.pending_shards)
+        self.load_progress.emit(loaded, len(self.shards.counts))
+        if not self.pending_shards:
+            self.load_finished.emit()
+
+    def finish_loading(self):
+        """Load all the shards which haven't been loaded yet.
+
+        """
+        while self.pending_shards:
+            self._load_shard(self.pending_shards[0])
+
+    def book_count(self):
+        if self.shards is None:
+            return len(self.books)
+        # the manifest has the sizes of the shards which haven't been loaded
+        return len(self.books) + sum(self.shards.counts[key] for key in self.pending_shards)
+
+    def statistics(self):
+        self.finish_loading()
+        return self.reading_stats
+
+    def has_book(self, new_book):
+        self.finish_loading()
+        return super(ShardedBookListModel, self).has_book(new_book)
+
+    def has_similar_book(self, new_book):
+        self.finish_loading()
+        return super(ShardedBookListModel, self).has_similar_book(new_book)
+
+    def split_duplicates(self, books):
+        self.finish_loading()
+        return super(ShardedBookListModel, self).split_duplicates(books)
+
+    def write_book_list(self):
+        """Write out every shard.
+
+        """
+        self.finish_loading()
+        self.dirty_shards.dirty.update(self.shards.counts)
+        self.save()
+
+    def save(self):
+        """Write the shards which have changed. A shard which has changed without
+        being loaded, e.g. because a book was added to it, is loaded first.
+
+        """
+        if self.shards is None or not self.dirty_shards.dirty:
+            return
+
+        for key in list(self.dirty_shards.dirty):
+            if key in self.pending_shards:
+                self._load_shard(key)
+
+        shards = dict((key, []) for key in self.dirty_shards.dirty)
+        for book in self.books:
+            key = ShardedList.shard_key(book)
+            if key in shards:
+                shards[key].append(book)
+
+        log("writing shards {0} of {1}".format(sorted(shards), self.list_file))
+        self.shards.write(shards)
+        self.dirty_shards.dirty.clear()
+        self.save_timer.stop()
+
+    def compact_journal(self):
+        self.save()
+
+class BinaryBookListModel(BookListModel):
+    """Model of a list in the binary list format, whose books are kept in a
+    MappedBookStore. Opening the list maps the file instead of reading it, so
+    the whole list is there at once whatever its size, and a row is only
+    decoded when it is shown or looked at. Changes are recorded in the journal
+    as for JSON lists, and compacting the journal writes the list back out in
+    the binary format.
+
+    """
+
+    extension = MappedBookStore.extension
+
+    def read_book_list(self):
+        if self.journal.recording: # make sure changes are saved before resetting
+            self.save()
+        self.journal.close()
+
+        self._load_generation += 1
+        self._loader = None
+        self.beginResetModel()
+        self.books = MappedBookStore(self.list_file)
+        self.new_rows = bytearray(len(self.books))
+        self.new_count = 0
+        for book_index in self.indexes:
+            book_index.reset(self.books)
+        self.endResetModel()
+        self.load_position = self.load_size = os.path.getsize(self.list_file)
+        log("mapped {0} books from {1}".format(len(self.books), self.list_file))
+
+        self._apply_journal()
+        # the window connects to the model after the list is opened
+        QTimer.singleShot(0, self.load_finished.emit)
 
-            f.write(json.dumps(book_dicts, indent=1))
+class SqliteProxyModel(QIdentityProxyModel):
+    """Stands in for MultiColumnFilterProxyModel in front of a SqliteBookListModel.
+    Sorting and filtering are queries run by the model, so this just passes them
+    on.
+
+    """
+
+    filter_applied = pyqtSignal(str)
+
+    def set_filter_string(self, text):
+        self.sourceModel().set_filter(text)
+        self.filter_applied.emit(text)
+
+    def request_filter(self, text):
+        self.set_filter_string(text)
+
+    def filtered_count(self):
+        return self.sourceModel().match_count
+
+class SqliteBookListModel(QAbstractTableModel):
+    """Model for a book list kept in an SQLite database. Only the rows the view
+    has scrolled to are read from the database, fetch_size at a time through
+    canFetchMore and fetchMore, in the current sort order and matching the
+    current filter. Sorting and filtering are done by queries, which reset the
+    rows that have been fetched.
+
+    Books added or edited in the session are slotted into the fetched rows at
+    their sorted position, or left for a later fetch if they sort after the
+    last book fetched.
+
+    """
+
+    extension = ".sqlite"
+    proxy_class = SqliteProxyModel
+    fetch_size = 500
+
+    load_progress = pyqtSignal(int, int)
+    load_finished = pyqtSignal()
+
+    def __init__(self, list_file=None, parent=None):
+        super(SqliteBookListModel, self).__init__(parent)
+        self.database = None
+        self.list_file = list_file
+        self.indexes = [] # BookIndex objects, which see the fetched rows
+
+        self.books = BookStore() # fetched books
+        self.ids = [] # database ids of the fetched books
+        self.sort_keys = [] # (sort key, id) of the fetched books
+        self.fetch_cursor = None # (sort key, id) of the last book fetched from the database
+        self.new_ids = set() # ids of books added in this session
+        self.deleted_books = []
+
+        self.sort_column = 2
+        self.descending = True
+        self.filter_text = u""
+        self.where, self.where_params = "1", ()
+        self.total = 0 # books in the database
+        self.match_count = 0 # books matching the filter
+
+    @property
+    def new_count(self):
+        return len(self.new_ids)
+
+    def columnCount(self, parent):
+        return 3
+
+    def rowCount(self, parent):
+        if parent.isValid():
+            return 0
+        return len(self.ids)
+
+    def data(self, index, role):
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            return self.books.field(index.row(), index.column())
+        if role == Qt.BackgroundRole:
+            if self.ids[index.row()] in self.new_ids:
+                return BookListModel.new_bg_item_colour
+
+        return QVariant()
+
+    def headerData(self, section, orientation, role):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return ["Title", "Author", "Date"][section]
+
+        return QVariant()
+
+    def flags(self, index):
+        return Qt.ItemIsSelectable | Qt.ItemIsEditable | Qt.ItemIsEnabled
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and len(self.ids) < self.match_count
+
+    def fetchMore(self, parent):
+        rows = self.database.fetch(self.sort_column, self.descending, self.where, self.where_params, self.fetch_cursor, self.fetch_size)
+        if not rows:
+            self.match_count = len(self.ids)
+            return
+        # the fetched rows can end with a book edited since, so the database's
+        # order is followed from the last book it returned
+        self.fetch_cursor = (rows[-1][4], rows[-1][0])
+
+        books = [Book.view(title, author, date) for _, title, author, date, _ in rows]
+        first = len(self.ids)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.books.extend(books)
+        self.ids.extend(row[0] for row in rows)
+        self.sort_keys.extend((row[4], row[0]) for row in rows)
+        for book_index in self.indexes:
+            book_index.rows_inserted(first, books)
+        self.endInsertRows()
+
+    def _refetch(self):
+        """Forget the fetched rows, after the sort order or filter has changed.
+
+        """
+        self.beginResetModel()
+        self.books.clear()
+        self.ids = []
+        self.sort_keys = []
+        self.fetch_cursor = None
+        self.match_count = self.database.count(self.where, self.where_params) if self.database else 0
+        for book_index in self.indexes:
+            book_index.reset(self.books)
+        self.endResetModel()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.descending = order == Qt.DescendingOrder
+        self._refetch()
+
+    def set_filter(self, text):
+        self.filter_text = text
+        self.where, self.where_params = self.database.filter_clause(text)
+        self._refetch()
+
+    def _sort_key(self, book_id, book):
+        return ([book.title.casefold(), book.author.casefold(), book.date][self.sort_column], book_id)
+
+    def _position(self, key):
+        """Row at which a book with the given (sort key, id) belongs among the fetched
+        rows.
+
+        """
+        low, high = 0, len(self.sort_keys)
+        while low < high:
+            middle = (low + high) // 2
+            if (self.sort_keys[middle] > key) if self.descending else (self.sort_keys[middle] < key):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _fetched_later(self, key):
+        """Check whether a book with the given (sort key, id) sorts after the last book
+        fetched, so that it will be fetched along with the books around it.
+
+        """
+        if not self.canFetchMore(QModelIndex()):
+            return False
+        if self.fetch_cursor is None:
+            return True
+        return key < self.fetch_cursor if self.descending else key > self.fetch_cursor
+
+    def _reposition(self, row, key):
+        """Move an edited row to where its new (sort key, id) belongs, so that the
+        fetched rows stay in order, or drop it if it now sorts after the last book
+        fetched.
+
+        """
+        book = self.books[row]
+        if self._fetched_later(key):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            self.books.delete(row, 1)
+            del self.ids[row]
+            del self.sort_keys[row]
+            for book_index in self.indexes:
+                book_index.rows_removed(row, [book])
+            self.endRemoveRows()
+            return
+
+        position = self._position(key) # among the rows including the edited one
+        if position in (row, row + 1):
+            self.sort_keys[row] = key
+            return
+
+        book_id = self.ids[row]
+        target = position if position < row else position - 1
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), position)
+        self.books.delete(row, 1)
+        del self.ids[row]
+        del self.sort_keys[row]
+        for book_index in self.indexes:
+            book_index.rows_removed(row, [book])
+        self.books.insert(target, book)
+        self.ids.insert(target, book_id)
+        self.sort_keys.insert(target, key)
+        for book_index in self.indexes:
+            book_index.rows_inserted(target, [book])
+        self.endMoveRows()
+
+    def setData(self, index, value, role):
+        if role == Qt.EditRole:
+            row = index.row()
+            old_book = self.books[row].copy()
+            self.books.set_field(row, index.column(), value)
+            new_book = self.books[row]
+            self.database.update(self.ids[row], new_book)
+            for book_index in self.indexes:
+                book_index.row_changed(row, old_book, new_book)
+            self.dataChanged.emit(index, index)
+            self._reposition(row, self._sort_key(self.ids[row], new_book))
+
+        return True
+
+    def add_book(self, book):
+        log("adding book")
+        book_id = self.database.insert([book])[0]
+        self.new_ids.add(book_id)
+        self.total += 1
+        if not self.database.matches(book_id, self.where, self.where_params):
+            return
+
+        self.match_count += 1
+        key = self._sort_key(book_id, book)
+        if self._fetched_later(key):
+            return
+        row = self._position(key)
+
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.books.insert(row, book)
+        self.ids.insert(row, book_id)
+        self.sort_keys.insert(row, key)
+        for book_index in self.indexes:
+            book_index.rows_inserted(row, [book])
+        self.endInsertRows()
+
+    def add_books(self, books):
+        """Add many books at once. They are inserted in one transaction and the
+        fetched rows are reset once, rather than slotting in each book.
+
+        """
+        if not books:
+            return
+        log("adding {0} books".format(len(books)))
+        ids = self.database.insert(books)
+        self.new_ids.update(ids)
+        self.total += len(ids)
+        self._refetch()
+
+    def split_duplicates(self, books):
+        return split_duplicates(books, self.database.has_similar_book)
+
+    def removeRows(self, row, count, parent):
+        self.beginRemoveRows(QModelIndex(), row, row + count - 1)
+        to_del = [self.books[r] for r in range(row, row + count)]
+        ids = self.ids[row:row + count]
+        self.database.delete(ids)
+        self.books.delete(row, count)
+        del self.ids[row:row + count]
+        del self.sort_keys[row:row + count]
+        self.new_ids.difference_update(ids)
+        self.total -= count
+        self.match_count -= count
+        for book_index in self.indexes:
+            book_index.rows_removed(row, to_del)
+        self.deleted_books.extend(to_del)
+        self.endRemoveRows()
+        return True
+
+    def remove_books(self, rows):
+        ranges = row_ranges(rows)
+        for row, count in reversed(ranges):
+            self.removeRows(row, count, QModelIndex())
+        return sum(count for _, count in ranges)
+
+    def add_index(self, book_index):
+        self.indexes.append(book_index)
+        book_index.reset(self.books)
+
+    def book_count(self):
+        return self.total
+
+    def statistics(self):
+        """Statistics are counted by the database when asked for, as only the fetched
+        rows are in the model.
+
+        """
+        return self.database.statistics()
+
+    def suggest_titles(self, text, limit=10):
+        return self.database.similar_titles(text, limit)
+
+    def complete(self, column, text, limit=10):
+        return self.database.complete(column, text, limit)
+
+    def has_book(self, new_book):
+        return self.database.has_book(new_book)
+
+    def has_similar_book(self, new_book):
+        return self.database.has_similar_book(new_book)
+
+    def is_loading(self):
+        return False
+
+    def finish_loading(self):
+        pass
+
+    def set_list_file(self, list_file):
+        log("changing list file, current is {0}".format(list_file))
+        self.close_list()
+        self.list_file = list_file
+        self.read_book_list()
+
+    def read_book_list(self):
+        """Open the database. Nothing is read until the view asks for rows.
+
+        """
+        self.database = SqliteBookDatabase(self.list_file)
+        self.total = self.database.count()
+        self.new_ids = set()
+        self.where, self.where_params = self.database.filter_clause(self.filter_text)
+        self._refetch()
+        log("opened database {0} with {1} books".format(self.list_file, self.total))
+        self.load_finished.emit()
+
+    def write_book_list(self):
+        self.save()
+
+    def save(self):
+        if self.database:
+            self.database.connection.commit()
+
+    def close_list(self):
+        if self.database:
+            self.database.close()
+            self.database = None
+
+class ColumnWidthTracker(BookIndex):
+    """Keeps track of how wide the text in each column of the book list is, so that
+    the table can be sized to its contents without measuring every row. The
+    widths of all texts in a column are counted, and the largest is only
+    looked for again when the last text with that width is removed.
+
+    """
+
+    def __init__(self, font_metrics, columns, padding=0):
+        self.font_metrics = font_metrics
+        self.columns = columns
+        self.padding = padding # added to the text width, for the cell margins
+        self._books = []
+        self._counts = None # for each column, text width -> number of rows
+        self._widest = {} # column -> largest width in _counts, or None if unknown
+
+    def _width(self, text):
+        return self.font_metrics.horizontalAdvance(text)
+
+    def _build(self):
+        self._counts = {}
+        for column in self.columns:
+            field = Book.fields[column]
+            # Authors repeat a lot, so only measure each distinct text once
+            text_counts = collections.Counter(getattr(book, field) for book in self._books)
+            widths = collections.Counter()
+            for text, count in text_counts.items():
+                widths[self._width(text)] += count
+            self._counts[column] = widths
+            self._widest[column] = None
+
+    def _add(self, book):
+        for column in self.columns:
+            width = self._width(getattr(book, Book.fields[column]))
+            self._counts[column][width] += 1
+            if self._widest[column] is not None and width > self._widest[column]:
+                self._widest[column] = width
+
+    def _remove(self, book):
+        for column in self.columns:
+            width = self._width(getattr(book, Book.fields[column]))
+            counts = self._counts[column]
+            counts[width] -= 1
+            if counts[width] <= 0:
+                del counts[width]
+                if width == self._widest[column]:
+                    self._widest[column] = None
+
+    def widths(self):
+        """Returns a dict from column to the width needed to show all of its contents.
+
+        """
+        if self._counts is None:
+            self._build()
+
+        for column in self.columns:
+            if self._widest[column] is None:
+                self._widest[column] = max(self._counts[column]) if self._counts[column] else 0
+
+        return dict((column, self._widest[column] + self.padding) for column in self.columns)
+
+    def reset(self, books):
+        self._books = books
+        self._counts = None
+
+    def rows_inserted(self, row, books):
+        if self._counts is not None:
+            for book in books:
+                self._add(book)
+
+    def rows_removed(self, row, books):
+        if self._counts is not None:
+            for book in books:
+                self._remove(book)
+
+    def row_changed(self, row, old_book, new_book):
+        if self._counts is not None:
+            self._remove(old_book)
+            self._add(new_book)
+
+class StatsDock(QDockWidget):
+    """Dashboard showing how many books were read each year and month, who the
+    most read authors are and the recent reading rate. The figures come from
+    the model's ReadingStats, which is kept up to date as the list changes,
+    so refreshing only has to fill in the tables, and only happens while the
+    dock is shown.
+
+    """
+
+    # Milliseconds to wait after a change to the list before refreshing
+    refresh_delay = 500
+
+    top_author_count = 50
+
+    def __init__(self, parent=None):
+        super(StatsDock, self).__init__("Statistics", parent)
+        self.setObjectName("statistics")
+        self.book_model = None
+        self._shown = None # (stats, version) currently shown
+
+        self.summary = QLabel()
+        self.years_table = StatsDock.create_table(["Year", "Books"])
+        self.months_table = StatsDock.create_table(["Month", "Books"])
+        self.authors_table = StatsDock.create_table(["Author", "Books"])
+
+        self.tabs = QTabWidget()
+        self.tabs.addTab(self.years_table, "Years")
+        self.tabs.addTab(self.months_table, "Months")
+        self.tabs.addTab(self.authors_table, "Authors")
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.summary)
+        layout.addWidget(self.tabs)
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(self.refresh_delay)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.refresh)
+
+    @staticmethod
+    def create_table(headers):
+        table = QTableWidget(0, len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.verticalHeader().setVisible(False)
+        table.setEditTriggers(QTableWidget.NoEditTriggers)
+        table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        return table
+
+    @staticmethod
+    def fill_table(table, rows):
+        table.setRowCount(len(rows))
+        for row, (label, count) in enumerate(rows):
+            table.setItem(row, 0, QTableWidgetItem(label))
+            item = QTableWidgetItem(str(count))
+            item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+            table.setItem(row, 1, item)
+
+    def set_model(self, book_model):
+        """Show the statistics of book_model, refreshing whenever it changes.
+
+        """
+        self.book_model = book_model
+        self._shown = None
+        for changed in (book_model.rowsInserted, book_model.rowsRemoved, book_model.dataChanged, book_model.modelReset):
+            changed.connect(self.schedule_refresh)
+        self.schedule_refresh()
+
+    def schedule_refresh(self, *args):
+        if self.isVisible():
+            self.refresh_timer.start()
+
+    def refresh(self, *args):
+        if self.book_model is None or not self.isVisible():
+            return
+
+        stats = self.book_model.statistics()
+        if self._shown == (stats, stats.version):
+            return
+        self._shown = (stats, stats.version)
+
+        this_year = QDate.currentDate().toString("yyyy")
+        self.summary.setText("{0} books, {1} this year, {2:.1f} a month over the last year".format(stats.total, stats.years().get(this_year, 0), stats.reading_rate()))
+        StatsDock.fill_table(self.years_table, sorted(stats.years().items(), reverse=True))
+        StatsDock.fill_table(self.months_table, [(month, count) for month, count in reversed(stats.monthly_counts()) if count])
+        StatsDock.fill_table(self.authors_table, stats.top_authors(self.top_author_count))
+
+class ProfileDock(QDockWidget):
+    """Debug panel shown when profiling is switched on, see book_profile. It shows
+    the call counts and times of the instrumented hot paths while it is
+    open, and captures cProfile profiles of the next filter or of a save.
+
+    """
+
+    # Milliseconds between refreshes of the counters
+    refresh_interval = 1000
+
+    def __init__(self, parent=None):
+        super(ProfileDock, self).__init__("Profile", parent)
+        self.setObjectName("profile")
+        self.book_model = None
+        self.capture = None # capture of a filter which is in progress
+        self.capture_filter = False # capture the next filter
+
+        self.table = StatsDock.create_table(["Function", "Calls", "Total ms", "Mean us", "Max ms"])
+        self.last_capture = QLabel("No profiles captured")
+        self.last_capture.setWordWrap(True)
+
+        self.filter_button = QPushButton("Profile next filter")
+        self.filter_button.setCheckable(True)
+        self.filter_button.toggled.connect(self.set_capture_filter)
+        self.save_button = QPushButton("Profile save")
+        self.save_button.clicked.connect(self.profile_save)
+        self.reset_button = QPushButton("Reset counters")
+        self.reset_button.clicked.connect(self.reset_counters)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.filter_button)
+        buttons.addWidget(self.save_button)
+        buttons.addWidget(self.reset_button)
+
+        layout = QVBoxLayout()
+        layout.addLayout(buttons)
+        layout.addWidget(self.table)
+        layout.addWidget(self.last_capture)
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(self.refresh_interval)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.visibility_changed)
+
+    def set_models(self, book_model, proxy_model):
+        self.book_model = book_model
+        proxy_model.filter_applied.connect(self.filter_finished)
+
+    def visibility_changed(self, visible):
+        if visible:
+            self.refresh()
+            self.refresh_timer.start()
+        else:
+            self.refresh_timer.stop()
+
+    def refresh(self):
+        rows = sorted(book_profile.call_stats.items(), key=lambda item: -item[1].seconds)
+        self.table.setRowCount(len(rows))
+        for row, (label, stats) in enumerate(rows):
+            self.table.setItem(row, 0, QTableWidgetItem(label))
+            for column, value in enumerate([str(stats.calls), "{0:.1f}".format(stats.seconds * 1e3), "{0:.1f}".format(stats.mean() * 1e6), "{0:.2f}".format(stats.slowest * 1e3)], 1):
+                item = QTableWidgetItem(value)
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
+
+    def reset_counters(self):
+        book_profile.reset_stats()
+        self.refresh()
+
+    def set_capture_filter(self, capture):
+        self.capture_filter = capture
+
+    def filter_started(self):
+        """Called as the filter string is applied. Starts the capture if the next
+        filter is to be profiled. The capture runs until the proxy shows the
+        result, which for large lists comes back from the worker thread.
+
+        """
+        if not self.capture_filter or self.capture is not None:
+            return
+        self.capture = book_profile.Capture("filter")
+        self.capture.start()
+
+    def filter_finished(self, text):
+        if self.capture is None:
+            return
+        capture, self.capture = self.capture, None
+        self.captured(capture.stop())
+        self.filter_button.setChecked(False)
+
+    def profile_save(self):
+        if self.book_model is None:
+            return
+        capture = book_profile.Capture("save")
+        capture.run(self.book_model.save)
+        self.captured(capture.profile_file)
+
+    def captured(self, profile_file):
+        self.last_capture.setText("Last profile: {0}".format(os.path.abspath(profile_file)))
+        self.parent().statusBar().showMessage("Profile written to {0}".format(profile_file))
+        self.refresh()
 
 class BookList(QMainWindow):
 
-    def __init__(self, list_file=None):
+    # Milliseconds to wait after the last change to the filter string before
+    # filtering
+    filter_delay = 150
+
+    # Milliseconds to wait after typing in the title box before suggesting
+    # similar titles
+    suggest_delay = 200
+
+    # Number of duplicates listed in the details of the import summary
+    import_listed_duplicates = 1000
+
+    # Emitted by the import worker with the file being imported and the number
+    # of books read so far
+    import_progress = pyqtSignal(str, int)
+
+    # Emitted by the import worker with the file, the BookImport read from it,
+    # or None if it couldn't be read, and the error
+    import_read = pyqtSignal(str, object, str)
+
+    def __init__(self, list_file=None, store_class=BookStore):
         super(BookList, self).__init__()
 
-        self.book_model = BookListModel()
+        self.store_class = store_class
+        self.importing = False
+        self.import_executor = None
+        self.import_progress.connect(self.import_progressed)
+        self.import_read.connect(self.finish_import)
+        self.book_model = BookListModel(store_class=store_class)
         log("created book list model")
         self.list_file = list_file
         log("got list file {0}".format(self.list_file))
@@ -248,8 +2052,21 @@ class BookList(QMainWindow):
     def create_window(self):
         self.main_widget = QWidget()
 
+        if not hasattr(self, "stats_dock"):
+            self.stats_dock = StatsDock(self)
+            self.addDockWidget(Qt.RightDockWidgetArea, self.stats_dock)
+            self.stats_dock.hide()
+        self.stats_dock.set_model(self.book_model)
+
+        if book_profile.enabled and not hasattr(self, "profile_dock"):
+            self.profile_dock = ProfileDock(self)
+            self.addDockWidget(Qt.BottomDockWidgetArea, self.profile_dock)
+            self.profile_dock.hide()
+
         self.create_add_widget()
         self.create_view_widget()
+        if hasattr(self, "profile_dock"):
+            self.profile_dock.set_models(self.book_model, self.proxy_model)
 
         self.main_layout = QVBoxLayout()
         self.main_layout.addWidget(self.view_widget)
@@ -279,6 +2096,13 @@ class BookList(QMainWindow):
         self.author_input.setMinimumWidth(250)
         self.author_input.setMaximumWidth(500)
         self.author_input.setPlaceholderText("Author")
+        # Complete authors already in the list as they are typed, the most read
+        # first, so that they are spelt the same way every time
+        self.author_completions = QStringListModel(self)
+        self.author_completer = QCompleter(self.author_completions, self)
+        self.author_completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.author_input.setCompleter(self.author_completer)
+        self.author_input.textEdited.connect(self.complete_author)
         self.author_lock = QCheckBox()
         self.author_lock.setToolTip("Don't erase author when adding")
 
@@ -286,6 +2110,18 @@ class BookList(QMainWindow):
         self.title_input.setMinimumWidth(250)
         self.title_input.setMaximumWidth(500)
         self.title_input.setPlaceholderText("Title")
+        # Complete titles already in the list as they are typed, and add titles
+        # which are similar to what is being typed once typing pauses
+        self.title_suggestions = QStringListModel(self)
+        self.title_completer = QCompleter(self.title_suggestions, self)
+        self.title_completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.title_input.setCompleter(self.title_completer)
+        self.suggest_timer = QTimer(self)
+        self.suggest_timer.setSingleShot(True)
+        self.suggest_timer.setInterval(self.suggest_delay)
+        self.suggest_timer.timeout.connect(self.suggest_titles)
+        self.title_input.textEdited.connect(self.complete_title)
+        self.title_input.textEdited.connect(self.suggest_timer.start)
 
         self.date_input = QDateEdit(QDate.currentDate())
         self.date_input.setMinimumWidth(250)
@@ -329,9 +2165,14 @@ class BookList(QMainWindow):
         self.table_widget = QTableView()
         self.table_widget.setSortingEnabled(True)
 
-        self.proxy_model = MultiColumnFilterProxyModel()
+        self.proxy_model = self.book_model.proxy_class()
         self.proxy_model.setSourceModel(self.book_model)
 
+        self.book_model.load_progress.connect(self.loading_progressed)
+        self.book_model.load_finished.connect(self.loading_finished)
+        if hasattr(self.book_model, "list_reloaded"):
+            self.book_model.list_reloaded.connect(self.list_reloaded)
+
         self.table_widget.setModel(self.proxy_model)
         # Can only sort properly after proxy model has been set
         self.table_widget.sortByColumn(2, Qt.DescendingOrder)
@@ -339,10 +2180,18 @@ class BookList(QMainWindow):
         # Title and author are set to contents, but date is fixed
         self.table_widget.horizontalHeader().setMinimumSectionSize(100)
         self.table_widget.horizontalHeader().setMaximumSectionSize(400)
-        self.table_widget.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeToContents)
-        self.table_widget.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeToContents)
+        self.table_widget.horizontalHeader().setSectionResizeMode(0, QHeaderView.Interactive)
+        self.table_widget.horizontalHeader().setSectionResizeMode(1, QHeaderView.Interactive)
         self.table_widget.horizontalHeader().setSectionResizeMode(2, QHeaderView.Fixed)
 
+        # Rather than have the view measure every row whenever the table
+        # changes, keep track of the text widths as books are added, edited and
+        # removed. The padding matches the margins the item delegate adds.
+        text_margin = self.table_widget.style().pixelMetric(QStyle.PM_FocusFrameHMargin, None, self.table_widget) + 1
+        self.column_widths = ColumnWidthTracker(self.table_widget.fontMetrics(), [0, 1, 2], 2 * text_margin + 1)
+        self.book_model.add_index(self.column_widths)
+        self.book_model.dataChanged.connect(self.books_edited)
+
         # delegate date editing to the calendar delegate, which allows use of
         # drop down calendar and guarantees correctness.
         self.calendar_delegate = CalendarDelegate()
@@ -356,20 +2205,30 @@ class BookList(QMainWindow):
         self.search_text.setPlaceholderText("Enter filter string")
         self.search_text.setMinimumWidth(200)
         self.search_text.setMaximumWidth(500)
-        self.search_text.textChanged.connect(self.proxy_model.setFilterRegExp)
-        self.search_text.textChanged.connect(self.update_status)
+        # Only filter once typing pauses for filter_delay ms
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(self.filter_delay)
+        self.filter_timer.timeout.connect(self.filter_books)
+        self.search_text.textChanged.connect(self.search_text_changed)
+        self.proxy_model.filter_applied.connect(self.update_status)
         # Need this because of some strange behaviour. Without this, if you type
         # a unique filter string for a book with a short field plus an extra
         # uninvolved character (e.g. On Liberty with the filter libertyy), and
         # then use backspace to erase characters one by one, eventually when you
         # erase the whole string, the columns will be resized only one, to the
         # size of the first (short) entry to reappear in the table.
-        self.search_text.textChanged.connect(self.resize_table)
+        self.proxy_model.filter_applied.connect(self.resize_table)
         self.search_clear = QPushButton("Clear")
         self.search_clear.clicked.connect(self.clear_search)
+        self.fuzzy_check = QCheckBox("Fuzzy")
+        self.fuzzy_check.setToolTip("Find books with titles or authors similar to the filter string, best matches first")
+        self.fuzzy_check.setEnabled(hasattr(self.proxy_model, "set_fuzzy"))
+        self.fuzzy_check.toggled.connect(self.fuzzy_toggled)
 
         self.search_layout.addWidget(self.search_clear)
         self.search_layout.addWidget(self.search_text)
+        self.search_layout.addWidget(self.fuzzy_check)
         self.search_layout.addStretch()
 
         self.view_layout = QVBoxLayout()
@@ -382,8 +2241,65 @@ class BookList(QMainWindow):
         self.delete_shortcut = QShortcut(QKeySequence.Delete, self.view_widget, context=Qt.WidgetWithChildrenShortcut)
         self.delete_shortcut.activated.connect(self.delete_book)
 
+    def search_text_changed(self, text):
+        self.filter_timer.start()
+
+    def filter_books(self):
+        if hasattr(self, "profile_dock"):
+            self.profile_dock.filter_started()
+        self.proxy_model.request_filter(self.search_text.text())
+
+    def fuzzy_toggled(self, fuzzy):
+        self.filter_timer.stop()
+        self.proxy_model.set_fuzzy(fuzzy)
+        self.filter_books()
+
+    def show_completions(self, line_edit, completer, completions):
+        text = line_edit.text()
+        # don't suggest what has already been typed
+        completer.model().setStringList([completion for completion in completions if completion != text])
+        if completer.model().rowCount() and line_edit.hasFocus():
+            completer.complete()
+        else:
+            completer.popup().hide()
+
+    def complete_author(self, text):
+        self.show_completions(self.author_input, self.author_completer, self.book_model.complete(1, text))
+
+    def complete_title(self, text):
+        self.show_completions(self.title_input, self.title_completer, self.book_model.complete(0, text))
+
+    def suggest_titles(self):
+        text = self.title_input.text()
+        titles = self.book_model.complete(0, text)
+        if len(text) >= 3:
+            titles += [title for title in self.book_model.suggest_titles(text) if title not in titles]
+        self.show_completions(self.title_input, self.title_completer, titles)
+
     def resize_table(self, changed_text=None):
-        self.table_widget.resizeColumnsToContents()
+        """Size the columns to fit the widest text in each, within the limits set on
+        the header. Widths are taken over the whole list rather than just the
+        books that are shown, so they don't change with the filter.
+
+        """
+        header = self.table_widget.horizontalHeader()
+        for column, width in self.column_widths.widths().items():
+            width = max(width, header.sectionSizeHint(column), header.minimumSectionSize())
+            self.table_widget.setColumnWidth(column, min(width, header.maximumSectionSize()))
+
+    def books_edited(self, top_left, bottom_right, roles=None):
+        self.resize_table()
+
+    def loading_progressed(self, position, size):
+        self.update_status()
+
+    def list_reloaded(self, changes):
+        self.update_status()
+        self.resize_table()
+
+    def loading_finished(self):
+        self.update_status()
+        self.resize_table()
 
     def clear_search(self):
         """Clears the text in the search box and resets the table to the state of
@@ -402,9 +2318,33 @@ class BookList(QMainWindow):
         open_action.setStatusTip('Select list file')
         open_action.triggered.connect(self.open_new_file)
 
+        convert_action = QAction('&Convert to SQLite...', self)
+        convert_action.setStatusTip('Copy this list into an SQLite database, for very large lists')
+        convert_action.triggered.connect(self.convert_to_sqlite)
+        convert_action.setEnabled(type(self.book_model) in (BookListModel, BinaryBookListModel))
+
+        import_action = QAction('&Import...', self)
+        import_action.setShortcut('Ctrl+i')
+        import_action.setStatusTip('Add the books in a CSV file, Goodreads export or another list')
+        import_action.triggered.connect(self.import_books)
+
+        stats_action = self.stats_dock.toggleViewAction()
+        stats_action.setShortcut('Ctrl+t')
+        stats_action.setStatusTip('Show statistics about the list')
+
         menubar = self.menuBar()
+        menubar.clear()
         fileMenu = menubar.addMenu('&File')
         fileMenu.addAction(open_action)
+        fileMenu.addAction(import_action)
+        fileMenu.addAction(convert_action)
+        viewMenu = menubar.addMenu('&View')
+        viewMenu.addAction(stats_action)
+        if hasattr(self, "profile_dock"):
+            profile_action = self.profile_dock.toggleViewAction()
+            profile_action.setShortcut('Ctrl+Shift+p')
+            profile_action.setStatusTip('Show call counts and timings, and capture profiles')
+            viewMenu.addAction(profile_action)
         menubar.setVisible(True)
 
     def center(self):
@@ -422,14 +2362,15 @@ class BookList(QMainWindow):
 
         """
         reply = QMessageBox.question(self, 'Message',
-                                     "Are you sure to quit?\n{0} books will be added to your list.".format(len(self.book_model.new_books)),
+                                     "Are you sure to quit?\n{0} books will be added to your list.".format(self.book_model.new_count),
                                      QMessageBox.Yes |
                                      QMessageBox.No, QMessageBox.No)
 
 
         if reply == QMessageBox.Yes:
             log("close event accepted")
-            self.book_model.write_book_list()
+            self.book_model.close_list()
+            flush_log()
         else:
             log("close event ignored")
             event.ignore()
@@ -441,7 +2382,7 @@ class BookList(QMainWindow):
         
         log("Book already exists in list.")
         message_box = QMessageBox()
-        message_box.setText("{0} - {1}\n\nFound a book with the same author and title in the list. Do you want to add this book anyway?".format(book.author, book.title))
+        message_box.setText("{0} - {1}\n\nFound a book with the same or a very similar author and title in the list. Do you want to add this book anyway?".format(book.author, book.title))
         message_box.setWindowTitle("Book already exists")
         yes_button = message_box.addButton("Add anyway", QMessageBox.YesRole)
         no_button = message_box.addButton("Don't add", QMessageBox.NoRole)
@@ -459,45 +2400,136 @@ class BookList(QMainWindow):
 
         """
         if not self.author_input.text() or not self.title_input.text():
-            result = QMessageBox.warning(self, "Message", "Please enter both an author and title.")
+            QMessageBox.warning(self, "Message", "Please enter both an author and title.")
         else:
             new_book = Book(self.title_input.text(), self.author_input.text(), self.date_input.date().toString("yyyy/MM/dd"))
-            duplicate = self.book_model.has_book(new_book)
+            duplicate = self.book_model.has_similar_book(new_book)
             if not duplicate or (duplicate and self.user_wants_duplicate(new_book)):
                 self.book_model.add_book(new_book)
                 self.reset_add_view()
                 self.resize_table()
                 self.update_status()
 
+    def import_books(self):
+        """Ask for a file to import books from, and read it on a worker thread. Once
+        it has been read, finish_import shows what would be added.
+
+        """
+        if self.importing:
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Import books", os.path.dirname(self.list_file or ""), "Books to import (*.csv *.txt *.bkl *.sqlite);;All files (*)")
+        if not path:
+            return
+
+        log("importing books from {0}".format(path))
+        self.importing = True
+        if self.import_executor is None:
+            self.import_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.statusBar().showMessage("Importing {0}".format(os.path.basename(path)))
+        self.import_executor.submit(self._read_import, path)
+
+    def _read_import(self, path):
+        """Runs on the import worker thread.
+
+        """
+        try:
+            book_import = BookImport(path).read(functools.partial(self.import_progress.emit, path))
+        except Exception as e: # anything wrong with the file, reported to the user
+            log("couldn't import {0}: {1}".format(path, e))
+            self.import_read.emit(path, None, str(e))
+            return
+        self.import_read.emit(path, book_import, "")
+
+    def import_progressed(self, path, count):
+        self.statusBar().showMessage("Importing {0}: {1} books read".format(os.path.basename(path), count))
+
+    def finish_import(self, path, book_import, error):
+        """Check the books read from path against the list in one go, and ask the user
+        which of them to add. The books are added in a single insertion.
+
+        """
+        self.importing = False
+        if book_import is None:
+            QMessageBox.warning(self, "Import failed", "Couldn't import books from {0}:\n\n{1}".format(path, error))
+            self.update_status()
+            return
+
+        new, duplicates = self.book_model.split_duplicates(book_import.books)
+        books = self.confirm_import(path, book_import, new, duplicates)
+        if books:
+            self.book_model.add_books(books)
+            self.resize_table()
+        self.update_status()
+
+    def confirm_import(self, path, book_import, new, duplicates):
+        """Summarise what importing would add, and ask whether to add the new books,
+        all of them including the duplicates, or nothing. Returns the books to add.
+
+        """
+        lines = ["Read {0} books from {1}.".format(len(book_import.books), os.path.basename(path)), "", "{0} of them are new.".format(len(new))]
+        if duplicates:
+            lines.append("{0} are the same as or very similar to a book already in the list or earlier in the file.".format(len(duplicates)))
+        if book_import.skipped:
+            lines.append("Rows skipped because they had no title or weren't on the read shelf: {0}".format(book_import.skipped))
+        if book_import.bad_dates:
+            lines.append("Dates which weren't understood, and were kept as they were: {0}".format(book_import.bad_dates))
+
+        message_box = QMessageBox(self)
+        message_box.setWindowTitle("Import books")
+        message_box.setText("\n".join(lines))
+        if duplicates:
+            listed = duplicates[:self.import_listed_duplicates]
+            message_box.setDetailedText(u"\n".join(u"{0} - {1}".format(book.author, book.title) for book in listed) + (u"\n..." if len(listed) < len(duplicates) else u""))
+
+        new_button = message_box.addButton("Add {0} new books".format(len(new)), QMessageBox.AcceptRole)
+        new_button.setEnabled(bool(new))
+        all_button = None
+        if duplicates:
+            all_button = message_box.addButton("Add all {0} books".format(len(book_import.books)), QMessageBox.AcceptRole)
+        cancel_button = message_box.addButton(QMessageBox.Cancel)
+        message_box.setDefaultButton(new_button if new else cancel_button)
+        message_box.exec_()
+
+        clicked = message_box.clickedButton()
+        if clicked == new_button:
+            return new
+        if all_button is not None and clicked == all_button:
+            return book_import.books
+        return []
+
     def delete_book(self):
         log("deleting books")
-        # Do things this way because the rows aren't deleted simultaneously, so
-        # the indexes of the items change
-        selected = self.table_widget.selectedIndexes()
-        log("selected indices {0}".format(selected))
+        # The selection has an index for every selected cell, so collect the
+        # source rows they belong to once, and remove them all together
+        rows = set(self.proxy_model.mapToSource(index).row() for index in self.table_widget.selectedIndexes())
+        log("selected rows {0}", sorted(rows), level=logging.DEBUG)
+        if not rows:
+            return
+
         reply = QMessageBox.question(self, 'Delete selection',
-                                     "Are you sure to delete these books?\n{0} books will be removed from your list.".format(len(selected)),
+                                     "Are you sure to delete these books?\n{0} books will be removed from your list.".format(len(rows)),
                                      QMessageBox.Yes |
                                      QMessageBox.No, QMessageBox.No)
 
         if reply == QMessageBox.Yes:
-            while selected:
-                index = selected.pop()
-                log("removing book at row {0}".format(index.row()))
-                self.proxy_model.removeRows(index.row(), 1, index)
-                selected = self.table_widget.selectedIndexes()
+            self.table_widget.clearSelection()
+            self.book_model.remove_books(rows)
             self.update_status()
             self.resize_table()
 
     def update_status(self, string=None):
-        status_string = "Total: {0}".format(len(self.book_model.books))
-        new = len(self.book_model.new_books)
+        total = self.book_model.book_count()
+        status_string = "Total: {0}".format(total)
+        new = self.book_model.new_count
         if new > 0:
             status_string += ", New: {0}".format(new)
 
-        filtered = self.proxy_model.rowCount(QModelIndex())
-        if filtered != len(self.book_model.books):
+        filtered = self.proxy_model.filtered_count()
+        if filtered != total:
             status_string += ", Filtered: {0}".format(filtered)
+
+        if self.book_model.is_loading() and self.book_model.load_size:
+            status_string += ", Loading: {0}%".format(100 * self.book_model.load_position // self.book_model.load_size)
         self.statusBar().showMessage(status_string)
 
     def open_new_file(self, force=True):
@@ -511,11 +2543,59 @@ class BookList(QMainWindow):
         while True: # nasty
             self.get_list_file(new=force)
             if self.list_file:
-                self.book_model.set_list_file(self.list_file)
+                self.set_list_file(self.list_file)
                 break
 
         log("got new list file {0}".format(self.list_file))
 
+    def set_list_file(self, list_file):
+        """Open list_file in the model. Lists in SQLite databases need a different
+        model, so if the kind of list changes, the model is replaced and the
+        window rebuilt around the new one.
+
+        """
+        self.list_file = list_file
+        if ShardedList.is_sharded(list_file):
+            model_class = ShardedBookListModel
+        elif os.path.splitext(list_file)[1] == SqliteBookListModel.extension:
+            model_class = SqliteBookListModel
+        elif os.path.splitext(list_file)[1] == BinaryBookListModel.extension:
+            model_class = BinaryBookListModel
+        else:
+            model_class = BookListModel
+        if type(self.book_model) is model_class:
+            self.book_model.set_list_file(list_file)
+            return
+
+        log("switching to {0}".format(model_class.__name__))
+        self.book_model.close_list()
+        if issubclass(model_class, BookListModel):
+            self.book_model = model_class(store_class=self.store_class)
+        else:
+            self.book_model = model_class()
+        self.book_model.set_list_file(list_file)
+
+        if hasattr(self, "table_widget"):
+            self.create_window()
+
+    def convert_to_sqlite(self):
+        """Copy the current list into a new SQLite database and open it.
+
+        """
+        database_file, _ = QFileDialog.getSaveFileName(self, "Save SQLite list", os.path.splitext(self.list_file)[0] + SqliteBookListModel.extension, "SQLite lists (*{0})".format(SqliteBookListModel.extension))
+        if not database_file:
+            return
+        if os.path.splitext(database_file)[1] != SqliteBookListModel.extension:
+            database_file += SqliteBookListModel.extension
+        if os.path.exists(database_file):
+            QMessageBox.warning(self, "File exists", "{0} already exists. Choose a new file to convert the list into.".format(database_file))
+            return
+
+        self.book_model.save()
+        count = migrate_list_to_sqlite(self.list_file, database_file)
+        self.set_list_file(database_file)
+        self.statusBar().showMessage("Copied {0} books to {1}".format(count, database_file))
+
     def reset_add_view(self):
         """Reset the add view to a default state. The title and author entries are
         cleared, and the focus is set on the title. If the author_lock checkbox
@@ -534,58 +2614,122 @@ class BookList(QMainWindow):
 
         """
         log("getting list file, current is {0}".format(self.list_file))
-        if new or not self.list_file or not os.path.isfile(self.list_file):
+        if new or not self.list_file or not os.path.exists(self.list_file):
             log("Querying user")
             message_box = QMessageBox()
             message_box.setText("Open existing book list or create a new one?")
             message_box.setWindowTitle("Select list file")
             existing_button = message_box.addButton("Open Existing", QMessageBox.YesRole)
             new_button = message_box.addButton("Create new", QMessageBox.YesRole)
+            sharded_button = message_box.addButton("Open sharded list", QMessageBox.YesRole)
 
             message_box.setDefaultButton(existing_button)
             message_box.exec_()
 
             dialog = QFileDialog()
-            dialog.setNameFilter("Only .txt files (*.txt)")
+            dialog.setNameFilter("List files (*.txt *.bkl *.sqlite *{0})".format(ShardedList.extension))
 
             if message_box.clickedButton() == new_button:
                 dialog.setFileMode(QFileDialog.AnyFile)
                 dialog.setDefaultSuffix("txt")
             elif message_box.clickedButton() == existing_button:
                 dialog.setFileMode(QFileDialog.ExistingFile)
+            elif message_box.clickedButton() == sharded_button:
+                # sharded lists are directories
+                dialog.setFileMode(QFileDialog.Directory)
+                dialog.setOption(QFileDialog.ShowDirsOnly)
 
             if dialog.exec_() == 1: # open clicked, otherwise cancelled
                 selected = dialog.selectedFiles()[0]
                 _, ext = os.path.splitext(selected)
 
-                if ext != ".txt":
+                if ext not in (BookListModel.extension, BinaryBookListModel.extension, SqliteBookListModel.extension, ShardedList.extension) and not ShardedList.is_sharded(selected):
                     selected += ".txt"
-                    result = QMessageBox.warning(self, "Your filename was changed", 'You selected a filename with an extension other than ".txt", but the program only supports list files with the  ".txt" extension. You can find your file at:\n {0}'.format(selected))
+                    QMessageBox.warning(self, "Your filename was changed", 'You selected a filename with an extension other than ".txt", ".bkl", ".sqlite" or ".books", but the program only supports list files with those extensions. You can find your file at:\n {0}'.format(selected))
 
                 self.list_file = selected
 
                 log("Got file {0} from user".format(self.list_file))
-                if not os.path.isfile(self.list_file):
+                if not os.path.exists(self.list_file) and not ShardedList.is_sharded(self.list_file):
                     log("File did not exist - creating")
                     with open(self.list_file, 'w'): # just to create the file
                         pass
 
         return self.list_file
 
+def instrument_hot_paths():
+    """Wrap the functions which take the time on large lists with the counters of
+    book_profile. This is only done when profiling is switched on.
+
+    """
+    module = sys.modules[__name__]
+    for owner, name in [
+            (BookListModel, "data"),
+            (SqliteBookListModel, "data"),
+            (MultiColumnFilterProxyModel, "sort"),
+            (MultiColumnFilterProxyModel, "_refilter"),
+            (MultiColumnFilterProxyModel, "set_filter_string"),
+            (MultiColumnFilterProxyModel, "_run_filter"),
+            (MultiColumnFilterProxyModel, "_apply_filter"),
+            (BookList, "resize_table"),
+            (BookListModel, "has_book"),
+            (BookListModel, "has_similar_book"),
+            (BookListModel, "_read_chunks"), # each chunk of the list file parsed
+            (BookListModel, "_insert_books"),
+            (BookListModel, "write_book_list"),
+            (BookListModel, "save"),
+            # the subclasses which override those have to be wrapped themselves
+            (ShardedProxyModel, "set_filter_string"),
+            (ShardedBookListModel, "has_book"),
+            (ShardedBookListModel, "has_similar_book"),
+            (ShardedBookListModel, "write_book_list"),
+            (ShardedBookListModel, "save"),
+            (SqliteBookListModel, "has_book"),
+            (SqliteBookListModel, "has_similar_book"),
+            (SqliteBookListModel, "write_book_list"),
+            (SqliteBookListModel, "save"),
+            (SqliteBookListModel, "fetchMore")]:
+        book_profile.instrument(owner, name)
+
+    # log is looked up in the namespace of each module calling it
+    book_profile.instrument(module, "log", "log")
+    book_profile.instrument(book_store, "log", "log")
+
 if __name__ == '__main__':
     app = QApplication(sys.argv)
+    try:
+        locale.setlocale(locale.LC_COLLATE, "") # titles and authors sort in the user's locale
+    except locale.Error:
+        pass
+
+    parser = argparse.ArgumentParser(description="Maintain a list of books you've read.")
+    parser.add_argument("list_file", nargs="?", help="list file to open")
+    parser.add_argument("--log-level", help="one of DEBUG, INFO, WARNING, ERROR. DEBUG logs every book which is read or written")
+    parser.add_argument("--log-file", default=log_file, help="file to write the log to")
+    parser.add_argument("--store", choices=sorted(book_stores), default="list", help="how books are kept in memory. columnar uses much less memory for large lists")
+    parser.add_argument("--profile", action="store_true", help="count calls to and time the slow parts of the program, shown in View > Profile. Also switched on by setting BOOKLIST_PROFILE=1")
+    args, _ = parser.parse_known_args(app.arguments()[1:])
+
+    if args.log_level:
+        logger.setLevel(getattr(logging, args.log_level.upper(), logging.INFO))
+    start_logging(args.log_file)
+    if args.profile:
+        book_profile.enabled = True
+    if book_profile.enabled:
+        instrument_hot_paths()
+
     log("-------------------- START --------------------")
     log("args: {0}".format(sys.argv))
     list_file = None
-    if len(sys.argv) > 1:
+    if args.list_file:
         log("got list file in args")
-        list_file = sys.argv[1]
+        list_file = args.list_file
 
-    gui = BookList(list_file)
+    gui = BookList(list_file, store_class=book_stores[args.store])
     gui.show()
 
     try:
         sys.exit(app.exec_())
     except Exception as e:
-        log("caught exception in main")
-        gui.write_book_list()
+        log("caught exception in main: {0!r}", e, level=logging.ERROR)
+        gui.book_model.save()
@@ -0,0 +1,142 @@
+"""Logging for the book list. Messages are queued by the calling thread and
+written out in batches by a background thread, so logging never waits on disk.
+
+"""
+
+import os
+import atexit
+import logging
+import logging.handlers
+import threading
+import queue
+
+logging_enabled = True
+
+log_file = "booklist.log"
+log_max_bytes = 5 * 1024 * 1024 # rotate the log once it reaches this size
+log_backup_count = 3 # number of rotated logs to keep
+log_batch_size = 512 # maximum number of records written between flushes
+
+logger = logging.getLogger("booklist")
+logger.propagate = False
+logger.setLevel(getattr(logging, os.environ.get("BOOKLIST_LOG_LEVEL", "INFO").upper(), logging.INFO))
+
+class _BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """A rotating file handler which doesn't flush after every record. The log
+    writer flushes once per batch instead.
+
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super(_BatchedRotatingFileHandler, self).flush()
+
+class LogWriter(threading.Thread):
+    """Background thread which takes log records off a queue and writes them to the
+    log file. Records which are waiting in the queue when the writer wakes up
+    are written together, with a single flush at the end of the batch, so that
+    the thread logging the messages never touches the file.
+
+    """
+
+    _stop_sentinel = None
+
+    def __init__(self, filename, max_bytes=log_max_bytes, backup_count=log_backup_count, batch_size=log_batch_size):
+        super(LogWriter, self).__init__(name="booklist-log-writer")
+        self.daemon = True
+        self.queue = queue.Queue()
+        self.batch_size = batch_size
+        self.handler = _BatchedRotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.handler.setFormatter(logging.Formatter("%(asctime)s.%(msecs)03d: %(message)s", "%Y/%m/%d %H:%M:%S"))
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            flushed = [] # flush requests to acknowledge once the batch is on disk
+            for record in batch:
+                if record is LogWriter._stop_sentinel:
+                    stopping = True
+                elif isinstance(record, threading.Event):
+                    flushed.append(record)
+                else:
+                    self.handler.handle(record)
+
+            self.handler.flush_batch()
+            for event in flushed:
+                event.set()
+
+        self.handler.close()
+
+    def flush(self, timeout=5):
+        """Block until everything queued before this call has been written to disk, or
+        the timeout expires.
+
+        """
+        if not self.is_alive():
+            return
+
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def stop(self, timeout=5):
+        self.queue.put(LogWriter._stop_sentinel)
+        self.join(timeout)
+
+_log_writer = None
+
+def start_logging(filename=None):
+    """Start the background log writer. Messages logged before this is called are
+    dropped, so this should happen as early as possible.
+
+    """
+    global _log_writer
+    if _log_writer is not None:
+        return
+
+    _log_writer = LogWriter(filename or log_file)
+    _log_writer.start()
+    logger.addHandler(logging.handlers.QueueHandler(_log_writer.queue))
+    atexit.register(stop_logging)
+
+def flush_log():
+    """Make sure that everything logged so far is on disk.
+
+    """
+    if _log_writer is not None:
+        _log_writer.flush()
+
+def stop_logging():
+    """Flush any pending messages and shut down the log writer.
+
+    """
+    global _log_writer
+    if _log_writer is None:
+        return
+
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+
+    _log_writer.stop()
+    _log_writer = None
+
+def log(string, *args, **kwargs):
+    """Log a message at the given level (INFO by default). If args are given, string
+    is formatted with them only if the message is actually going to be logged,
+    so that frequent debug messages cost next to nothing when they are turned
+    off.
+
+    """
+    level = kwargs.get("level", logging.INFO)
+    if logging_enabled and logger.isEnabledFor(level):
+        logger.log(level, string.format(*args) if args else string)
@@ -0,0 +1,152 @@
+"""Optional instrumentation of the parts of the program which get slow on large
+lists. Nothing here runs unless profiling is switched on, with the
+BOOKLIST_PROFILE environment variable or the --profile option, because the hot
+paths are only wrapped with timing code by instrument. Without it they are
+the plain methods, with no overhead at all.
+
+"""
+
+import os
+import io
+import time
+import pstats
+import cProfile
+import inspect
+import functools
+import collections
+
+from book_log import log
+
+# Profiling is switched on for the session if this is set to anything but 0
+enabled = os.environ.get("BOOKLIST_PROFILE", "0") not in ("", "0")
+
+# Directory profiles are written to, the working directory by default
+profile_directory = os.environ.get("BOOKLIST_PROFILE_DIR", "")
+
+# Number of functions listed in the log when a profile is captured
+profile_summary_lines = 25
+
+class CallStats(object):
+    """Number of calls to an instrumented function, and the time spent in them.
+    Calls from the filter worker thread are counted along with the rest, so the
+    figures may be off by the odd call when both run at once.
+
+    """
+
+    __slots__ = ["calls", "seconds", "slowest"]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        if seconds > self.slowest:
+            self.slowest = seconds
+
+    def mean(self):
+        return self.seconds / self.calls if self.calls else 0.0
+
+# Statistics for each instrumented label, in the order they were instrumented
+call_stats = collections.OrderedDict()
+
+def instrument(owner, name, label=None):
+    """Replace the function called name on owner, a class or a module, with one which
+    counts its calls and their time in call_stats[label]. Generator functions
+    are timed for each item they produce, rather than for creating the
+    generator. Instrumenting the same function twice does nothing.
+
+    """
+    function = getattr(owner, name)
+    if getattr(function, "_instrumented", False):
+        return
+    if label is None:
+        label = "{0}.{1}".format(owner.__name__, name)
+    stats = call_stats.setdefault(label, CallStats())
+    clock = time.perf_counter
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            while True:
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    stats.add(clock() - start)
+                yield item
+    else:
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.add(clock() - start)
+
+    timed._instrumented = True
+    setattr(owner, name, timed)
+
+def reset_stats():
+    # the instrumented functions hold on to their CallStats, so reset them in place
+    for stats in call_stats.values():
+        stats.reset()
+
+def format_stats():
+    """call_stats as lines of text, slowest overall first.
+
+    """
+    lines = ["{0:<46} {1:>10} {2:>10} {3:>10} {4:>10}".format("", "calls", "total ms", "mean us", "max ms")]
+    for label, stats in sorted(call_stats.items(), key=lambda item: -item[1].seconds):
+        lines.append("{0:<46} {1:>10} {2:>10.1f} {3:>10.1f} {4:>10.2f}".format(label, stats.calls, stats.seconds * 1e3, stats.mean() * 1e6, stats.slowest * 1e3))
+    return "\n".join(lines)
+
+class Capture(object):
+    """cProfile capture of one interaction, such as filtering or saving. Only the
+    thread which starts the capture is profiled. When it is stopped, the
+    profile is written to a .prof file, which can be opened with pstats or
+    snakeviz, and the most expensive functions are logged.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.started = None
+        self.profile_file = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling and write out the profile. Returns the file it was written to.
+
+        """
+        self.profile.disable()
+        seconds = time.perf_counter() - self.started
+        self.profile_file = os.path.join(profile_directory, "booklist-{0}-{1}.prof".format(self.name, time.strftime("%Y%m%d-%H%M%S")))
+        self.profile.dump_stats(self.profile_file)
+
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(profile_summary_lines)
+        log("profiled {0} in {1:.3f}s, written to {2}\n{3}", self.name, seconds, self.profile_file, summary.getvalue())
+        return self.profile_file
+
+    def run(self, function, *args, **kwargs):
+        """Profile a single call of function.
+
+        """
+        self.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.stop()
@@ -0,0 +1,2931 @@
+"""Books and the ways they are stored, indexed and written to disk. Nothing here
+depends on Qt, so it can be used by scripts and the command line tool without
+the cost of starting the GUI.
+
+"""
+
+import sys
+import os
+import re
+import locale
+import io
+import codecs
+import json
+import array
+import base64
+import hashlib
+import bisect
+import calendar
+import mmap
+import struct
+import itertools
+import collections
+import datetime
+import logging
+import threading
+import sqlite3
+
+from book_log import log
+
+_json_whitespace = re.compile(r"[ \t\n\r]*")
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """Parse a JSON array from the binary file f element by element, reading it in
+    chunks of chunk_size bytes rather than all at once. Yields (element,
+    bytes_read) pairs, where bytes_read is how far into the file the parser
+    has got. An empty file is treated as an empty array.
+
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = u""
+    pos = 0
+    bytes_read = 0
+    eof = False
+    started = False # seen the opening bracket
+    expect_value = True
+    seen_element = False
+
+    while True:
+        pos = _json_whitespace.match(buf, pos).end()
+        need_more = pos == len(buf)
+
+        if not need_more:
+            char = buf[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError("list file does not contain a JSON array")
+                started = True
+                pos += 1
+                continue
+            elif char == "]" and not (expect_value and seen_element):
+                return
+            elif char == "," and not expect_value:
+                expect_value = True
+                pos += 1
+                continue
+            elif not expect_value or char in "],":
+                raise ValueError("list file has a missing or extra comma")
+
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+                # a value which runs to the end of the buffer might continue in
+                # the next chunk
+                need_more = end == len(buf) and not eof
+            except ValueError:
+                if eof:
+                    raise
+                need_more = True
+
+            if not need_more:
+                yield element, bytes_read
+                pos = end
+                expect_value = False
+                seen_element = True
+                continue
+
+        if eof:
+            if started:
+                raise ValueError("unexpected end of list file")
+            return
+
+        chunk = f.read(chunk_size)
+        bytes_read += len(chunk)
+        eof = not chunk
+        buf = buf[pos:] + text_decoder.decode(chunk, final=eof)
+        pos = 0
+
+_date_format = re.compile(r"[0-9]{4}/[0-9]{2}/[0-9]{2}\Z")
+
+def date_to_ordinal(date):
+    """Convert a yyyy/MM/dd date string to a proleptic Gregorian day ordinal. Returns
+    None if the string is not a valid date in that format. Only ASCII digits
+    are accepted, so that ordinal_to_date gives back exactly the same string,
+    rather than e.g. "0016/05/13" for "+016/05/13".
+
+    """
+    if _date_format.match(date) is None:
+        return None
+
+    try:
+        return datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10])).toordinal()
+    except ValueError:
+        return None
+
+def ordinal_to_date(ordinal):
+    """Inverse of date_to_ordinal.
+
+    """
+    date = datetime.date.fromordinal(ordinal)
+    return u"{0:04d}/{1:02d}/{2:02d}".format(date.year, date.month, date.day)
+
+class Book(object):
+
+    # Attributes of a book, in the order of the model columns
+    fields = ("title", "author", "date")
+
+    __slots__ = fields
+
+    def __init__(self, title, author, date):
+        self.title = title
+        self.author = author
+        self.date = date
+        log(u"created book {0}", self, level=logging.DEBUG)
+
+    @classmethod
+    def view(cls, title, author, date):
+        """Create a book without logging it. Used by stores which build books on the
+        fly when a row is accessed.
+
+        """
+        book = cls.__new__(cls)
+        book.title = title
+        book.author = author
+        book.date = date
+        return book
+
+    def to_dict(self):
+        return {"title": self.title, "author": self.author, "date": self.date}
+
+    def copy(self):
+        return Book.view(self.title, self.author, self.date)
+
+    def set_title(self, title):
+        self.title = title
+
+    def set_author(self, author):
+        self.author = author
+
+    def set_date(self, date):
+        self.date = date
+
+    def contains(self, string):
+        """Check if any of the elements of this book contain the given string.
+
+        """
+
+        return string in self.title or string in self.author or string in self.date
+
+    def __eq__(self, other):
+        return self.title == other.title and self.author == other.author and self.date == other.date
+
+    def __repr__(self):
+        return u"{0}: {1} - {2}".format(self.date, self.author, self.title)
+
+def row_ranges(rows):
+    """Coalesce row numbers into a list of (first row, count) pairs for each run of
+    consecutive rows, in ascending order.
+
+    """
+    ranges = []
+    for row in sorted(set(rows)):
+        if ranges and ranges[-1][0] + ranges[-1][1] == row:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([row, 1])
+
+    return [tuple(r) for r in ranges]
+
+class BookStore(object):
+    """Stores the books of a list as a python list of Book objects. This is the
+    simplest store, and the one to use for small lists. Stores are sequences of
+    books, but the model goes through field and set_field to access single
+    values, so that stores don't have to keep Book objects around.
+
+    """
+
+    def __init__(self, books=()):
+        self._books = list(books)
+
+    def __len__(self):
+        return len(self._books)
+
+    def __getitem__(self, row):
+        return self._books[row]
+
+    def __iter__(self):
+        return iter(self._books)
+
+    def field(self, row, column):
+        return getattr(self._books[row], Book.fields[column])
+
+    def set_field(self, row, column, value):
+        # replace rather than modify the book, so snapshots aren't affected
+        book = self._books[row].copy()
+        setattr(book, Book.fields[column], value)
+        self._books[row] = book
+
+    def append(self, book):
+        self._books.append(book)
+
+    def extend(self, books):
+        self._books.extend(books)
+
+    def insert(self, row, book):
+        self._books.insert(row, book)
+
+    def delete(self, row, count=1):
+        del self._books[row:row + count]
+
+    def clear(self):
+        self._books = []
+
+    def snapshot(self):
+        """A copy of the store which is not affected by later changes to it.
+
+        """
+        return BookStore(self._books)
+
+class ColumnarBookStore(object):
+    """Stores the books of a list column by column to keep the per-book overhead low
+    on large lists. Titles are kept UTF-8 encoded in a single buffer and
+    addressed by offset and length, authors are interned and referenced by
+    index, and dates are packed as day ordinals. Books are only created as
+    lightweight views when a row is asked for.
+
+    Edited titles are appended to the end of the buffer and removed titles are
+    left in place, so the buffer is compacted when more than half of it is no
+    longer referenced. Dates which aren't in yyyy/MM/dd format are interned
+    with a count of the rows using each, and their slots are reused once no
+    row does.
+
+    """
+
+    # Don't bother compacting the title buffer below this many unused bytes
+    min_compact_bytes = 1 << 20
+
+    def __init__(self, books=()):
+        self.clear()
+        self.extend(books)
+
+    def __len__(self):
+        return len(self._dates)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        return Book.view(self._title(row), self._authors[self._author_column[row]], self._date(row))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def _title(self, row):
+        start = self._title_starts[row]
+        return self._titles[start:start + self._title_lengths[row]].decode("utf-8")
+
+    def _date(self, row):
+        ordinal = self._dates[row]
+        if ordinal > 0:
+            return ordinal_to_date(ordinal)
+        return self._odd_dates[-ordinal]
+
+    def _add_title(self, title):
+        encoded = title.encode("utf-8")
+        start = len(self._titles)
+        self._titles += encoded
+        return start, len(encoded)
+
+    def _author_id(self, author):
+        author_id = self._author_ids.get(author)
+        if author_id is None:
+            author_id = len(self._authors)
+            self._author_ids[author] = author_id
+            self._authors.append(author)
+        return author_id
+
+    def _date_code(self, date):
+        """Dates which are not in yyyy/MM/dd format are kept as strings and stored as the
+        negated index of the string.
+
+        """
+        ordinal = date_to_ordinal(date)
+        if ordinal is not None:
+            return ordinal
+        index = self._odd_date_ids.get(date)
+        if index is None:
+            if self._free_odd_dates:
+                index = self._free_odd_dates.pop()
+                self._odd_dates[index] = date
+                self._odd_date_rows[index] = 0
+            else:
+                index = len(self._odd_dates)
+                self._odd_dates.append(date)
+                self._odd_date_rows.append(0)
+            self._odd_date_ids[date] = index
+        if index:
+            self._odd_date_rows[index] += 1
+        return -index
+
+    def _release_date(self, code):
+        # a row no longer uses the date with this code
+        if code < 0:
+            self._odd_date_rows[-code] -= 1
+            if not self._odd_date_rows[-code]:
+                del self._odd_date_ids[self._odd_dates[-code]]
+                self._odd_dates[-code] = None
+                self._free_odd_dates.append(-code)
+
+    def field(self, row, column):
+        if column == 0:
+            return self._title(row)
+        elif column == 1:
+            return self._authors[self._author_column[row]]
+        elif column == 2:
+            return self._date(row)
+
+    def set_field(self, row, column, value):
+        if column == 0:
+            self._title_garbage += self._title_lengths[row]
+            self._title_starts[row], self._title_lengths[row] = self._add_title(value)
+            self._maybe_compact()
+        elif column == 1:
+            self._author_column[row] = self._author_id(value)
+        elif column == 2:
+            code = self._date_code(value)
+            self._release_date(self._dates[row])
+            self._dates[row] = code
+
+    def append(self, book):
+        self.extend((book,))
+
+    def extend(self, books):
+        for book in books:
+            start, length = self._add_title(book.title)
+            self._title_starts.append(start)
+            self._title_lengths.append(length)
+            self._author_column.append(self._author_id(book.author))
+            self._dates.append(self._date_code(book.date))
+
+    def delete(self, row, count=1):
+        self._title_garbage += sum(self._title_lengths[row:row + count])
+        del self._title_starts[row:row + count]
+        del self._title_lengths[row:row + count]
+        del self._author_column[row:row + count]
+        for code in self._dates[row:row + count]:
+            self._release_date(code)
+        del self._dates[row:row + count]
+        self._maybe_compact()
+
+    def clear(self):
+        self._titles = bytearray()
+        self._title_starts = array.array('Q')
+        self._title_lengths = array.array('I')
+        self._title_garbage = 0 # bytes in the buffer no longer used by any row
+        self._authors = []
+        self._author_ids = {}
+        self._author_column = array.array('I')
+        self._dates = array.array('i')
+        self._odd_dates = [u""] # index 0 is shared with the ordinal 0, which is never valid
+        self._odd_date_ids = {u"": 0}
+        self._odd_date_rows = [0] # number of rows using each odd date, not counted for index 0
+        self._free_odd_dates = [] # indexes of odd dates no row uses
+
+    def snapshot(self):
+        """A copy of the store which is not affected by later changes to it.
+
+        """
+        store = ColumnarBookStore.__new__(ColumnarBookStore)
+        store._titles = bytes(self._titles)
+        store._title_starts = array.array('Q', self._title_starts)
+        store._title_lengths = array.array('I', self._title_lengths)
+        store._title_garbage = self._title_garbage
+        store._authors = list(self._authors)
+        store._author_ids = {} # snapshots are only read
+        store._author_column = array.array('I', self._author_column)
+        store._dates = array.array('i', self._dates)
+        store._odd_dates = list(self._odd_dates)
+        store._odd_date_ids = {}
+        store._odd_date_rows = []
+        store._free_odd_dates = []
+        return store
+
+    def _maybe_compact(self):
+        if self._title_garbage < max(self.min_compact_bytes, len(self._titles) // 2):
+            return
+
+        titles = bytearray()
+        for row in range(len(self)):
+            start = self._title_starts[row]
+            self._title_starts[row] = len(titles)
+            titles += self._titles[start:start + self._title_lengths[row]]
+
+        self._titles = titles
+        self._title_garbage = 0
+
+    def memory_usage(self):
+        """Approximate number of bytes used by the columns.
+
+        """
+        columns = [self._title_starts, self._title_lengths, self._author_column, self._dates]
+        return len(self._titles) + sum(column.itemsize * len(column) for column in columns) + sum(sys.getsizeof(author) for author in self._authors)
+
+class MappedBookStore(object):
+    """Stores the books of a list in the binary list format, read straight out of
+    the file mapped into memory. Opening a list doesn't read or parse it, and
+    rows are only decoded when they are asked for.
+
+    A binary list file is laid out as
+
+        header          magic, version, number of books, authors and odd dates
+        title offsets   books + 1 unsigned 64 bit offsets into the titles
+        author offsets  authors + 1 unsigned 64 bit offsets into the authors
+        date offsets    odd dates + 1 unsigned 64 bit offsets into the dates
+        author ids      unsigned 32 bit index of the author of each book
+        dates           signed 32 bit day ordinal of each book's date
+        titles, authors, odd dates
+                        UTF-8 strings, back to back
+
+    with all numbers little endian. Each author is only written once. Dates
+    which are not in yyyy/MM/dd format are kept as strings in the odd dates
+    table, and stored as the negated index of the string, as in
+    ColumnarBookStore.
+
+    The file is never changed in place. Books which are added or edited are
+    kept in memory, and the rows which have changed map to those instead of
+    the file, until the list is written out again with write_binary_list.
+    A mapped file can't be replaced on Windows, so the mapping is closed
+    while the list file is replaced, see replace_list_file.
+
+    """
+
+    extension = ".bkl"
+    magic = b"BKL1"
+    version = 1
+    header = struct.Struct("<4sIIIII") # magic, version, books, authors, odd dates, unused
+
+    def __init__(self, path=None):
+        self.clear()
+        if path is not None:
+            self._map(path)
+
+    def _map(self, path):
+        with io.open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0: # a new list
+                return
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.path = os.path.abspath(path)
+        self._view = view = memoryview(self._mmap)
+        magic, version, books, authors, odd_dates, _ = MappedBookStore.header.unpack_from(view)
+        if magic != MappedBookStore.magic or version > MappedBookStore.version:
+            raise ValueError("{0} is not a binary list file".format(path))
+
+        position = [MappedBookStore.header.size]
+        def column(typecode, count):
+            start = position[0]
+            position[0] += count * struct.calcsize(typecode)
+            if position[0] > len(view):
+                raise ValueError("{0} is truncated".format(path))
+            if sys.byteorder == "little":
+                return view[start:position[0]].cast(typecode)
+            values = array.array(typecode, view[start:position[0]])
+            values.byteswap()
+            return values
+
+        self._title_offsets = column('Q', books + 1)
+        self._author_offsets = column('Q', authors + 1)
+        self._date_offsets = column('Q', odd_dates + 1)
+        self._author_column = column('I', books)
+        self._dates = column('i', books)
+        self._titles = column('B', self._title_offsets[-1])
+        self._author_strings = column('B', self._author_offsets[-1])
+        self._date_strings = column('B', self._date_offsets[-1])
+        self._authors = [None] * authors # decoded as they are needed
+        self._file_rows = books
+
+    @staticmethod
+    def _decode(strings, offsets, index):
+        return str(strings[offsets[index]:offsets[index + 1]], "utf-8", "surrogatepass")
+
+    def _location(self, row):
+        """Row of the file holding row, or -1 - the position of the book in the
+        overlay.
+
+        """
+        if self._rows is not None:
+            return self._rows[row]
+        if row < self._file_rows:
+            return row
+        return self._file_rows - 1 - row
+
+    def _materialize(self):
+        """Map every row explicitly, before rows are edited or removed. Until then
+        the rows of the file are in order, followed by any added books.
+
+        """
+        if self._rows is None:
+            self._rows = array.array('q', range(self._file_rows))
+            self._rows.extend(range(-1, -1 - len(self._overlay), -1))
+
+    def __len__(self):
+        if self._rows is not None:
+            return len(self._rows)
+        return self._file_rows + len(self._overlay)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        location = self._location(row)
+        if location < 0:
+            return self._overlay[-1 - location]
+        return Book.view(self._file_field(location, 0), self._file_field(location, 1), self._file_field(location, 2))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def _file_field(self, location, column):
+        if column == 0:
+            return MappedBookStore._decode(self._titles, self._title_offsets, location)
+        elif column == 1:
+            author_id = self._author_column[location]
+            author = self._authors[author_id]
+            if author is None:
+                author = self._authors[author_id] = MappedBookStore._decode(self._author_strings, self._author_offsets, author_id)
+            return author
+        elif column == 2:
+            ordinal = self._dates[location]
+            if ordinal > 0:
+                return ordinal_to_date(ordinal)
+            return MappedBookStore._decode(self._date_strings, self._date_offsets, -ordinal)
+
+    def field(self, row, column):
+        location = self._location(row)
+        if location < 0:
+            return getattr(self._overlay[-1 - location], Book.fields[column])
+        return self._file_field(location, column)
+
+    def set_field(self, row, column, value):
+        self._materialize()
+        book = self[row].copy()
+        setattr(book, Book.fields[column], value)
+        self._overlay.append(book)
+        self._rows[row] = -len(self._overlay)
+
+    def append(self, book):
+        self.extend((book,))
+
+    def extend(self, books):
+        for book in books:
+            self._overlay.append(book)
+            if self._rows is not None:
+                self._rows.append(-len(self._overlay))
+
+    def delete(self, row, count=1):
+        self._materialize()
+        del self._rows[row:row + count]
+
+    def clear(self):
+        self.path = None
+        self._mmap = None
+        self._file_rows = 0
+        self._rows = None # row -> location, None while the rows are in file order
+        self._overlay = [] # books added or edited since the file was mapped
+
+    def unchanged(self):
+        """Check whether the store holds just the books of the file, in order.
+
+        """
+        return self._rows is None and not self._overlay
+
+    def maps(self, path):
+        return self._mmap is not None and os.path.abspath(path) == self.path
+
+    def unmap(self):
+        """Close the mapping of the file, along with those of any snapshots. Rows of
+        the file can't be read until remap is called.
+
+        """
+        columns = [self._title_offsets, self._author_offsets, self._date_offsets, self._author_column, self._dates, self._titles, self._author_strings, self._date_strings]
+        for values in columns + [self._view]:
+            if isinstance(values, memoryview):
+                values.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def remap(self, path, replaced=True):
+        """Map path again after unmap. If the file was replaced by one holding the
+        books of the store, the store goes back to holding just the file.
+
+        """
+        if replaced:
+            self.clear()
+        self._map(path)
+
+    def snapshot(self):
+        """A copy of the store which is not affected by later changes to it. The
+        copy shares the mapping of the file.
+
+        """
+        store = MappedBookStore.__new__(MappedBookStore)
+        store.__dict__.update(self.__dict__)
+        if self._rows is not None:
+            store._rows = array.array('q', self._rows)
+        store._overlay = list(self._overlay)
+        return store
+
+# Stores which can be selected with the --store command line option
+book_stores = {"list": BookStore, "columnar": ColumnarBookStore}
+
+class BookIndex(object):
+    """Base class for structures which are kept in step with the books in a
+    BookListModel. Indexes are registered with BookListModel.add_index, and
+    the model calls these methods whenever its rows change.
+
+    Indexes which are expensive to build can just remember the books in reset
+    and build themselves the first time they are used. Until then they can
+    ignore the other notifications, since the build will see the changes.
+
+    """
+
+    def reset(self, books):
+        """The model now contains books, which may be empty or still loading.
+
+        """
+        pass
+
+    def rows_inserted(self, row, books):
+        """books have been inserted, the first of them at row.
+
+        """
+        pass
+
+    def rows_removed(self, row, books):
+        """books, which started at row, have been removed.
+
+        """
+        pass
+
+    def row_changed(self, row, old_book, new_book):
+        """The book at row has been edited.
+
+        """
+        pass
+
+_punctuation = re.compile(r"[^\w\s]+", re.UNICODE)
+_whitespace = re.compile(r"\s+", re.UNICODE)
+
+def normalize_text(text):
+    """Casefold text, turn punctuation into spaces and collapse whitespace, so that
+    e.g. "I, Robot" and "i robot " compare equal, as do "Eighty-Four" and
+    "Eighty Four".
+
+    """
+    return _whitespace.sub(u" ", _punctuation.sub(u" ", text.casefold())).strip()
+
+class DuplicateIndex(BookIndex):
+    """Hash index of the (title, author) pairs in the list, used to check for
+    duplicates without scanning the list. Exact matches ignore case only, near
+    matches also ignore punctuation and whitespace, see normalize_text.
+
+    """
+
+    def __init__(self):
+        self._books = []
+        self._exact = None # casefolded (title, author) -> number of books
+        self._near = None # normalized (title, author) -> number of books
+
+    @staticmethod
+    def exact_key(book):
+        return (book.title.casefold(), book.author.casefold())
+
+    @staticmethod
+    def near_key(book):
+        return (normalize_text(book.title), normalize_text(book.author))
+
+    def _build(self):
+        self._exact = collections.Counter(DuplicateIndex.exact_key(book) for book in self._books)
+        self._near = collections.Counter(DuplicateIndex.near_key(book) for book in self._books)
+
+    def _add(self, book):
+        self._exact[DuplicateIndex.exact_key(book)] += 1
+        self._near[DuplicateIndex.near_key(book)] += 1
+
+    def _remove(self, book):
+        for counter, key in ((self._exact, DuplicateIndex.exact_key(book)), (self._near, DuplicateIndex.near_key(book))):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+
+    def reset(self, books):
+        self._books = books
+        self._exact = None
+        self._near = None
+
+    def rows_inserted(self, row, books):
+        if self._exact is not None:
+            for book in books:
+                self._add(book)
+
+    def rows_removed(self, row, books):
+        if self._exact is not None:
+            for book in books:
+                self._remove(book)
+
+    def row_changed(self, row, old_book, new_book):
+        if self._exact is not None:
+            self._remove(old_book)
+            self._add(new_book)
+
+    def contains(self, book):
+        if self._exact is None:
+            self._build()
+        return DuplicateIndex.exact_key(book) in self._exact
+
+    def contains_similar(self, book):
+        if self._near is None:
+            self._build()
+        return DuplicateIndex.near_key(book) in self._near
+
+class SortKeyIndex(BookIndex):
+    """Keys to sort the rows of the list by, one list of keys per column. Dates are
+    kept as day ordinals, and titles and authors casefolded and transformed
+    with locale.strxfrm so that they compare in the order of the collation
+    locale. Dates which aren't valid sort before all others.
+
+    The keys for a column are only computed when they are first asked for, and
+    afterwards only the keys of rows which change are recomputed. The list of
+    keys for a column is updated in place, so it can be held on to.
+
+    """
+
+    def __init__(self):
+        self._books = []
+        self._keys = {} # column -> list with the key of each row
+
+    @staticmethod
+    def sort_key(book, column):
+        if column == 2:
+            return date_to_ordinal(book.date) or 0
+        return locale.strxfrm(getattr(book, Book.fields[column]).casefold())
+
+    def keys(self, column):
+        keys = self._keys.get(column)
+        if keys is None:
+            keys = self._keys[column] = [SortKeyIndex.sort_key(book, column) for book in self._books]
+        return keys
+
+    def key(self, row, column):
+        return self.keys(column)[row]
+
+    def order(self, column, descending=False):
+        """The rows sorted on the keys of column, as a list of row numbers. The sort is
+        stable, so rows with equal keys stay in the order they have in the list.
+
+        """
+        keys = self.keys(column)
+        return sorted(range(len(keys)), key=keys.__getitem__, reverse=descending)
+
+    def reset(self, books):
+        self._books = books
+        for column, keys in self._keys.items():
+            keys[:] = [SortKeyIndex.sort_key(book, column) for book in books]
+
+    def rows_inserted(self, row, books):
+        for column, keys in self._keys.items():
+            keys[row:row] = [SortKeyIndex.sort_key(book, column) for book in books]
+
+    def rows_removed(self, row, books):
+        for keys in self._keys.values():
+            del keys[row:row + len(books)]
+
+    def row_changed(self, row, old_book, new_book):
+        for column, keys in self._keys.items():
+            keys[row] = SortKeyIndex.sort_key(new_book, column)
+
+class ReadingStats(BookIndex):
+    """Counts of the books in the list by month and by author, from which the
+    statistics dashboard is drawn. Like the other indexes, nothing is counted
+    until the figures are first asked for, when the dashboard is opened, so
+    opening a list doesn't decode every book just for them. After that the
+    counts are kept up to date as the rows change.
+
+    Months are counted by the yyyy/MM prefix of the date, and years are summed
+    from the months, of which there are only a few hundred.
+
+    """
+
+    undated = u"undated"
+
+    def __init__(self):
+        self._books = []
+        self._months = collections.Counter() # yyyy/MM -> number of books
+        self._authors = collections.Counter() # author -> number of books
+        self._total = 0
+        self._counted = True # False until the books given to reset are counted
+        self.version = 0 # incremented whenever the counts change
+
+    def _ensure_counted(self):
+        if not self._counted:
+            self._counted = True
+            self._count(self._books, 1)
+
+    @property
+    def months(self):
+        self._ensure_counted()
+        return self._months
+
+    @property
+    def authors(self):
+        self._ensure_counted()
+        return self._authors
+
+    @property
+    def total(self):
+        self._ensure_counted()
+        return self._total
+
+    @staticmethod
+    def month(date):
+        if len(date) == 10 and date[4] == u"/" and date[7] == u"/":
+            return date[:7]
+        return ReadingStats.undated
+
+    @classmethod
+    def from_counts(cls, months, authors):
+        """Statistics for already counted books, e.g. counted by a database.
+
+        """
+        stats = cls()
+        stats._months.update(months)
+        stats._authors.update(authors)
+        stats._total = sum(stats._months.values())
+        return stats
+
+    def _count(self, books, sign):
+        # one pass over the books, which may each be decoded as they are read
+        month = ReadingStats.month
+        months = collections.Counter()
+        authors = collections.Counter()
+        for book in books:
+            months[month(book.date)] += 1
+            authors[book.author] += 1
+        if sign > 0:
+            self._months.update(months)
+            self._authors.update(authors)
+        else:
+            for counter, removed in ((self._months, months), (self._authors, authors)):
+                for key, count in removed.items():
+                    counter[key] -= count
+                    if counter[key] <= 0:
+                        del counter[key]
+        self._total += sign * sum(months.values())
+        self.version += 1
+
+    def reset(self, books):
+        self._books = books
+        self._months = collections.Counter()
+        self._authors = collections.Counter()
+        self._total = 0
+        self._counted = False
+        self.version += 1
+
+    def rows_inserted(self, row, books):
+        if self._counted:
+            self._count(books, 1)
+
+    def rows_removed(self, row, books):
+        if self._counted:
+            self._count(books, -1)
+
+    def row_changed(self, row, old_book, new_book):
+        if self._counted:
+            self._count([old_book], -1)
+            self._count([new_book], 1)
+
+    def years(self):
+        """Returns a Counter of books by year.
+
+        """
+        years = collections.Counter()
+        for month, count in self.months.items():
+            years[month[:4] if month != ReadingStats.undated else month] += count
+        return years
+
+    def top_authors(self, count=20):
+        return self.authors.most_common(count)
+
+    def monthly_counts(self):
+        """Returns (month, books) for every month from the first to the last month
+        with a book in it, including months with none.
+
+        """
+        dated = sorted(month for month in self.months if month != ReadingStats.undated)
+        if not dated:
+            return []
+
+        year, month = int(dated[0][:4]), int(dated[0][5:])
+        last = (int(dated[-1][:4]), int(dated[-1][5:]))
+        counts = []
+        while (year, month) <= last:
+            key = u"{0:04d}/{1:02d}".format(year, month)
+            counts.append((key, self.months.get(key, 0)))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return counts
+
+    def reading_rate(self, months=12):
+        """Average number of books per month over the last months months with books
+        in them, counting the months in between.
+
+        """
+        counts = self.monthly_counts()[-months:]
+        if not counts:
+            return 0.0
+        return sum(count for _, count in counts) / float(len(counts))
+
+class TrigramIndex(BookIndex):
+    """Inverted index from trigrams to the distinct titles and authors in the list,
+    for fuzzy search that tolerates typos. Texts are normalized as for near
+    duplicates and each word padded as in "  word ", so a query matches a text
+    when enough of its trigrams appear in the text, wherever they are.
+
+    Entries are kept per distinct (column, normalized text), with a count of
+    the rows using them, so repeated authors are only indexed once, and a
+    search only looks at the entries sharing a trigram with the query rather
+    than at every row.
+
+    Like SearchIndex, the index also holds the result of the current query as
+    a score per row, for the proxy to filter and rank by, which is kept up to
+    date as rows change. The rows using each entry are kept as well, so that
+    only the rows of the entries sharing trigrams with the query are scored.
+
+    Nothing is built until the index is first used. Building it takes a while
+    on a large list, so it can be built on another thread instead: snapshot
+    takes the texts of the rows, from_texts builds an index from them, and
+    adopt takes that over if the rows haven't changed in the meantime.
+
+    """
+
+    # Fraction of the query's trigrams a text needs to contain to match
+    threshold = 0.5
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.version = 0 # incremented whenever the rows change
+        self.query = u""
+        self.scores = [] # score of each row for the current query, 0 for rows which don't match
+        self._books = []
+        self._built = False
+
+    @staticmethod
+    def trigrams(text):
+        """Trigrams of the words of an already normalized text.
+
+        """
+        # pad all the words at once; the trigrams spanning two words are the
+        # ones ending in two spaces, which no word's trigrams do
+        padded = u"  " + u"   ".join(text.split()) + u" "
+        grams = set([padded[i:i + 3] for i in range(len(padded) - 2)])
+        if u"   " in padded:
+            grams = set([gram for gram in grams if not gram.endswith(u"  ")])
+        return grams
+
+    @staticmethod
+    def similarity(query_grams, grams):
+        """Score of a text with trigrams grams for a query with trigrams query_grams:
+        the fraction of the query's trigrams found in the text, plus the Dice
+        coefficient of the two sets, which prefers texts that are close as a
+        whole when as much of the query is found in them. Between 0 and 2.
+
+        """
+        if not query_grams or not grams:
+            return 0.0
+        common = len(query_grams & grams)
+        return common / float(len(query_grams)) + 2.0 * common / (len(query_grams) + len(grams))
+
+    # Structures making up a built index, which adopt takes over
+    _structures = ("_entries", "_keys", "_texts", "_sizes", "_refs", "_free", "_postings", "_row_entries", "_entry_rows")
+
+    def _build(self, texts=None):
+        """Build the index from the books, or from texts, a list of the texts of each
+        column in the order of self.columns.
+
+        """
+        self._entries = {} # (column, normalized text) -> entry id
+        self._keys = [] # entry id -> (column, normalized text), None for free ids
+        self._texts = [] # entry id -> text as it appears in the list
+        self._sizes = [] # entry id -> number of trigrams
+        self._refs = [] # entry id -> number of rows using it
+        self._free = [] # ids of entries which are no longer used
+        self._postings = collections.defaultdict(set) # trigram -> entry ids
+        if texts is None:
+            texts = [(getattr(book, Book.fields[column]) for book in self._books) for column in self.columns]
+        self._row_entries = dict((column, [self._acquire(column, text) for text in column_texts]) for column, column_texts in zip(self.columns, texts))
+        self._entry_rows = None
+        self._entry_rows_map()
+        self._built = True
+        self._score_rows()
+
+    def _ensure_built(self):
+        if not self._built:
+            self._build()
+
+    def built(self):
+        return self._built
+
+    def snapshot(self):
+        """Returns the version of the rows and the texts of each column, for from_texts.
+
+        """
+        books = self._books
+        return self.version, [[books.field(row, column) for row in range(len(books))] for column in self.columns]
+
+    @classmethod
+    def from_texts(cls, columns, texts):
+        """An index built from the texts of each of columns, which can be done on
+        another thread as it doesn't touch any books.
+
+        """
+        index = cls(columns)
+        index._build(texts)
+        return index
+
+    def adopt(self, version, index):
+        """Take over the structures of an index built with from_texts from the texts of
+        the given version of the rows. Returns False if the rows have changed
+        since, in which case nothing is taken over.
+
+        """
+        if self._built:
+            return True
+        if version != self.version:
+            return False
+
+        for name in TrigramIndex._structures:
+            setattr(self, name, getattr(index, name))
+        self._built = True
+        self._score_rows()
+        return True
+
+    def _entry_rows_map(self):
+        # entry id -> set of the rows using it, rebuilt after rows are inserted
+        # or removed anywhere but at the end
+        if self._entry_rows is None:
+            entry_rows = {}
+            for entries in self._row_entries.values():
+                for row, entry in enumerate(entries):
+                    entry_rows.setdefault(entry, set()).add(row)
+            self._entry_rows = entry_rows
+        return self._entry_rows
+
+    def _acquire(self, column, text):
+        key = (column, normalize_text(text))
+        entry = self._entries.get(key)
+        if entry is None:
+            grams = TrigramIndex.trigrams(key[1])
+            if self._free:
+                entry = self._free.pop()
+                self._keys[entry], self._texts[entry], self._sizes[entry], self._refs[entry] = key, text, len(grams), 0
+            else:
+                entry = len(self._keys)
+                self._keys.append(key)
+                self._texts.append(text)
+                self._sizes.append(len(grams))
+                self._refs.append(0)
+            self._entries[key] = entry
+            postings = self._postings
+            for gram in grams:
+                postings[gram].add(entry)
+
+        self._refs[entry] += 1
+        return entry
+
+    def _release(self, entry):
+        self._refs[entry] -= 1
+        if self._refs[entry] > 0:
+            return
+
+        key = self._keys[entry]
+        for gram in TrigramIndex.trigrams(key[1]):
+            postings = self._postings[gram]
+            postings.discard(entry)
+            if not postings:
+                del self._postings[gram]
+        del self._entries[key]
+        self._keys[entry] = None
+        self._texts[entry] = None
+        self._free.append(entry)
+
+    def _entry_scores(self, query):
+        """Returns {entry id: score} for the entries matching query.
+
+        """
+        query_grams = TrigramIndex.trigrams(normalize_text(query))
+        if not query_grams:
+            return {}
+
+        # count how many of the query's trigrams each entry has, in C, and score
+        # them as similarity does
+        common = collections.Counter(itertools.chain.from_iterable(self._postings.get(gram, ()) for gram in query_grams))
+        needed = TrigramIndex.threshold * len(query_grams)
+        total = float(len(query_grams))
+        return dict((entry, count / total + 2.0 * count / (total + self._sizes[entry])) for entry, count in common.items() if count >= needed)
+
+    def search(self, query, limit=10, column=None):
+        """Returns up to limit (score, text) pairs for the texts which best match query,
+        best first. If column is given, only texts from that column are looked
+        at.
+
+        """
+        self._ensure_built()
+        scores = self._entry_scores(query)
+        results = [(score, self._texts[entry]) for entry, score in scores.items() if column is None or self._keys[entry][0] == column]
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results[:limit] if limit is not None else results
+
+    def _score_rows(self):
+        if not self.query:
+            self.scores = []
+            return
+
+        # only the rows using the entries which match are looked at
+        scores = [0.0] * len(self._row_entries[self.columns[0]])
+        entry_rows = self._entry_rows_map()
+        for entry, score in self._entry_scores(self.query).items():
+            for row in entry_rows.get(entry, ()):
+                if score > scores[row]:
+                    scores[row] = score
+        self.scores = scores
+
+    def _score_books(self, books):
+        query_grams = TrigramIndex.trigrams(normalize_text(self.query))
+        scores = []
+        for book in books:
+            best = 0.0
+            for column in self.columns:
+                grams = TrigramIndex.trigrams(normalize_text(getattr(book, Book.fields[column])))
+                if len(query_grams & grams) >= TrigramIndex.threshold * len(query_grams):
+                    best = max(best, TrigramIndex.similarity(query_grams, grams))
+            scores.append(best)
+        return scores
+
+    def set_query(self, query):
+        self.query = query
+        if query:
+            self._ensure_built()
+            self._score_rows()
+        else:
+            self.scores = []
+
+    def accepts(self, row):
+        if not self.query:
+            return True
+        self._ensure_built()
+        return self.scores[row] > 0
+
+    def accepted_rows(self):
+        """The scores of the rows for the current query, which are 0 for the rows it
+        doesn't accept, or None if there is no query and every row is accepted.
+
+        """
+        if not self.query:
+            return None
+        self._ensure_built()
+        return self.scores
+
+    def score(self, row):
+        return self.scores[row] if self.query else 0.0
+
+    def reset(self, books):
+        self.version += 1
+        self._books = books
+        self._built = False
+        self.scores = []
+
+    def _add_entry_row(self, entry, row):
+        if self._entry_rows is not None:
+            self._entry_rows.setdefault(entry, set()).add(row)
+
+    def _discard_entry_row(self, entry, row):
+        if self._entry_rows is not None:
+            rows = self._entry_rows[entry]
+            rows.discard(row)
+            if not rows:
+                del self._entry_rows[entry]
+
+    def rows_inserted(self, row, books):
+        self.version += 1
+        if self._built:
+            if row != len(self._row_entries[self.columns[0]]):
+                self._entry_rows = None # the rows after it move down
+            for column in self.columns:
+                entries = [self._acquire(column, getattr(book, Book.fields[column])) for book in books]
+                self._row_entries[column][row:row] = entries
+                for new_row, entry in enumerate(entries, row):
+                    self._add_entry_row(entry, new_row)
+            if self.query:
+                self.scores[row:row] = self._score_books(books)
+
+    def rows_removed(self, row, books):
+        self.version += 1
+        if self._built:
+            if row + len(books) != len(self._row_entries[self.columns[0]]):
+                self._entry_rows = None # the rows after them move up
+            for column in self.columns:
+                entries = self._row_entries[column]
+                for old_row in range(row, row + len(books)):
+                    self._discard_entry_row(entries[old_row], old_row)
+                    self._release(entries[old_row])
+                del entries[row:row + len(books)]
+            if self.query:
+                del self.scores[row:row + len(books)]
+
+    def row_changed(self, row, old_book, new_book):
+        self.version += 1
+        if self._built:
+            for column in self.columns:
+                entries = self._row_entries[column]
+                self._discard_entry_row(entries[row], row)
+                self._release(entries[row])
+                entries[row] = self._acquire(column, getattr(new_book, Book.fields[column]))
+                self._add_entry_row(entries[row], row)
+            if self.query:
+                self.scores[row] = self._score_books([new_book])[0]
+
+class PrefixIndex(BookIndex):
+    """The distinct values of one column, with the number of rows using each, for
+    completing what is typed into the add form. Values are grouped by their
+    number of rows, and each group is sorted casefolded, so the values starting
+    with a prefix are found with a binary search in each group, taking the
+    groups of the most used values first. There are only as many groups as
+    there are different numbers of rows, so a lookup never has to look at all
+    the values starting with a short prefix to rank them.
+
+    Nothing is built until the index is first used, and after that a change
+    only moves a value from one group to the next.
+
+    """
+
+    def __init__(self, column):
+        self.column = column
+        self._books = []
+        self._counts = None # value -> number of rows using it
+        self._groups = None # number of rows -> sorted (casefolded value, value)
+        self._levels = None # sorted keys of _groups
+
+    def _build(self):
+        field = Book.fields[self.column]
+        self._counts = collections.Counter(getattr(book, field) for book in self._books)
+        self._groups = collections.defaultdict(list)
+        for value, count in self._counts.items():
+            self._groups[count].append((value.casefold(), value))
+        for group in self._groups.values():
+            group.sort()
+        self._levels = sorted(self._groups)
+
+    def complete(self, text, limit=10):
+        """Returns up to limit values starting with text, ignoring case, those used by
+        the most books first.
+
+        """
+        prefix = text.casefold()
+        if not prefix:
+            return []
+        if self._counts is None:
+            self._build()
+
+        completions = []
+        for count in reversed(self._levels):
+            group = self._groups[count]
+            i = bisect.bisect_left(group, (prefix,))
+            while i < len(group) and group[i][0].startswith(prefix):
+                completions.append(group[i][1])
+                if len(completions) == limit:
+                    return completions
+                i += 1
+        return completions
+
+    def _move(self, value, count, new_count):
+        # move value from the group of count to that of new_count, 0 for none
+        key = (value.casefold(), value)
+        if count:
+            group = self._groups[count]
+            del group[bisect.bisect_left(group, key)]
+            if not group:
+                del self._groups[count]
+                del self._levels[bisect.bisect_left(self._levels, count)]
+        if new_count:
+            if new_count not in self._groups:
+                bisect.insort(self._levels, new_count)
+            bisect.insort(self._groups[new_count], key)
+            self._counts[value] = new_count
+        else:
+            del self._counts[value]
+
+    def _add(self, value):
+        count = self._counts.get(value, 0)
+        self._move(value, count, count + 1)
+
+    def _remove(self, value):
+        count = self._counts[value]
+        self._move(value, count, count - 1)
+
+    def reset(self, books):
+        self._books = books
+        self._counts = None
+        self._groups = None
+        self._levels = None
+
+    def rows_inserted(self, row, books):
+        if self._counts is not None:
+            field = Book.fields[self.column]
+            for book in books:
+                self._add(getattr(book, field))
+
+    def rows_removed(self, row, books):
+        if self._counts is not None:
+            field = Book.fields[self.column]
+            for book in books:
+                self._remove(getattr(book, field))
+
+    def row_changed(self, row, old_book, new_book):
+        if self._counts is not None:
+            field = Book.fields[self.column]
+            if getattr(old_book, field) != getattr(new_book, field):
+                self._remove(getattr(old_book, field))
+                self._add(getattr(new_book, field))
+
+class DateIndex(BookIndex):
+    """The day ordinal of each book's date, and the rows sorted by it, so that the
+    books read between two dates are found with two binary searches rather
+    than by looking at every row. Dates which aren't valid have ordinal 0 and
+    are never in a range.
+
+    The sorted order is only built when a range is first looked up. After
+    that, rows which change are moved to their new place with binary
+    searches, rows with the same date being kept in row order, unless more
+    than max_moved_rows are inserted or removed at once, when the order is
+    built again the next time it is needed.
+
+    """
+
+    # Inserting or removing more rows than this at once drops the sorted order
+    # rather than moving each row into place
+    max_moved_rows = 1000
+
+    def __init__(self):
+        self._books = []
+        self.ordinals = None # array with the ordinal of each row
+        self._order = None # rows sorted by date
+        self._sorted = None # ordinals of the rows in _order
+
+    @staticmethod
+    def _ordinals(books):
+        return array.array('i', (date_to_ordinal(book.date) or 0 for book in books))
+
+    def _ensure_sorted(self):
+        if self.ordinals is None:
+            self.ordinals = DateIndex._ordinals(self._books)
+        if self._order is None:
+            ordinals = self.ordinals
+            self._order = array.array('i', sorted(range(len(ordinals)), key=ordinals.__getitem__))
+            self._sorted = array.array('i', (ordinals[row] for row in self._order))
+
+    def _position(self, row, ordinal):
+        # index of row in the sorted order, among the rows with the same ordinal
+        return bisect.bisect_left(self._order, row, bisect.bisect_left(self._sorted, ordinal), bisect.bisect_right(self._sorted, ordinal))
+
+    def _renumber(self, row, count):
+        # add count to the rows from row onwards in the sorted order
+        self._order = array.array('i', (other + count if other >= row else other for other in self._order))
+
+    def _bounds(self, low, high):
+        self._ensure_sorted()
+        return bisect.bisect_left(self._sorted, max(low, 1)), bisect.bisect_right(self._sorted, high)
+
+    def count_between(self, low, high):
+        """Number of books read between the ordinals low and high, inclusive.
+
+        """
+        start, end = self._bounds(low, high)
+        return end - start
+
+    def rows_between(self, low, high):
+        """The rows of the books read between the ordinals low and high, inclusive,
+        in date order.
+
+        """
+        start, end = self._bounds(low, high)
+        return self._order[start:end]
+
+    def reset(self, books):
+        self._books = books
+        self.ordinals = self._order = self._sorted = None
+
+    def rows_inserted(self, row, books):
+        if self.ordinals is None:
+            return
+        ordinals = DateIndex._ordinals(books)
+        if self._order is not None and len(books) <= DateIndex.max_moved_rows:
+            if row < len(self.ordinals):
+                self._renumber(row, len(books))
+            for new_row, ordinal in enumerate(ordinals, row):
+                position = self._position(new_row, ordinal)
+                self._order.insert(position, new_row)
+                self._sorted.insert(position, ordinal)
+        else:
+            self._order = self._sorted = None
+        self.ordinals[row:row] = ordinals
+
+    def rows_removed(self, row, books):
+        if self.ordinals is None:
+            return
+        end = row + len(books)
+        if self._order is not None and len(books) <= DateIndex.max_moved_rows:
+            for removed in range(row, end):
+                position = self._position(removed, self.ordinals[removed])
+                del self._order[position]
+                del self._sorted[position]
+            if end < len(self.ordinals):
+                self._renumber(end, -len(books))
+        else:
+            self._order = self._sorted = None
+        del self.ordinals[row:end]
+
+    def row_changed(self, row, old_book, new_book):
+        if self.ordinals is None:
+            return
+        ordinal = date_to_ordinal(new_book.date) or 0
+        if self._order is not None and ordinal != self.ordinals[row]:
+            position = self._position(row, self.ordinals[row])
+            del self._order[position]
+            del self._sorted[position]
+            position = self._position(row, ordinal)
+            self._order.insert(position, row)
+            self._sorted.insert(position, ordinal)
+        self.ordinals[row] = ordinal
+
+class QueryTerm(object):
+    """One term of a BookQuery: the column it applies to, or None for any column,
+    and its value. Terms on the date column whose value is a date or range of
+    dates have dates set to the (low, high) day ordinals it covers.
+
+    """
+
+    def __init__(self, column, value, dates=None):
+        self.column = column
+        self.value = value
+        self.dates = dates
+
+class BookQuery(object):
+    """A filter string written in the query syntax, such as
+
+        author:orwell date:2015-01..2015-12 title:"on "
+
+    Each term is a field name, a colon and a value, or just a value, which can
+    be in any column. Values with spaces in them are quoted. A book matches
+    the query if it matches every term. Values are matched in the same way as
+    the filter box matches a whole filter string, as a substring ignoring case
+    or as a regular expression if they contain regular expression syntax.
+
+    Date values can be a year, a month or a day, as yyyy, yyyy-MM or
+    yyyy-MM-dd, with / or - between the parts, or a range of them separated
+    by "..". Either end of a range can be left out. Other date values are
+    matched as text.
+
+    Filter strings with no field names in them aren't queries, so that they
+    keep matching as a whole, spaces and all. See parse.
+
+    """
+
+    fields = {"title": 0, "author": 1, "date": 2}
+
+    term_pattern = re.compile(r'(?:(\w+):)?("[^"]*"?|\S+)', re.UNICODE)
+    date_pattern = re.compile(r"^(\d{4})(?:[-/](\d{1,2})(?:[-/](\d{1,2}))?)?$")
+
+    def __init__(self, text):
+        self.text = text
+        self.terms = []
+        for field, value in BookQuery.term_pattern.findall(text):
+            column = BookQuery.fields.get(field.casefold()) if field else None
+            if field and column is None:
+                value = u"{0}:{1}".format(field, value) # not a field, e.g. a URL
+            if value.startswith('"'):
+                # a quote left open while typing runs to the end of the string
+                value = value[1:-1] if len(value) > 1 and value.endswith('"') else value[1:]
+            if value:
+                self.terms.append(QueryTerm(column, value, BookQuery.date_range(value) if column == 2 else None))
+
+    @staticmethod
+    def parse(text):
+        """Returns a BookQuery for text, or None if it doesn't name any fields.
+
+        """
+        for field, _ in BookQuery.term_pattern.findall(text):
+            if field.casefold() in BookQuery.fields:
+                return BookQuery(text)
+        return None
+
+    @staticmethod
+    def date_bounds(text):
+        """Returns the first and last day ordinals of a year, month or day, or None if
+        text isn't one.
+
+        """
+        match = BookQuery.date_pattern.match(text.strip())
+        if match is None:
+            return None
+        year, month, day = (int(part) if part else None for part in match.groups())
+        try:
+            if day is not None:
+                first = last = datetime.date(year, month, day)
+            elif month is not None:
+                first = datetime.date(year, month, 1)
+                last = datetime.date(year, month, calendar.monthrange(year, month)[1])
+            else:
+                first, last = datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+        except ValueError:
+            return None
+        return first.toordinal(), last.toordinal()
+
+    @staticmethod
+    def date_range(value):
+        """Returns the (low, high) day ordinals of a date or range of dates, or None if
+        value isn't one.
+
+        """
+        start, dots, end = value.partition("..")
+        if not dots:
+            return BookQuery.date_bounds(value)
+        low = BookQuery.date_bounds(start) if start.strip() else (1, 1)
+        high = BookQuery.date_bounds(end) if end.strip() else (datetime.date.max.toordinal(),) * 2
+        if low is None or high is None:
+            return None
+        return low[0], high[1]
+
+class SearchIndex(BookIndex):
+    """Matches the filter string against the books in the list. Each row is kept as
+    a single casefolded string of its filter columns, joined by a separator
+    which can't be typed into the filter box, so a plain substring filter needs
+    one "in" per row. Filters containing regular expression syntax are matched
+    as regular expressions against each column in turn, stopping at the first
+    match.
+
+    The result of the last filter is kept as one flag per row. When the filter
+    string is extended, e.g. by typing another character, only the rows which
+    matched the previous string need to be checked again.
+
+    Filter strings naming fields are matched as a BookQuery, one term at a
+    time, starting with the term expected to match the fewest rows so that the
+    others only need to check what is left. Date ranges are looked up in a
+    DateIndex, which gives their exact number of rows, and the other terms'
+    numbers are estimated from a sample of the rows.
+
+    """
+
+    separator = u"\x00"
+
+    # A filter string containing any of these is treated as a regular expression
+    regexp_chars = re.compile(r"[\\^$.|?*+()\[\]{}]")
+
+    # Number of rows checked to estimate how many rows a query term matches
+    sample_rows = 256
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.version = 0 # incremented whenever the rows change
+        self._books = []
+        self._haystacks = None # casefolded and joined filter columns of each row
+        self.query = u""
+        self._needle = None # casefolded query if it is a plain string
+        self._regexp = None
+        self._query = None # BookQuery if the query names fields
+        self.dates = DateIndex()
+        self.accepted = bytearray() # 1 for rows which match the query
+
+    def _haystack(self, book):
+        return SearchIndex.separator.join(getattr(book, Book.fields[column]) for column in self.columns).casefold()
+
+    def _build(self):
+        self._haystacks = [self._haystack(book) for book in self._books]
+        self.accepted = self.match(self._haystacks)
+
+    def _ensure_built(self):
+        if self._haystacks is None:
+            self._build()
+
+    def snapshot(self):
+        """The current haystacks, which can be matched against a query with match.
+
+        """
+        self._ensure_built()
+        return self._haystacks
+
+    def compile(self, query):
+        """Returns (needle, regexp) for the query. Exactly one is not None if the query
+        is not empty.
+
+        """
+        if not query:
+            return None, None
+        if SearchIndex.regexp_chars.search(query) is None:
+            return query.casefold(), None
+        try:
+            return None, re.compile(query, re.IGNORECASE | re.UNICODE)
+        except re.error: # an incomplete pattern while typing matches nothing
+            return None, re.compile(u"(?!)")
+
+    def _compile_query(self, query):
+        # (needle, regexp, BookQuery) for the query, the BookQuery if it names fields
+        book_query = BookQuery.parse(query)
+        if book_query is not None:
+            return None, None, book_query
+        return self.compile(query) + (None,)
+
+    def match(self, haystacks, query=None, candidates=None):
+        """Returns a bytearray with a 1 for every haystack which matches query, which is
+        the current query if not given. If candidates is given, only haystacks
+        where it is 1 are checked.
+
+        """
+        if query is None:
+            needle, regexp, book_query = self._needle, self._regexp, self._query
+        else:
+            needle, regexp, book_query = self._compile_query(query)
+
+        if book_query is not None:
+            return self._match_query(haystacks, book_query, candidates)
+
+        if needle is None and regexp is None:
+            return bytearray(b"\x01" * len(haystacks))
+
+        if needle is not None:
+            if candidates is None:
+                return bytearray(needle in haystack for haystack in haystacks)
+            return bytearray(candidate and needle in haystack for candidate, haystack in zip(candidates, haystacks))
+
+        def regexp_matches(haystack):
+            for column in haystack.split(SearchIndex.separator):
+                if regexp.search(column) is not None:
+                    return True
+            return False
+
+        if candidates is None:
+            return bytearray(regexp_matches(haystack) for haystack in haystacks)
+        return bytearray(candidate and regexp_matches(haystack) for candidate, haystack in zip(candidates, haystacks))
+
+    def _term_matcher(self, term):
+        """Returns a function checking whether a haystack matches one term of a query.
+
+        """
+        if term.column is None:
+            position = None
+        elif term.column in self.columns:
+            position = self.columns.index(term.column)
+        else:
+            return lambda haystack: False
+        separator = SearchIndex.separator
+
+        if term.dates is not None:
+            low, high = term.dates
+            return lambda haystack: low <= (date_to_ordinal(haystack.split(separator)[position]) or 0) <= high
+
+        needle, regexp = self.compile(term.value)
+        if position is None:
+            if needle is not None:
+                return lambda haystack: needle in haystack
+            return lambda haystack: any(regexp.search(column) is not None for column in haystack.split(separator))
+        if needle is not None:
+            # the plain "in" rules out most rows before splitting
+            return lambda haystack: needle in haystack and needle in haystack.split(separator)[position]
+        return lambda haystack: regexp.search(haystack.split(separator)[position]) is not None
+
+    def _match_query(self, haystacks, book_query, candidates):
+        # Date ranges can only be looked up in the date index when matching the
+        # current rows, rather than a snapshot or newly inserted rows
+        indexed = haystacks is self._haystacks
+        terms = []
+        for term in book_query.terms:
+            matcher = self._term_matcher(term)
+            if term.dates is not None and indexed:
+                terms.append((self.dates.count_between(*term.dates), 0, term, matcher))
+            else:
+                step = max(1, len(haystacks) // SearchIndex.sample_rows)
+                sample = haystacks[::step]
+                estimate = len(haystacks) * sum(1 for haystack in sample if matcher(haystack)) // max(1, len(sample))
+                terms.append((estimate, 1, term, matcher))
+        terms.sort(key=lambda item: item[:2]) # fewest rows first, date ranges before text on a tie
+
+        rows = None if candidates is None else [row for row, candidate in enumerate(candidates) if candidate]
+        for _, _, term, matcher in terms:
+            if term.dates is not None and indexed:
+                low, high = term.dates
+                if rows is None:
+                    rows = self.dates.rows_between(low, high)
+                else:
+                    ordinals = self.dates.ordinals
+                    rows = [row for row in rows if low <= ordinals[row] <= high]
+            else:
+                rows = [row for row in (range(len(haystacks)) if rows is None else rows) if matcher(haystacks[row])]
+            if not rows:
+                break
+
+        if rows is None:
+            return bytearray(b"\x01" * len(haystacks))
+        accepted = bytearray(len(haystacks))
+        for row in rows:
+            accepted[row] = 1
+        return accepted
+
+    def refines(self, query):
+        """Check whether everything matching query also matches the current query, so
+        that only the rows accepted now need to be checked for it.
+
+        """
+        needle, _, _ = self._compile_query(query)
+        return self._haystacks is not None and bool(self._needle) and needle is not None and self._needle in needle
+
+    def set_query(self, query):
+        refines = self.refines(query)
+        self.query = query
+        self._needle, self._regexp, self._query = self._compile_query(query)
+
+        if not query:
+            self.accepted = bytearray()
+        elif refines:
+            self.accepted = self.match(self._haystacks, candidates=self.accepted)
+        else:
+            self._ensure_built()
+            self.accepted = self.match(self._haystacks)
+
+    def set_accepted(self, query, accepted):
+        """Set the query along with an already computed result for it.
+
+        """
+        self.query = query
+        self._needle, self._regexp, self._query = self._compile_query(query)
+        self.accepted = accepted
+
+    def accepts(self, row):
+        if not self.query:
+            return True
+        self._ensure_built()
+        return self.accepted[row] == 1
+
+    def accepted_rows(self):
+        """The accepted bytearray for the current query, or None if there is no query and
+        every row is accepted.
+
+        """
+        if not self.query:
+            return None
+        self._ensure_built()
+        return self.accepted
+
+    def reset(self, books):
+        self.version += 1
+        self._books = books
+        self._haystacks = None
+        self.accepted = bytearray()
+        self.dates.reset(books)
+
+    def rows_inserted(self, row, books):
+        self.version += 1
+        self.dates.rows_inserted(row, books)
+        if self._haystacks is not None:
+            haystacks = [self._haystack(book) for book in books]
+            self._haystacks[row:row] = haystacks
+            if self.query:
+                self.accepted[row:row] = self.match(haystacks)
+
+    def rows_removed(self, row, books):
+        self.version += 1
+        self.dates.rows_removed(row, books)
+        if self._haystacks is not None:
+            del self._haystacks[row:row + len(books)]
+            if self.query:
+                del self.accepted[row:row + len(books)]
+
+    def row_changed(self, row, old_book, new_book):
+        self.version += 1
+        self.dates.row_changed(row, old_book, new_book)
+        if self._haystacks is not None:
+            self._haystacks[row] = self._haystack(new_book)
+            if self.query:
+                self.accepted[row] = self.match(self._haystacks[row:row + 1])[0]
+
+def list_file_fingerprint(list_file):
+    """Size and modification time of a list file, used to tell whether a journal
+    belongs to the current contents of the file.
+
+    """
+    stat = os.stat(list_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def dump_json_list(f, books):
+    """Write books to the text file f as a JSON array with one book per line.
+
+    """
+    f.write(u"[")
+    separator = u"\n "
+    for book in books:
+        book_dict = book.to_dict()
+        log("wrote {0}", book_dict, level=logging.DEBUG)
+        f.write(separator)
+        f.write(json.dumps(book_dict, ensure_ascii=False))
+        separator = u",\n "
+    f.write(u"\n]\n")
+
+def write_json_list(path, books):
+    """Write books to path as a JSON array with one book per line, and make sure the
+    file is on disk before returning.
+
+    """
+    with io.open(path, 'w', encoding="utf-8") as f:
+        dump_json_list(f, books)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_binary_list(path, books):
+    """Write books to path in the binary list format described in MappedBookStore,
+    and make sure the file is on disk before returning.
+
+    """
+    title_offsets, titles = array.array('Q', [0]), bytearray()
+    author_offsets, author_strings, author_ids = array.array('Q', [0]), bytearray(), {}
+    date_offsets, date_strings, date_ids = array.array('Q', [0, 0]), bytearray(), {u"": 0}
+    author_column = array.array('I')
+    dates = array.array('i')
+
+    for book in books:
+        titles += book.title.encode("utf-8", "surrogatepass")
+        title_offsets.append(len(titles))
+
+        author_id = author_ids.get(book.author)
+        if author_id is None:
+            author_id = author_ids[book.author] = len(author_ids)
+            author_strings += book.author.encode("utf-8", "surrogatepass")
+            author_offsets.append(len(author_strings))
+        author_column.append(author_id)
+
+        ordinal = date_to_ordinal(book.date)
+        if ordinal is None or ordinal_to_date(ordinal) != book.date: # e.g. "+016/05/13"
+            ordinal = date_ids.get(book.date)
+            if ordinal is None:
+                ordinal = date_ids[book.date] = len(date_ids)
+                date_strings += book.date.encode("utf-8", "surrogatepass")
+                date_offsets.append(len(date_strings))
+            ordinal = -ordinal
+        dates.append(ordinal)
+
+    columns = [title_offsets, author_offsets, date_offsets, author_column, dates]
+    if sys.byteorder != "little":
+        for values in columns:
+            values.byteswap()
+
+    with io.open(path, 'wb') as f:
+        f.write(MappedBookStore.header.pack(MappedBookStore.magic, MappedBookStore.version, len(dates), len(author_ids), len(date_ids), 0))
+        for values in columns:
+            f.write(values.tobytes())
+        f.write(titles)
+        f.write(author_strings)
+        f.write(date_strings)
+        f.flush()
+        os.fsync(f.fileno())
+
+def is_binary_list(list_file):
+    return os.path.splitext(list_file)[1] == MappedBookStore.extension
+
+def list_writer(list_file):
+    """The function which writes books in the format of list_file, which is binary
+    for files with the MappedBookStore extension and JSON for anything else.
+
+    """
+    return write_binary_list if is_binary_list(list_file) else write_json_list
+
+def replace_list_file(temp_file, list_file, books=None):
+    """Rename temp_file over list_file. books, if given, is the store which was
+    written to temp_file. If it maps list_file, the mapping is closed while the
+    file is replaced, which Windows doesn't allow for a mapped file, and the
+    store then maps the new file instead.
+
+    """
+    if not isinstance(books, MappedBookStore) or not books.maps(list_file):
+        os.replace(temp_file, list_file)
+        return
+
+    books.unmap()
+    try:
+        os.replace(temp_file, list_file)
+    except OSError:
+        books.remap(list_file, replaced=False)
+        raise
+    books.remap(list_file)
+
+def write_list_file(list_file, books):
+    """Replace list_file with books. The list is written to a temporary file which is
+    then renamed over the original, so the file is never left half written.
+
+    """
+    temp_file = list_file + ".tmp"
+    list_writer(list_file)(temp_file, books)
+    replace_list_file(temp_file, list_file, books)
+
+def replay_journal(entries, books):
+    """Work out what the changes recorded in journal entries do to books. Changes
+    are matched to books by value, so the order of the books doesn't matter.
+    Returns (edited, added, removed), where edited maps rows of books to their
+    new contents, added is a list of books to append and removed is a list of
+    rows to remove.
+
+    """
+    rows = collections.defaultdict(list) # (title, author, date) -> ids of books with those values
+    for row, book in enumerate(books):
+        rows[(book.title, book.author, book.date)].append(row)
+
+    def key(book_dict):
+        return (book_dict["title"], book_dict["author"], book_dict["date"])
+
+    current = {} # id -> new contents of edited and added books
+    added = []
+    removed = set()
+    next_id = len(books) # ids past the end of books are added books
+
+    for entry in entries:
+        op = entry.get("op")
+        if op == "add":
+            current[next_id] = entry["book"]
+            rows[key(entry["book"])].append(next_id)
+            added.append(next_id)
+            next_id += 1
+        elif op == "remove" and rows.get(key(entry["book"])):
+            removed.add(rows[key(entry["book"])].pop())
+        elif op == "edit" and rows.get(key(entry["old"])):
+            book_id = rows[key(entry["old"])].pop()
+            current[book_id] = entry["new"]
+            rows[key(entry["new"])].append(book_id)
+
+    def to_book(book_dict):
+        return Book(book_dict["title"], book_dict["author"], book_dict["date"])
+
+    edited = dict((book_id, to_book(book_dict)) for book_id, book_dict in current.items() if book_id < len(books) and book_id not in removed)
+    added = [to_book(current[book_id]) for book_id in added if book_id not in removed]
+    return edited, added, sorted(book_id for book_id in removed if book_id < len(books))
+
+def diff_books(old, new):
+    """Journal entries which turn the books in old into the books in new, for
+    replay_journal. Books are matched by value, so the order of either list
+    doesn't matter. A book which is only in old is taken to have been edited
+    into a book only in new if two of their three fields are the same, and
+    removed otherwise.
+
+    """
+    counts = collections.Counter((book.title, book.author, book.date) for book in old)
+    added = []
+    for book in new:
+        key = (book.title, book.author, book.date)
+        if counts[key]:
+            counts[key] -= 1
+        else:
+            added.append(book)
+
+    pairs = [(0, 1), (0, 2), (1, 2)] # fields which stay the same in an edit
+    near = collections.defaultdict(list) # (pair, values) -> positions in added
+    for position, book in enumerate(added):
+        key = (book.title, book.author, book.date)
+        for pair in pairs:
+            near[(pair, key[pair[0]], key[pair[1]])].append(position)
+
+    entries = []
+    edited = set() # positions in added which are the new contents of edited books
+    for key, count in counts.items():
+        for _ in range(count):
+            old_book = Book(*key)
+            for pair in pairs:
+                candidates = near.get((pair, key[pair[0]], key[pair[1]]))
+                while candidates and candidates[-1] in edited:
+                    candidates.pop()
+                if candidates:
+                    position = candidates.pop()
+                    edited.add(position)
+                    entries.append({"op": "edit", "old": old_book.to_dict(), "new": added[position].to_dict()})
+                    break
+            else:
+                entries.append({"op": "remove", "book": old_book.to_dict()})
+
+    entries.extend({"op": "add", "book": book.to_dict()} for position, book in enumerate(added) if position not in edited)
+    return entries
+
+def merge_journal(entries, base, books):
+    """Rewrite the entries of a journal recorded against an earlier version of a
+    list file, whose BookKeys are base, so that replay_journal applies them to
+    books, what the file holds now. Where the file has changed a book the
+    journal changed too, the journal's change wins, as it does when the model
+    merges a file changed while the list is open: a book which was edited in
+    the file is edited or removed again, and one which was removed from the
+    file is added back if the journal edited it.
+
+    """
+    def key(book_dict):
+        return (book_dict["title"], book_dict["author"], book_dict["date"])
+
+    recorded = [Book(*key(entry["book"] if entry.get("op") == "remove" else entry["old"])) for entry in entries if entry.get("op") in ("remove", "edit")]
+    theirs = collections.defaultdict(list) # books the file changed -> what they became, None if removed
+    for entry in base.diff(books, recorded):
+        if entry["op"] == "edit":
+            theirs[key(entry["old"])].append(entry["new"])
+        elif entry["op"] == "remove":
+            theirs[key(entry["book"])].append(None)
+
+    merged = []
+    for entry in entries:
+        op = entry.get("op")
+        field = "book" if op == "remove" else "old"
+        changed = theirs.get(key(entry[field])) if op in ("remove", "edit") else None
+        if not changed:
+            merged.append(entry)
+            continue
+        new = changed.pop()
+        if new is not None:
+            merged.append(dict(entry, **{field: new}))
+        elif op == "edit":
+            merged.append({"op": "add", "book": entry["new"]})
+    return merged
+
+class BookKeys(object):
+    """The books of a list file as a multiset of hashes of their values, kept by
+    the journal as the base the file's changes are worked out against. A
+    sorted array of hashes takes 8 bytes a book, rather than a copy of the
+    list. The hashes are the same in every run, so that the journal can keep
+    them on disk, see encode.
+
+    A MappedBookStore which still holds just its file is kept as a snapshot
+    instead, which shares the mapping and costs nothing, and its books are
+    only hashed if they are needed, since the mapped file can't change.
+
+    """
+
+    def __init__(self, books):
+        if isinstance(books, MappedBookStore) and books.unchanged():
+            self._books = books.snapshot()
+            self._keys = None
+        else:
+            self._books = None
+            self._keys = BookKeys._hash_all(books)
+
+    @staticmethod
+    def key(book):
+        text = u"\x00".join((book.title, book.author, book.date)).encode("utf-8", "surrogatepass")
+        return int.from_bytes(hashlib.blake2b(text, digest_size=8).digest(), "little", signed=True)
+
+    @staticmethod
+    def _hash_all(books):
+        key = BookKeys.key
+        return array.array('q', sorted(key(book) for book in books))
+
+    def keys(self):
+        if self._keys is None:
+            self._keys = BookKeys._hash_all(self._books)
+            self._books = None
+        return self._keys
+
+    def encode(self):
+        """The keys as an ASCII string, for the header of the journal.
+
+        """
+        keys = array.array('q', self.keys())
+        if sys.byteorder != "little":
+            keys.byteswap()
+        return base64.b64encode(keys.tobytes()).decode("ascii")
+
+    @staticmethod
+    def decode(text):
+        """Inverse of encode.
+
+        """
+        keys = array.array('q')
+        keys.frombytes(base64.b64decode(text))
+        if sys.byteorder != "little":
+            keys.byteswap()
+        base = BookKeys(())
+        base._keys = keys
+        return base
+
+    def diff(self, books, known_books):
+        """Journal entries which turn the base into books, as diff_books would. Only
+        hashes are kept of the base, so the books which have gone from it are
+        looked for in known_books, which should be the books of the model and
+        those the journal recorded as removed or edited since the base.
+
+        """
+        keys = self.keys()
+        key = BookKeys.key
+        gone = collections.Counter() # hash -> number of books in the base but not in books
+        added = [] # rows of books which aren't in the base
+        i = 0
+        for book_key, row in sorted((key(book), row) for row, book in enumerate(books)):
+            while i < len(keys) and keys[i] < book_key:
+                gone[keys[i]] += 1
+                i += 1
+            if i < len(keys) and keys[i] == book_key:
+                i += 1
+            else:
+                added.append(row)
+        for book_key in keys[i:]:
+            gone[book_key] += 1
+
+        removed = []
+        missing = sum(gone.values())
+        for book in known_books:
+            if not missing:
+                break
+            book_key = key(book)
+            if gone.get(book_key):
+                gone[book_key] -= 1
+                missing -= 1
+                removed.append(Book(book.title, book.author, book.date))
+        if missing:
+            log("{0} books changed in the list file couldn't be found".format(missing))
+
+        return diff_books(removed, [books[row] for row in sorted(added)])
+
+class BookJournal(BookIndex):
+    """Append-only record of the changes made to a list since its file was last
+    written, kept next to the list file with a .journal extension. Each change
+    is written out as one JSON line as soon as it is made, so nothing is lost
+    if the program dies, and saving only costs as much as the changes.
+
+    The first line of the journal holds the fingerprint of the list file the
+    changes apply to, and the BookKeys of its books if the journal has them.
+    If the list file is changed by someone else while the list isn't open,
+    the journal no longer applies to it as it is, and its changes are merged
+    into the file's new contents instead, see recover. Compacting writes the list with the changes applied to a temporary
+    file, then the changes made since compaction started to a new journal
+    based on that file, and only then renames both into place. Whichever step
+    is interrupted, one of the journals matches the list file.
+
+    The journal also keeps the fingerprint of the list file it applies to, and
+    optionally the BookKeys of the books in that file, as base. Compaction
+    doesn't replace a list file which has been changed by someone else, and
+    the model uses base to work out what they changed.
+
+    """
+
+    def __init__(self):
+        self.list_file = None
+        self.recording = False
+        self.entries = 0 # number of changes in the journal
+        self.base = None # BookKeys of the books in the list file, if set with rebase
+        self.base_fingerprint = None
+        self._file = None
+        self._lock = threading.Lock() # guards the journal file against compaction
+        self._compactor = None # thread doing a background compaction
+
+    @staticmethod
+    def journal_path(list_file):
+        return list_file + ".journal"
+
+    @staticmethod
+    def _read_file(path):
+        # (header, entries) of the journal file at path, or None if it can't be read
+        try:
+            with io.open(path, 'r', encoding="utf-8") as f:
+                header = json.loads(f.readline() or "{}")
+                entries = []
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError: # the last write was cut off
+                        break
+                return header, entries
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def read(list_file):
+        """Returns the entries of the journal for the current contents of list_file,
+        and the path of the file they were read from, which is None if there is
+        no such journal.
+
+        """
+        fingerprint = list_file_fingerprint(list_file)
+        path = BookJournal.journal_path(list_file)
+        for candidate in (path, path + ".tmp"):
+            journal = BookJournal._read_file(candidate)
+            if journal is not None and journal[0].get("base") == fingerprint:
+                return journal[1], candidate
+
+        return [], None
+
+    @staticmethod
+    def read_stale(list_file, books):
+        """Returns the entries of a journal of list_file which was kept for an earlier
+        version of the file, merged with merge_journal into books, what the file
+        holds now, and the path of the journal. The path is None if there is no
+        such journal, or it doesn't have the BookKeys it needs to be merged.
+
+        """
+        fingerprint = list_file_fingerprint(list_file)
+        path = BookJournal.journal_path(list_file)
+        for candidate in (path, path + ".tmp"):
+            journal = BookJournal._read_file(candidate)
+            if journal is None or journal[0].get("base") == fingerprint or not journal[1] or "keys" not in journal[0]:
+                continue
+            header, entries = journal
+            log("merging {0} changes from {1} into {2}, which has changed since".format(len(entries), candidate, list_file))
+            return merge_journal(entries, BookKeys.decode(header["keys"]), books), candidate
+
+        return [], None
+
+    @staticmethod
+    def set_aside(list_file):
+        """Rename the journals of list_file which hold changes out of the way, so that
+        they aren't removed when a new journal is started. For journals which
+        can't be applied or merged.
+
+        """
+        path = BookJournal.journal_path(list_file)
+        for candidate in (path, path + ".tmp"):
+            journal = BookJournal._read_file(candidate)
+            if journal is None or not journal[1]:
+                continue
+            aside = candidate + ".unmerged"
+            number = 1
+            while os.path.exists(aside):
+                number += 1
+                aside = "{0}.unmerged{1}".format(candidate, number)
+            os.replace(candidate, aside)
+            log("couldn't merge the changes in {0} into {1}, which has changed since. They have been kept in {2}".format(candidate, list_file, aside), level=logging.WARNING)
+
+    @staticmethod
+    def recover(list_file, books):
+        """Returns the entries of the journal of list_file to apply to books, the
+        contents of the file, the path of the journal, and whether the journal
+        was kept for an earlier version of the file and merged, see read_stale.
+        A merged list should be written out in full, since the journal doesn't
+        apply to the file as it is. A journal which can't be merged is set
+        aside, never lost.
+
+        """
+        entries, path = BookJournal.read(list_file)
+        if path is not None:
+            return entries, path, False
+        entries, path = BookJournal.read_stale(list_file, books)
+        if path is not None:
+            return entries, path, True
+        BookJournal.set_aside(list_file)
+        return [], None, False
+
+    def open(self, list_file, existing=None, entries=0, base=None):
+        """Start recording changes to list_file. existing is the journal the current
+        state was replayed from, which is continued. Any other journal for the
+        file is out of date and is removed. base is the BookKeys of the books
+        read from list_file, if they are to be kept.
+
+        """
+        self.close()
+        self.list_file = list_file
+        path = BookJournal.journal_path(list_file)
+        if existing is None:
+            self._remove_files()
+        elif existing != path:
+            os.replace(existing, path)
+
+        self.entries = entries
+        self.base = base
+        self.base_fingerprint = list_file_fingerprint(list_file)
+        self.recording = True
+
+    def rebase(self, books):
+        """Record that books are what the list file holds now, after it was read or
+        written.
+
+        """
+        with self._lock:
+            self.base = BookKeys(books)
+            self.base_fingerprint = list_file_fingerprint(self.list_file)
+
+    def _remove_files(self):
+        path = BookJournal.journal_path(self.list_file)
+        for stale in (path, path + ".tmp"):
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    def _append(self, entries):
+        if not self.recording or not entries:
+            return
+
+        lines = u"".join(json.dumps(entry, ensure_ascii=False) + u"\n" for entry in entries).encode("utf-8")
+        with self._lock:
+            if self._file is None:
+                path = BookJournal.journal_path(self.list_file)
+                exists = os.path.exists(path)
+                self._file = io.open(path, 'ab')
+                if not exists:
+                    self._file.write(BookJournal._header(self.base_fingerprint, self.base))
+            self._file.write(lines)
+            self._file.flush()
+            self.entries += len(entries)
+
+    @staticmethod
+    def _header(fingerprint, base):
+        header = {"base": fingerprint}
+        if base is not None:
+            header["keys"] = base.encode()
+        return (json.dumps(header) + "\n").encode("utf-8")
+
+    def rows_inserted(self, row, books):
+        self._append([{"op": "add", "book": book.to_dict()} for book in books])
+
+    def rows_removed(self, row, books):
+        self._append([{"op": "remove", "book": book.to_dict()} for book in books])
+
+    def row_changed(self, row, old_book, new_book):
+        self._append([{"op": "edit", "old": old_book.to_dict(), "new": new_book.to_dict()}])
+
+    def recorded_books(self):
+        """The books the journal records as removed or edited away, which are where
+        the books of the list file are that have left the model.
+
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+        books = []
+        try:
+            with io.open(BookJournal.journal_path(self.list_file), 'r', encoding="utf-8") as f:
+                f.readline() # the header
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    book_dict = entry.get("book") if entry.get("op") == "remove" else entry.get("old")
+                    if book_dict is not None:
+                        books.append(Book(book_dict["title"], book_dict["author"], book_dict["date"]))
+        except (IOError, OSError):
+            pass
+        return books
+
+    def sync(self):
+        """Make sure the journal is on disk.
+
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def wait(self):
+        """Wait for a background compaction to finish.
+
+        """
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+    def compacting(self):
+        return self._compactor is not None and self._compactor.is_alive()
+
+    def discard(self):
+        """Forget the recorded changes after the whole list has been written out.
+
+        """
+        self.wait()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self.list_file:
+                self._remove_files()
+                self.base_fingerprint = list_file_fingerprint(self.list_file)
+            self.entries = 0
+
+    def close(self):
+        self.wait()
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        self.recording = False
+
+    def compact(self, books, background=True):
+        """Fold the journal into the list file. books is the store holding the current
+        state of the list, which is snapshotted before returning, so changes can
+        carry on being made while the list file is written.
+
+        """
+        if self.compacting() or not self.entries:
+            return
+
+        self.wait()
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            offset = self._file.tell()
+            snapshot = books.snapshot()
+
+        log("compacting journal of {0} with {1} changes".format(self.list_file, self.entries))
+        if isinstance(books, MappedBookStore):
+            # the store's mapping of the list file is closed to replace the file,
+            # which can't be done while the store may be changing
+            self._compact(snapshot, offset, books)
+        elif background:
+            self._compactor = threading.Thread(target=self._compact, args=(snapshot, offset), name="booklist-compactor")
+            self._compactor.start()
+        else:
+            self._compact(snapshot, offset)
+
+    def _compact(self, snapshot, offset, books=None):
+        # books is the store snapshot was taken from, if it hasn't changed since
+        temp_file = self.list_file + ".tmp"
+        list_writer(self.list_file)(temp_file, snapshot)
+        fingerprint = list_file_fingerprint(temp_file)
+        base = BookKeys(snapshot) if self.base is not None else None
+        header = BookJournal._header(fingerprint, base) # hashes the books outside the lock
+
+        path = BookJournal.journal_path(self.list_file)
+        with self._lock:
+            # changes made while the list was being written
+            with io.open(path, 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+
+            try:
+                replaced = list_file_fingerprint(self.list_file) != self.base_fingerprint
+            except OSError:
+                replaced = True
+            if replaced:
+                # someone else has replaced the list file, leave it for the model
+                # to merge their changes
+                os.remove(temp_file)
+                log("not compacting journal of {0}, the list file has changed".format(self.list_file))
+                return
+
+            with io.open(path + ".tmp", 'wb') as f:
+                f.write(header)
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+
+            replace_list_file(temp_file, self.list_file, books)
+            self._file.close()
+            os.replace(path + ".tmp", path)
+            self._file = io.open(path, 'ab')
+            self.entries = tail.count(b"\n")
+            self.base_fingerprint = fingerprint
+            if base is not None:
+                self.base = base
+
+        log("compacted journal of {0}, {1} changes left".format(self.list_file, self.entries))
+
+class SqliteBookDatabase(object):
+    """A book list stored in an SQLite database, for libraries too large to keep in
+    memory. Casefolded and normalized copies of the title and author are
+    stored and indexed for sorting and duplicate checks, and if SQLite has
+    FTS5 with the trigram tokenizer, substring searches go through a trigram
+    index as well.
+
+    """
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS books (id INTEGER PRIMARY KEY, title TEXT NOT NULL, author TEXT NOT NULL, date TEXT NOT NULL,"
+        " title_key TEXT NOT NULL, author_key TEXT NOT NULL, title_norm TEXT NOT NULL, author_norm TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS books_title ON books (title_key, id)",
+        "CREATE INDEX IF NOT EXISTS books_author ON books (author_key, id)",
+        "CREATE INDEX IF NOT EXISTS books_date ON books (date, id)",
+        "CREATE INDEX IF NOT EXISTS books_exact ON books (title_key, author_key)",
+        "CREATE INDEX IF NOT EXISTS books_near ON books (title_norm, author_norm)",
+    ]
+
+    # Number of books read from the index to complete a prefix, see complete
+    complete_scan_rows = 2000
+
+    fts_schema = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(title, author, date, content='books', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN"
+        " INSERT INTO books_fts (rowid, title, author, date) VALUES (new.id, new.title, new.author, new.date); END",
+        "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN"
+        " INSERT INTO books_fts (books_fts, rowid, title, author, date) VALUES ('delete', old.id, old.title, old.author, old.date); END",
+        "CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE ON books BEGIN"
+        " INSERT INTO books_fts (books_fts, rowid, title, author, date) VALUES ('delete', old.id, old.title, old.author, old.date);"
+        " INSERT INTO books_fts (rowid, title, author, date) VALUES (new.id, new.title, new.author, new.date); END",
+    ]
+
+    # Column of the books table to sort on for each model column
+    sort_columns = ["title_key", "author_key", "date"]
+
+    # Kept in PRAGMA user_version. Bumped whenever normalize_text changes, so
+    # that the normalized columns of existing databases are recomputed
+    normalize_version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.create_function("regexp", 2, SqliteBookDatabase._regexp)
+        for statement in SqliteBookDatabase.schema:
+            self.connection.execute(statement)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < SqliteBookDatabase.normalize_version:
+            self.connection.create_function("normalize_text", 1, normalize_text)
+            self.connection.execute("UPDATE books SET title_norm = normalize_text(title), author_norm = normalize_text(author)"
+                                    " WHERE title_norm != normalize_text(title) OR author_norm != normalize_text(author)")
+            self.connection.execute("PRAGMA user_version = {0}".format(SqliteBookDatabase.normalize_version))
+
+        try:
+            for statement in SqliteBookDatabase.fts_schema:
+                self.connection.execute(statement)
+            self.fts = True
+        except sqlite3.OperationalError: # no FTS5, or no trigram tokenizer
+            self.fts = False
+        self.connection.commit()
+
+    @staticmethod
+    def _regexp(pattern, value):
+        try:
+            return re.search(pattern, value, re.IGNORECASE) is not None
+        except re.error:
+            return False
+
+    @staticmethod
+    def _row(book):
+        return (book.title, book.author, book.date, book.title.casefold(), book.author.casefold(), normalize_text(book.title), normalize_text(book.author))
+
+    def filter_clause(self, text):
+        """Returns an SQL condition and its parameters selecting the books which match
+        the filter string text, in the same way as SearchIndex.
+
+        """
+        if not text:
+            return "1", ()
+
+        book_query = BookQuery.parse(text)
+        if book_query is not None:
+            return self._query_clause(book_query)
+
+        if SearchIndex.regexp_chars.search(text) is not None:
+            return "(regexp(?, title) OR regexp(?, author) OR regexp(?, date))", (text, text, text)
+
+        folded = text.casefold()
+        if self.fts and len(folded) >= 3:
+            return "id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)", (u'"{0}"'.format(folded.replace('"', '""')),)
+
+        pattern = u"%{0}%".format(folded.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+        return "(title_key LIKE ? ESCAPE '\\' OR author_key LIKE ? ESCAPE '\\' OR date LIKE ? ESCAPE '\\')", (pattern, pattern, pattern)
+
+    def _query_clause(self, book_query):
+        # one condition per term, date ranges using the books_date index
+        conditions = []
+        params = []
+        for term in book_query.terms:
+            if term.column is None:
+                condition, term_params = self.filter_clause(term.value)
+            elif term.dates is not None:
+                low, high = term.dates
+                condition, term_params = "date BETWEEN ? AND ?", (ordinal_to_date(low), ordinal_to_date(high))
+            elif SearchIndex.regexp_chars.search(term.value) is not None:
+                condition, term_params = "regexp(?, {0})".format(Book.fields[term.column]), (term.value,)
+            else:
+                column = ["title_key", "author_key", "date"][term.column]
+                pattern = u"%{0}%".format(term.value.casefold().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+                condition, term_params = "{0} LIKE ? ESCAPE '\\'".format(column), (pattern,)
+            conditions.append(condition)
+            params.extend(term_params)
+        if not conditions:
+            return "1", ()
+        return "({0})".format(" AND ".join(conditions)), tuple(params)
+
+    def count(self, where="1", params=()):
+        return self.connection.execute("SELECT COUNT(*) FROM books WHERE " + where, params).fetchone()[0]
+
+    def fetch(self, column, descending, where="1", params=(), after=None, limit=500):
+        """Fetch up to limit books matching where in the order given by column, after
+        the (sort key, id) pair after. Returns (id, title, author, date, sort
+        key) rows.
+
+        """
+        sort_column = SqliteBookDatabase.sort_columns[column]
+        direction, compare = ("DESC", "<") if descending else ("ASC", ">")
+        query = "SELECT id, title, author, date, {0} FROM books WHERE ({1})".format(sort_column, where)
+        if after is not None:
+            query += " AND ({0} {1} ? OR ({0} = ? AND id {1} ?))".format(sort_column, compare)
+            params = tuple(params) + (after[0], after[0], after[1])
+        query += " ORDER BY {0} {1}, id {1} LIMIT ?".format(sort_column, direction)
+        return self.connection.execute(query, tuple(params) + (limit,)).fetchall()
+
+    def matches(self, book_id, where, params):
+        return self.connection.execute("SELECT 1 FROM books WHERE id = ? AND ({0})".format(where), (book_id,) + tuple(params)).fetchone() is not None
+
+    def insert(self, books):
+        """Insert books, returning their ids.
+
+        """
+        cursor = self.connection.cursor()
+        ids = []
+        for book in books:
+            cursor.execute("INSERT INTO books (title, author, date, title_key, author_key, title_norm, author_norm) VALUES (?, ?, ?, ?, ?, ?, ?)", SqliteBookDatabase._row(book))
+            ids.append(cursor.lastrowid)
+        self.connection.commit()
+        return ids
+
+    def insert_many(self, books):
+        """Insert an iterable of books in one transaction, without returning ids. The
+        trigram index is rebuilt once at the end rather than updated for every
+        book.
+
+        """
+        if self.fts:
+            self.connection.execute("DROP TRIGGER books_fts_insert")
+        self.connection.executemany("INSERT INTO books (title, author, date, title_key, author_key, title_norm, author_norm) VALUES (?, ?, ?, ?, ?, ?, ?)", (SqliteBookDatabase._row(book) for book in books))
+        if self.fts:
+            self.connection.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+            self.connection.execute(SqliteBookDatabase.fts_schema[1])
+        self.connection.commit()
+
+    def update(self, book_id, book):
+        self.connection.execute("UPDATE books SET title = ?, author = ?, date = ?, title_key = ?, author_key = ?, title_norm = ?, author_norm = ? WHERE id = ?", SqliteBookDatabase._row(book) + (book_id,))
+        self.connection.commit()
+
+    def delete(self, ids):
+        self.connection.executemany("DELETE FROM books WHERE id = ?", ((book_id,) for book_id in ids))
+        self.connection.commit()
+
+    def has_book(self, book):
+        return self.connection.execute("SELECT 1 FROM books WHERE title_key = ? AND author_key = ? LIMIT 1", (book.title.casefold(), book.author.casefold())).fetchone() is not None
+
+    def has_similar_book(self, book):
+        return self.connection.execute("SELECT 1 FROM books WHERE title_norm = ? AND author_norm = ? LIMIT 1", (normalize_text(book.title), normalize_text(book.author))).fetchone() is not None
+
+    def statistics(self):
+        """Returns a ReadingStats for the books in the database, counted by indexed
+        queries.
+
+        """
+        months = self.connection.execute("SELECT CASE WHEN date GLOB '[0-9][0-9][0-9][0-9]/[0-9][0-9]/[0-9][0-9]' THEN substr(date, 1, 7) ELSE ? END AS month, COUNT(*) FROM books GROUP BY month", (ReadingStats.undated,))
+        authors = self.connection.execute("SELECT author, COUNT(*) FROM books GROUP BY author")
+        return ReadingStats.from_counts(dict(months.fetchall()), dict(authors.fetchall()))
+
+    def similar_titles(self, text, limit=10):
+        """Titles which are similar to text, best first, found through the trigram
+        index and ranked as TrigramIndex does. Without the trigram index only
+        titles containing text are found.
+
+        """
+        folded = text.casefold()
+        if not self.fts or len(folded) < 3:
+            pattern = u"%{0}%".format(folded.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+            return [row[0] for row in self.connection.execute("SELECT DISTINCT title FROM books WHERE title_key LIKE ? ESCAPE '\\' LIMIT ?", (pattern, limit))]
+
+        grams = set(folded[i:i + 3] for i in range(len(folded) - 2))
+        match = u"title : ({0})".format(u" OR ".join(u'"{0}"'.format(gram.replace('"', '""')) for gram in grams))
+        candidates = self.connection.execute("SELECT DISTINCT title FROM books WHERE id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ? ORDER BY rank LIMIT ?)", (match, 20 * limit))
+
+        query_grams = TrigramIndex.trigrams(normalize_text(text))
+        scored = []
+        for (title,) in candidates:
+            grams = TrigramIndex.trigrams(normalize_text(title))
+            if len(query_grams & grams) >= TrigramIndex.threshold * len(query_grams):
+                scored.append((-TrigramIndex.similarity(query_grams, grams), title))
+        return [title for _, title in sorted(scored)[:limit]]
+
+    def complete(self, column, text, limit=10):
+        """Titles (column 0) or authors (column 1) starting with text, ignoring case,
+        the most used first, as PrefixIndex finds them. They are read from the
+        title or author index, which is only scanned for complete_scan_rows
+        books, so a short prefix is ranked by the first of its books.
+
+        """
+        prefix = text.casefold()
+        if not prefix:
+            return []
+        field = Book.fields[column]
+        query = ("SELECT {0}, COUNT(*) AS uses FROM (SELECT {0}, {0}_key FROM books WHERE {0}_key >= ? AND {0}_key < ? ORDER BY {0}_key LIMIT ?)"
+                 " GROUP BY {0} ORDER BY uses DESC, {0}_key LIMIT ?").format(field)
+        return [row[0] for row in self.connection.execute(query, (prefix, prefix + u"\U0010ffff", SqliteBookDatabase.complete_scan_rows, limit))]
+
+    def duplicate_ids(self):
+        """Ids of the books which have the same normalized title and author as an
+        earlier book.
+
+        """
+        return [row[0] for row in self.connection.execute("SELECT id FROM books WHERE id NOT IN (SELECT MIN(id) FROM books GROUP BY title_norm, author_norm) ORDER BY id")]
+
+    def iter_books(self):
+        for title, author, date in self.connection.execute("SELECT title, author, date FROM books ORDER BY id"):
+            yield Book.view(title, author, date)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def iter_list_file(list_file):
+    """Yields the books in a JSON or binary list file, without the changes in its
+    journal.
+
+    """
+    if is_binary_list(list_file):
+        for book in MappedBookStore(list_file):
+            yield book
+        return
+
+    with io.open(list_file, 'rb') as f:
+        for book_json, _ in iter_json_array(f):
+            yield Book.view(book_json["title"], book_json["author"], book_json["date"])
+
+def apply_journal(books, entries):
+    """Apply journal entries to the store books in place.
+
+    """
+    edited, added, removed = replay_journal(entries, books)
+    for row, book in edited.items():
+        for column, field in enumerate(Book.fields):
+            books.set_field(row, column, getattr(book, field))
+    books.extend(added)
+    for row, count in reversed(row_ranges(removed)):
+        books.delete(row, count)
+
+def load_list_file(list_file, store_class=BookStore, stale_journal=False):
+    """Read all the books in a JSON or binary list file, with the changes in its
+    journal applied, into a new store_class. With stale_journal, a journal
+    kept for an earlier version of the file is merged in as well, see
+    BookJournal.read_stale.
+
+    """
+    books = store_class()
+    books.extend(iter_list_file(list_file))
+
+    entries, journal_file = BookJournal.read(list_file)
+    if journal_file is None and stale_journal:
+        entries, _ = BookJournal.read_stale(list_file, books)
+    if entries:
+        apply_journal(books, entries)
+
+    return books
+
+def migrate_list_to_sqlite(list_file, database_file):
+    """Copy the books in a list file, including any changes in its journal, into an
+    SQLite database. Returns the number of books copied.
+
+    """
+    books = load_list_file(list_file)
+    database = SqliteBookDatabase(database_file)
+    database.insert_many(books)
+    database.close()
+    log("migrated {0} books from {1} to {2}".format(len(books), list_file, database_file))
+    return len(books)
+
+def convert_list_file(list_file, output):
+    """Copy the books in a list file, including any changes in its journal, into a
+    new list file in the format given by the extension of output, JSON or
+    binary. Returns the number of books copied.
+
+    """
+    books = load_list_file(list_file)
+    write_list_file(output, books)
+    log("converted {0} books from {1} to {2}".format(len(books), list_file, output))
+    return len(books)
+
+class ShardedList(object):
+    """A list kept as a directory with one list file per year, so that opening it
+    only has to read the years that are looked at, and saving only has to
+    rewrite the years that changed. Books are put in shards by the year of
+    their date, and books without a valid date go in their own shard.
+
+    The directory holds a manifest naming the shards and how many books each
+    has, which lets the size of the list be shown without reading it. The
+    shards themselves are ordinary list files.
+
+    """
+
+    extension = ".books"
+    manifest_name = "manifest.json"
+    undated = "undated"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.counts = {} # shard key -> number of books
+        self.read()
+
+    @staticmethod
+    def shard_key(book):
+        if date_to_ordinal(book.date) is None:
+            return ShardedList.undated
+        return book.date[:4]
+
+    @staticmethod
+    def is_sharded(path):
+        return os.path.splitext(path.rstrip(os.sep))[1] == ShardedList.extension or os.path.isfile(os.path.join(path, ShardedList.manifest_name))
+
+    def manifest_path(self):
+        return os.path.join(self.directory, ShardedList.manifest_name)
+
+    def shard_path(self, key):
+        return os.path.join(self.directory, key + ".txt")
+
+    def read(self):
+        """Read the manifest, creating the directory if it doesn't exist yet.
+
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        try:
+            with io.open(self.manifest_path(), 'r', encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.counts = dict((shard["key"], shard["count"]) for shard in manifest["shards"])
+        except (IOError, OSError):
+            self.counts = {}
+
+    def write_manifest(self):
+        shards = [{"key": key, "file": os.path.basename(self.shard_path(key)), "count": self.counts[key]} for key in self.keys()]
+        temp_file = self.manifest_path() + ".tmp"
+        with io.open(temp_file, 'w', encoding="utf-8") as f:
+            f.write(json.dumps({"version": 1, "shards": shards}, indent=1))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.manifest_path())
+
+    def keys(self):
+        """Shard keys, newest year first and undated books last.
+
+        """
+        years = sorted((key for key in self.counts if key != ShardedList.undated), reverse=True)
+        return years + [key for key in self.counts if key == ShardedList.undated]
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def load(self, key, store_class=BookStore):
+        return load_list_file(self.shard_path(key), store_class)
+
+    def write(self, shards):
+        """Write the books of the shards in the dict shards, which maps shard keys to
+        lists of books, and update the manifest. Shards left with no books are
+        removed.
+
+        """
+        for key, books in shards.items():
+            if books:
+                write_list_file(self.shard_path(key), books)
+                self.counts[key] = len(books)
+            elif key in self.counts:
+                if os.path.exists(self.shard_path(key)):
+                    os.remove(self.shard_path(key))
+                del self.counts[key]
+        self.write_manifest()
+
+    def iter_books(self):
+        """All the books in the list, oldest year first.
+
+        """
+        for key in reversed(self.keys()):
+            for book in self.load(key):
+                yield book
+
+class DirtyShards(BookIndex):
+    """Records which shards of a ShardedList have changed since they were last
+    written. changed is called whenever a shard becomes dirty. Nothing is
+    recorded while recording is False, e.g. while a shard is being loaded.
+
+    """
+
+    def __init__(self, changed=None):
+        self.dirty = set()
+        self.recording = True
+        self.changed = changed
+
+    def _mark(self, books):
+        if not self.recording:
+            return
+        self.dirty.update(ShardedList.shard_key(book) for book in books)
+        if self.changed is not None:
+            self.changed()
+
+    def reset(self, books):
+        self.dirty = set()
+
+    def rows_inserted(self, row, books):
+        self._mark(books)
+
+    def rows_removed(self, row, books):
+        self._mark(books)
+
+    def row_changed(self, row, old_book, new_book):
+        self._mark([old_book, new_book])
+
+def split_list_file(list_file, directory):
+    """Copy the books in a list file, including any changes in its journal, into a
+    new sharded list in directory. Returns the number of books copied.
+
+    """
+    shards = collections.defaultdict(list)
+    books = load_list_file(list_file)
+    for book in books:
+        shards[ShardedList.shard_key(book)].append(book)
+
+    ShardedList(directory).write(shards)
+    log("split {0} books from {1} into {2} shards in {3}".format(len(books), list_file, len(shards), directory))
+    return len(books)
+
+def merge_sharded_list(directory, list_file):
+    """Copy the books in the sharded list in directory into a single list file, in
+    the format given by its extension. Returns the number of books copied.
+
+    """
+    books = list(ShardedList(directory).iter_books())
+    write_list_file(list_file, books)
+    log("merged {0} books from {1} into {2}".format(len(books), directory, list_file))
+    return len(books)
@@ -0,0 +1,67 @@
+"""Tests of the command line tool.
+
+    python -m unittest discover tests
+
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import book_cli
+from book_store import Book, BookJournal, load_list_file, write_json_list
+
+class JournalCliTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.list_file = os.path.join(self.directory, "books.txt")
+        write_json_list(self.list_file, [Book(u"Emma", u"Jane Austen", u"2015/01/01")])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_cli(self, *args):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(book_cli.main([self.list_file] + list(args)), 0)
+        return output.getvalue()
+
+    def add(self, title):
+        self.run_cli("add", "--title", title, "--author", "Someone", "--date", "2016/01/01")
+
+    def titles(self):
+        return sorted(line.split(u"\t")[0] for line in self.run_cli("list").splitlines())
+
+    def test_add_after_touch(self):
+        self.add(u"First")
+        os.utime(self.list_file, ns=(0, 0))
+        self.add(u"Second")
+        self.assertEqual(self.titles(), [u"Emma", u"First", u"Second"])
+        # merged into the list file rather than onto the old journal
+        self.assertEqual(sorted(book.title for book in load_list_file(self.list_file)), [u"Emma", u"First", u"Second"])
+        self.assertEqual(BookJournal.read(self.list_file), ([], None))
+
+    def test_list_after_touch(self):
+        self.add(u"First")
+        os.utime(self.list_file, ns=(0, 0))
+        self.assertEqual(self.titles(), [u"Emma", u"First"])
+        self.assertTrue(os.path.exists(BookJournal.journal_path(self.list_file)))
+
+    def test_import_after_change(self):
+        self.add(u"First")
+        write_json_list(self.list_file, [Book(u"Emma", u"Jane Austen", u"2015/01/01"), Book(u"Theirs", u"Them", u"2016/02/01")])
+        other = os.path.join(self.directory, "other.txt")
+        write_json_list(other, [Book(u"Imported", u"Someone", u"2016/03/01"), Book(u"Emma", u"Jane Austen", u"2015/01/01")])
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.run_cli("import", other)
+        self.assertEqual(self.titles(), [u"Emma", u"First", u"Imported", u"Theirs"])
+
+if __name__ == '__main__':
+    unittest.main()
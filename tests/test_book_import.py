@@ -0,0 +1,81 @@
+"""Tests of reading books to import.
+
+    python -m unittest discover tests
+
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from book_import import BookImport, normalize_date, split_duplicates
+from book_store import Book
+
+class NormalizeDateTest(unittest.TestCase):
+
+    def test_formats(self):
+        for text in [u"2016/05/13", u"2016-05-13", u"2016.05.13", u"20160513", u"13 May 2016", u"13 may 2016", u"May 13, 2016", u"MAY 13, 2016", u"May 13 2016", u" 2016-5-13 "]:
+            self.assertEqual(normalize_date(text), u"2016/05/13", text)
+
+    def test_time(self):
+        self.assertEqual(normalize_date(u"2016-05-13T10:20:30Z"), u"2016/05/13")
+        self.assertEqual(normalize_date(u"2016/05/13 10:20"), u"2016/05/13")
+
+    def test_not_understood(self):
+        # day or month first can't be told apart
+        for text in [u"05/06/2016", u"someday", u"2016/02/30", u""]:
+            self.assertIsNone(normalize_date(text), text)
+
+class ReadCsvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, text, encoding="utf-8"):
+        path = os.path.join(self.directory, "books.csv")
+        with io.open(path, 'w', encoding=encoding, newline="") as f:
+            f.write(text)
+        return BookImport(path).read()
+
+    def test_goodreads_export(self):
+        books = self.read(u"Book Id,Title,Author,Date Read,Date Added,Exclusive Shelf\r\n"
+                          u"1,Emma,Jane Austen,2016/05/13,2016/01/01,read\r\n"
+                          u"2,Ethics,Baruch Spinoza,,2016/01/02,to-read\r\n"
+                          u"3,\"I, Robot\",Isaac Asimov,,2016/01/03,Read\r\n"
+                          u"4,The Prince,Niccolo Machiavelli,2016/02/01,2016/01/04,currently-reading\r\n", encoding="utf-8-sig")
+        self.assertEqual(books.books, [Book(u"Emma", u"Jane Austen", u"2016/05/13"), Book(u"I, Robot", u"Isaac Asimov", u"2016/01/03")])
+        self.assertEqual(books.skipped, 2)
+        self.assertEqual(books.bad_dates, 0)
+
+    def test_column_names(self):
+        books = self.read(u"Finished , Creator,BOOK TITLE\n13 May 2016,Jane Austen,Emma\n,Nobody,\n")
+        self.assertEqual(books.books, [Book(u"Emma", u"Jane Austen", u"2016/05/13")])
+        self.assertEqual(books.skipped, 1)
+
+    def test_bad_dates(self):
+        books = self.read(u"title,author,date\nEmma,Jane Austen,05/06/2016\nEthics,Baruch Spinoza,\nThe Prince,Niccolo Machiavelli,2016-02-01\n")
+        self.assertEqual([book.date for book in books.books], [u"05/06/2016", u"", u"2016/02/01"])
+        self.assertEqual(books.bad_dates, 1)
+
+    def test_no_title_column(self):
+        with self.assertRaises(ValueError):
+            self.read(u"author,date\nJane Austen,2016/05/13\n")
+
+class SplitDuplicatesTest(unittest.TestCase):
+
+    def test_split(self):
+        books = [Book(u"Emma", u"Jane Austen", u"2016/05/13"), Book(u"Ethics", u"Baruch Spinoza", u"2016/01/02"), Book(u"emma ", u"Jane  Austen", u""), Book(u"I, Robot", u"Isaac Asimov", u"")]
+        new, duplicates = split_duplicates(books, lambda book: book.title == u"Ethics")
+        self.assertEqual(new, [books[0], books[3]])
+        self.assertEqual(duplicates, [books[1], books[2]])
+
+if __name__ == '__main__':
+    unittest.main()
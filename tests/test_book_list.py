@@ -0,0 +1,309 @@
+"""Tests of the list models, run on the offscreen Qt platform.
+
+    python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt, QModelIndex, QPersistentModelIndex
+from PyQt5.QtGui import QFontMetrics
+
+from book_store import Book, BookJournal, SqliteBookDatabase, ShardedList, load_list_file, write_json_list, write_list_file
+from book_list import BinaryBookListModel, BookListModel, ColumnWidthTracker, ShardedBookListModel, SqliteBookListModel
+
+app = QApplication.instance() or QApplication(sys.argv[:1])
+
+class SqliteModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        list_file = os.path.join(self.directory, "books.sqlite")
+        database = SqliteBookDatabase(list_file)
+        database.insert([Book(u"Title {0:03d}".format(i), u"Author {0}".format(i % 7), u"2015/01/{0:02d}".format(i % 28 + 1)) for i in range(100)])
+        database.close()
+
+        self.model = SqliteBookListModel(list_file)
+        self.model.fetch_size = 10
+        self.model.read_book_list()
+        self.model.sort(0, Qt.AscendingOrder)
+        self.model.fetchMore(QModelIndex())
+
+    def tearDown(self):
+        self.model.close_list()
+        shutil.rmtree(self.directory)
+
+    def fetch_all(self):
+        while self.model.canFetchMore(QModelIndex()):
+            self.model.fetchMore(QModelIndex())
+
+    def titles(self):
+        return [self.model.books[row].title for row in range(self.model.rowCount(QModelIndex()))]
+
+    def test_edit_last_fetched_row(self):
+        self.model.setData(self.model.index(9, 0), u"ZZZ", Qt.EditRole)
+        self.fetch_all()
+        titles = self.titles()
+        self.assertEqual(len(titles), 100)
+        self.assertEqual(self.model.match_count, 100)
+        self.assertEqual(titles[-1], u"ZZZ")
+        self.assertEqual(titles, sorted(titles, key=lambda title: title.casefold()))
+
+    def test_edit_moves_row_within_fetched_rows(self):
+        self.model.setData(self.model.index(7, 0), u"AAA", Qt.EditRole)
+        self.assertEqual(self.titles()[0], u"AAA")
+        self.model.setData(self.model.index(0, 0), u"Title 004x", Qt.EditRole)
+        self.fetch_all()
+        titles = self.titles()
+        self.assertEqual(len(titles), 100)
+        self.assertEqual(titles, sorted(titles, key=lambda title: title.casefold()))
+
+    def test_add_book_after_edit(self):
+        self.model.setData(self.model.index(9, 0), u"ZZZ", Qt.EditRole)
+        self.model.add_book(Book(u"Title 008a", u"Author", u"2016/01/01"))
+        self.fetch_all()
+        titles = self.titles()
+        self.assertEqual(len(titles), 101)
+        self.assertEqual(titles, sorted(titles, key=lambda title: title.casefold()))
+
+class FilterProxyModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.list_file = os.path.join(self.directory, "books.txt")
+        write_json_list(self.list_file, [Book(u"Title {0:02d}".format(i), u"Author {0}".format(i % 3), u"2015/{0:02d}/01".format((i * 7) % 12 + 1)) for i in range(30)])
+
+        self.model = BookListModel(self.list_file)
+        self.model.load_chunk_size = 4
+        self.proxy = self.model.proxy_class()
+        self.proxy.setSourceModel(self.model)
+        self.proxy.sort(2, Qt.DescendingOrder)
+        self.model.read_book_list()
+        self.model.finish_loading()
+
+    def tearDown(self):
+        self.model.journal.discard()
+        self.model.close_list()
+        shutil.rmtree(self.directory)
+
+    def books(self):
+        return [self.model.books[self.proxy.mapToSource(self.proxy.index(row, 0)).row()] for row in range(self.proxy.rowCount())]
+
+    def assertSorted(self, books):
+        dates = [book.date for book in books]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_sorted_after_loading(self):
+        books = self.books()
+        self.assertEqual(len(books), 30)
+        self.assertSorted(books)
+
+    def test_filter_keeps_order(self):
+        self.proxy.set_filter_string(u"Author 1")
+        books = self.books()
+        self.assertEqual(len(books), 10)
+        self.assertTrue(all(book.author == u"Author 1" for book in books))
+        self.assertSorted(books)
+
+        self.proxy.set_filter_string(u"")
+        books = self.books()
+        self.assertEqual(len(books), 30)
+        self.assertSorted(books)
+
+    def test_edited_row_moves(self):
+        index = QPersistentModelIndex(self.proxy.index(5, 0))
+        title = index.data()
+        self.proxy.setData(self.proxy.index(5, 2), u"2020/01/01", Qt.EditRole)
+        self.assertEqual(index.row(), 0)
+        self.assertEqual(index.data(), title)
+        self.assertSorted(self.books())
+
+    def test_edited_row_hidden_by_filter(self):
+        self.proxy.set_filter_string(u"Author 1")
+        self.proxy.setData(self.proxy.index(0, 1), u"Someone", Qt.EditRole)
+        self.assertEqual(self.proxy.rowCount(), 9)
+
+    def test_added_book_sorted_in(self):
+        self.proxy.set_filter_string(u"Author")
+        self.model.add_book(Book(u"New", u"Author 9", u"2015/06/15"))
+        books = self.books()
+        self.assertEqual(len(books), 31)
+        self.assertSorted(books)
+
+    def test_removed_rows(self):
+        self.model.remove_books([0, 1, 2, 10])
+        books = self.books()
+        self.assertEqual(len(books), 26)
+        self.assertSorted(books)
+        self.assertEqual(sorted(book.title for book in books), sorted(book.title for book in self.model.books))
+
+    def test_removed_scattered_rows(self):
+        self.proxy.set_filter_string(u"Author 1")
+        index = QPersistentModelIndex(self.proxy.mapFromSource(self.model.index(28, 0)))
+        kept = self.model.books[28]
+        self.model.remove_books(list(range(0, 24, 2)) + [25, 26])
+        books = self.books()
+        self.assertEqual(sorted(book.title for book in books), sorted(book.title for book in self.model.books if book.author == u"Author 1"))
+        self.assertSorted(books)
+        self.assertEqual(self.model.books[self.proxy.mapToSource(index).row()], kept)
+        for row, book in enumerate(books):
+            self.assertEqual(self.proxy.mapFromSource(self.model.index(list(self.model.books).index(book), 0)).row(), row)
+
+    def test_edited_rows_with_same_date(self):
+        # the rows which sort the same are told apart by the date they had
+        books = self.books()
+        index = QPersistentModelIndex(self.proxy.index(4, 0))
+        for row in range(len(books)):
+            if books[row].date == books[4].date:
+                self.proxy.setData(self.proxy.index(self.books().index(books[row]), 2), u"2015/06/15", Qt.EditRole)
+        self.assertSorted(self.books())
+        self.assertEqual(index.data(), books[4].title)
+        self.assertEqual(self.model.books[self.proxy.mapToSource(index).row()].date, u"2015/06/15")
+
+    def test_close_stops_filter_worker(self):
+        self.proxy.background_filter_rows = 0
+        self.proxy.request_filter(u"Title 1")
+        self.assertIsNotNone(self.proxy._filter_executor)
+        self.model.close_list()
+        self.assertIsNone(self.proxy._filter_executor)
+        app.processEvents()
+        self.assertEqual(self.proxy.rowCount(), 30) # the result wasn't applied
+
+class ShardedProxyModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), "books" + ShardedList.extension)
+        books = [Book(u"Title {0:02d}".format(i), u"Author {0}".format(i % 3), u"{0}/01/01".format(2010 + i % 4)) for i in range(20)]
+        books.append(Book(u"Leviathan", u"Thomas Hobbes", u"2013/05/05"))
+        shards = {}
+        for book in books:
+            shards.setdefault(ShardedList.shard_key(book), []).append(book)
+        ShardedList(self.directory).write(shards)
+
+        self.model = ShardedBookListModel(self.directory)
+        self.model.read_book_list()
+        self.proxy = self.model.proxy_class()
+        self.proxy.setSourceModel(self.model)
+
+    def tearDown(self):
+        self.model.close_list()
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def test_count_before_loading(self):
+        self.assertEqual(self.proxy.filtered_count(), 21)
+
+    def test_fuzzy_count(self):
+        self.proxy.set_fuzzy(True)
+        self.proxy.set_filter_string(u"Levathan")
+        while not self.model.trigram_index.built():
+            app.processEvents()
+        app.processEvents()
+        self.assertEqual(self.proxy.rowCount(), 1)
+        self.assertEqual(self.proxy.filtered_count(), 1)
+
+class ColumnWidthTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.list_file = os.path.join(self.directory, "books.txt")
+        write_json_list(self.list_file, [Book(u"Title " + u"x" * i, u"Author {0}".format(i % 3), u"2015/01/01") for i in range(10)])
+
+        self.model = BookListModel(self.list_file)
+        self.model.read_book_list()
+        self.model.finish_loading()
+        self.font_metrics = QFontMetrics(app.font())
+        self.tracker = ColumnWidthTracker(self.font_metrics, [0, 1, 2], padding=4)
+        self.model.add_index(self.tracker)
+
+    def tearDown(self):
+        self.model.journal.discard()
+        self.model.close_list()
+        shutil.rmtree(self.directory)
+
+    def assertSameAsRebuilt(self):
+        rebuilt = ColumnWidthTracker(self.font_metrics, [0, 1, 2], padding=4)
+        rebuilt.reset(self.model.books)
+        self.assertEqual(self.tracker.widths(), rebuilt.widths())
+
+    def test_widths(self):
+        widths = self.tracker.widths()
+        self.assertEqual(widths[0], self.font_metrics.horizontalAdvance(u"Title " + u"x" * 9) + 4)
+        self.assertEqual(widths[1], max(self.font_metrics.horizontalAdvance(u"Author {0}".format(i)) for i in range(3)) + 4)
+
+    def test_follows_rows(self):
+        self.tracker.widths() # counted before the changes
+        self.model.add_book(Book(u"A much longer title than the others", u"Author 0", u"2016/01/01"))
+        self.assertSameAsRebuilt()
+        self.model.setData(self.model.index(10, 0), u"Short", Qt.EditRole)
+        self.model.setData(self.model.index(0, 1), u"Someone with a long name", Qt.EditRole)
+        self.assertSameAsRebuilt()
+        self.model.remove_books([0, 9, 8])
+        self.assertSameAsRebuilt()
+        self.model.remove_books(list(range(len(self.model.books))))
+        self.assertSameAsRebuilt()
+        self.assertEqual(self.tracker.widths(), {0: 4, 1: 4, 2: 4})
+
+class ReopenModelTest(unittest.TestCase):
+
+    model_class = BookListModel
+    extension = BookListModel.extension
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.list_file = os.path.join(self.directory, "books" + self.extension)
+        self.books = [Book(u"Title {0}".format(i), u"Author {0}".format(i), u"2015/01/{0:02d}".format(i + 1)) for i in range(5)]
+        write_list_file(self.list_file, self.books)
+        self.model = self.open()
+
+    def tearDown(self):
+        self.model.close_list()
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        model = self.model_class(self.list_file)
+        model.read_book_list()
+        model.finish_loading()
+        return model
+
+    def contents(self, books):
+        return sorted((book.title, book.date) for book in books)
+
+    def test_edits_survive_change_while_closed(self):
+        self.model.add_book(Book(u"Ours", u"Us", u"2016/01/01"))
+        self.model.setData(self.model.index(1, 2), u"2016/02/02", Qt.EditRole)
+        self.model.remove_books([3]) # while they remove Title 4
+        self.model.close_list() # the changes are only in the journal
+
+        theirs = self.books[:4] + [Book(u"Theirs", u"Them", u"2016/03/03")]
+        theirs[0] = Book(u"Title 0", u"Author 0", u"2016/04/04")
+        write_list_file(self.list_file, theirs)
+
+        self.model = self.open()
+        expected = [(u"Ours", u"2016/01/01"), (u"Theirs", u"2016/03/03"), (u"Title 0", u"2016/04/04"), (u"Title 1", u"2016/02/02"), (u"Title 2", u"2015/01/03")]
+        self.assertEqual(self.contents(self.model.books), expected)
+        self.assertEqual(self.contents(load_list_file(self.list_file)), expected) # written out
+        self.assertEqual(BookJournal.read(self.list_file), ([], None))
+
+    def test_touched_while_closed(self):
+        self.model.add_book(Book(u"Ours", u"Us", u"2016/01/01"))
+        self.model.close_list()
+        os.utime(self.list_file, ns=(0, 0))
+        self.model = self.open()
+        self.assertEqual(len(self.model.books), 6)
+
+class ReopenBinaryModelTest(ReopenModelTest):
+
+    model_class = BinaryBookListModel
+    extension = BinaryBookListModel.extension
+
+if __name__ == '__main__':
+    unittest.main()
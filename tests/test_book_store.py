@@ -0,0 +1,595 @@
+"""Tests of the stores and indexes, which don't need Qt.
+
+    python -m unittest discover tests
+
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from book_store import Book, BookJournal, BookKeys, BookQuery, BookStore, ColumnarBookStore, DateIndex, DuplicateIndex, MappedBookStore, PrefixIndex, ReadingStats, SearchIndex, ShardedList, SortKeyIndex, TrigramIndex, apply_journal, date_to_ordinal, diff_books, iter_json_array, normalize_text, ordinal_to_date, replay_journal, replace_list_file, row_ranges, write_binary_list, write_json_list, write_list_file
+
+class DateTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for date in [u"2015/01/05", u"0016/05/13", u"9999/12/31"]:
+            self.assertEqual(ordinal_to_date(date_to_ordinal(date)), date)
+
+    def test_not_dates(self):
+        for date in [u"", u"2015/1/5", u"+016/05/13", u"2015/ 1/05", u"2015/01/ 5", u"-015/01/05", u"2015/02/30", u"0000/01/01", u"٢٠١٥/01/05"]:
+            self.assertIsNone(date_to_ordinal(date), date)
+
+    def test_columnar_store_keeps_odd_dates(self):
+        books = [Book(u"A", u"B", date) for date in [u"+016/05/13", u"2015/ 1/05", u"2015/01/05", u"someday"]]
+        store = ColumnarBookStore(books)
+        self.assertEqual([book.date for book in store], [book.date for book in books])
+
+    def test_columnar_store_reuses_odd_dates(self):
+        store = ColumnarBookStore([Book(u"A", u"B", date) for date in [u"someday", u"", u"someday", u"2015/01/05"]])
+        self.assertEqual(len(store._odd_dates), 2)
+        for i in range(10):
+            store.set_field(1, 2, u"day {0}".format(i))
+        store.set_field(0, 2, u"2015/01/06")
+        self.assertEqual([book.date for book in store], [u"2015/01/06", u"day 9", u"someday", u"2015/01/05"])
+        store.delete(1, 2)
+        store.append(Book(u"A", u"B", u"later"))
+        self.assertEqual([book.date for book in store], [u"2015/01/06", u"2015/01/05", u"later"])
+        self.assertEqual(len(store._odd_dates), 4) # "", "someday" and two slots taking turns
+        self.assertEqual(store.snapshot()[2].date, u"later")
+
+    def test_shard_key(self):
+        self.assertEqual(ShardedList.shard_key(Book(u"A", u"B", u"2015/01/05")), u"2015")
+        self.assertEqual(ShardedList.shard_key(Book(u"A", u"B", u"+016/05/13")), ShardedList.undated)
+
+class MappedBookStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.list_file = os.path.join(self.directory, "books" + MappedBookStore.extension)
+        self.books = [Book(u"Преступление и наказание", u"Фёдор Достоевский", u"2015/01/05"), Book(u"", u"", u""), Book(u"Émile", u"Jean-Jacques Rousseau", u"+016/05/13"),
+                      Book(u"Du contrat social \U0001F4DC", u"Jean-Jacques Rousseau", u"someday"), Book(u"Lone \ud800", u"Someone", u"+016/05/13"), Book(u"Candide", u"Voltaire", u"0001/01/01")]
+        write_binary_list(self.list_file, self.books)
+        self.store = MappedBookStore(self.list_file)
+
+    def tearDown(self):
+        self.store.clear()
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.assertTrue(self.store.unchanged())
+        self.assertEqual(list(self.store), self.books)
+        for row, book in enumerate(self.books):
+            for column, field in enumerate(Book.fields):
+                self.assertEqual(self.store.field(row, column), getattr(book, field))
+        self.assertEqual(self.store[-1], self.books[-1])
+
+    def test_empty_list(self):
+        write_binary_list(self.list_file + ".empty", [])
+        self.assertEqual(list(MappedBookStore(self.list_file + ".empty")), [])
+
+    def test_header(self):
+        with io.open(self.list_file, 'rb') as f:
+            data = bytearray(f.read())
+        self.store.unmap()
+        for magic, version in [(b"BKL0", MappedBookStore.version), (MappedBookStore.magic, MappedBookStore.version + 1)]:
+            data[:8] = MappedBookStore.header.pack(magic, version, 0, 0, 0, 0)[:8]
+            with io.open(self.list_file, 'wb') as f:
+                f.write(data)
+            with self.assertRaises(ValueError):
+                MappedBookStore(self.list_file)
+        with io.open(self.list_file, 'wb') as f:
+            f.write(MappedBookStore.header.pack(MappedBookStore.magic, MappedBookStore.version, 1000, 0, 0, 0))
+        with self.assertRaises(ValueError): # truncated
+            MappedBookStore(self.list_file)
+
+    def test_changes(self):
+        self.store.set_field(0, 2, u"2016/02/02")
+        self.store.append(Book(u"Added", u"Someone", u"2016/03/03"))
+        self.store.delete(1, 2)
+        expected = [Book(u"Преступление и наказание", u"Фёдор Достоевский", u"2016/02/02")] + self.books[3:] + [Book(u"Added", u"Someone", u"2016/03/03")]
+        self.assertEqual(list(self.store), expected)
+        self.assertFalse(self.store.unchanged())
+
+        # the store maps the file which replaces the one it mapped
+        write_list_file(self.list_file, self.store)
+        self.assertTrue(self.store.maps(self.list_file))
+        self.assertTrue(self.store.unchanged())
+        self.assertEqual(list(self.store), expected)
+        self.assertEqual(list(MappedBookStore(self.list_file)), expected)
+
+    def test_failed_replace(self):
+        self.store.set_field(1, 0, u"Edited")
+        with self.assertRaises(OSError):
+            replace_list_file(os.path.join(self.directory, "missing"), self.list_file, self.store)
+        # mapped again, with the changes kept
+        self.assertTrue(self.store.maps(self.list_file))
+        self.assertEqual(self.store.field(1, 0), u"Edited")
+        self.assertEqual(list(self.store)[2:], self.books[2:])
+
+class DuplicateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.books = BookStore([Book(u"Nineteen Eighty-Four", u"George Orwell", u"2015/01/01"), Book(u"I, Robot", u"Isaac Asimov", u"2015/02/01")])
+        self.index = DuplicateIndex()
+        self.index.reset(self.books)
+
+    def test_normalize_text(self):
+        self.assertEqual(normalize_text(u"  I, Robot "), u"i robot")
+        self.assertEqual(normalize_text(u"Nineteen Eighty-Four"), u"nineteen eighty four")
+        self.assertEqual(normalize_text(u"Eighty--Four!"), u"eighty four")
+
+    def test_exact(self):
+        self.assertTrue(self.index.contains(Book(u"nineteen eighty-four", u"GEORGE ORWELL", u"")))
+        self.assertFalse(self.index.contains(Book(u"Nineteen Eighty Four", u"George Orwell", u"")))
+
+    def test_similar(self):
+        self.assertTrue(self.index.contains_similar(Book(u"Nineteen Eighty Four", u"George Orwell", u"")))
+        self.assertTrue(self.index.contains_similar(Book(u"nineteen eighty-four.", u"george  orwell", u"")))
+        self.assertTrue(self.index.contains_similar(Book(u"I Robot", u"Isaac Asimov", u"")))
+        self.assertFalse(self.index.contains_similar(Book(u"Nineteen EightyFour", u"George Orwell", u"")))
+
+    def test_follows_rows(self):
+        self.index.contains(self.books[0]) # built before the change
+        old_book = self.books[0]
+        self.books.set_field(0, 0, u"Animal Farm")
+        self.index.row_changed(0, old_book, self.books[0])
+        self.assertFalse(self.index.contains_similar(Book(u"Nineteen Eighty Four", u"George Orwell", u"")))
+        self.assertTrue(self.index.contains_similar(Book(u"Animal-Farm", u"George Orwell", u"")))
+
+class RowRangesTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(row_ranges([]), [])
+        self.assertEqual(row_ranges([7, 2, 3, 9, 1, 8]), [(1, 3), (7, 3)])
+        self.assertEqual(row_ranges([4, 4, 5, 0, 5, 0]), [(0, 1), (4, 2)])
+        self.assertEqual(row_ranges([3, 5, 4, 6, 2]), [(2, 5)])
+
+    def test_delete_ranges(self):
+        books = [Book(u"Title {0}".format(i), u"Author {0}".format(i % 3), u"2015/01/{0:02d}".format(i + 1)) for i in range(20)]
+        rows = [19, 3, 4, 11, 5, 3, 0, 12, 19, 18, 7]
+        expected = [book for row, book in enumerate(books) if row not in rows]
+        for store_class in [BookStore, ColumnarBookStore]:
+            store = store_class(books)
+            # from the end, so that the rows still to be deleted keep their places
+            for row, count in reversed(row_ranges(rows)):
+                store.delete(row, count)
+            self.assertEqual(list(store), expected, store_class.__name__)
+
+class SortKeyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.books = BookStore([Book(u"banana", u"Zola", u"2015/03/01"), Book(u"Apple", u"austen", u""), Book(u"cherry", u"Balzac", u"2015/01/01"), Book(u"apple", u"Austen", u"someday"), Book(u"Banana", u"zola", u"2014/12/31")])
+        self.index = SortKeyIndex()
+        self.index.reset(self.books)
+
+    def test_case_folded(self):
+        self.assertEqual(self.index.order(0), [1, 3, 0, 4, 2])
+        self.assertEqual(self.index.order(1), [1, 3, 2, 0, 4])
+        self.assertEqual(self.index.order(0, descending=True), [2, 0, 4, 1, 3])
+
+    def test_dates(self):
+        # books without a valid date come first, in the order of the list
+        self.assertEqual(self.index.order(2), [1, 3, 4, 2, 0])
+        self.assertEqual(self.index.key(1, 2), 0)
+        self.assertEqual(self.index.key(3, 2), 0)
+        self.assertEqual(self.index.order(2, descending=True), [0, 2, 4, 1, 3])
+
+    def test_follows_rows(self):
+        keys = self.index.keys(2) # built before the changes, and kept up to date in place
+        self.index.keys(0)
+        book = Book(u"Date", u"Dumas", u"2016/01/01")
+        self.books.insert(1, book)
+        self.index.rows_inserted(1, [book])
+        old_book = self.books[3]
+        self.books.set_field(3, 2, u"2013/01/01")
+        self.index.row_changed(3, old_book, self.books[3])
+        removed = [self.books[0], self.books[1]]
+        self.books.delete(0, 2)
+        self.index.rows_removed(0, removed)
+
+        rebuilt = SortKeyIndex()
+        rebuilt.reset(self.books)
+        self.assertIs(self.index.keys(2), keys)
+        for column in range(3):
+            self.assertEqual(self.index.keys(column), rebuilt.keys(column))
+        self.assertEqual(self.index.order(2), [0, 2, 1, 3])
+
+class ReadingStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        dates = [u"2015/01/05", u"2015/01/20", u"2015/03/01", u"2016/02/29", u"", u"someday", u"2016/02/01"]
+        self.books = BookStore([Book(u"Title {0}".format(i), u"Author {0}".format(i % 3), date) for i, date in enumerate(dates)])
+        self.stats = ReadingStats()
+        self.stats.reset(self.books)
+
+    def assertSameAsRebuilt(self):
+        rebuilt = ReadingStats()
+        rebuilt.reset(self.books)
+        self.assertEqual(self.stats.years(), rebuilt.years())
+        self.assertEqual(sorted(self.stats.top_authors()), sorted(rebuilt.top_authors()))
+        self.assertEqual(self.stats.monthly_counts(), rebuilt.monthly_counts())
+        self.assertEqual(self.stats.total, len(self.books))
+
+    def test_counts(self):
+        self.assertEqual(self.stats.years(), {u"2015": 3, u"2016": 2, ReadingStats.undated: 2})
+        self.assertEqual(self.stats.top_authors(1), [(u"Author 0", 3)])
+        self.assertEqual(self.stats.monthly_counts(), [(u"2015/{0:02d}".format(month), count) for month, count in [(1, 2), (2, 0), (3, 1)] + [(month, 0) for month in range(4, 13)]] + [(u"2016/01", 0), (u"2016/02", 2)])
+        self.assertEqual(self.stats.reading_rate(2), 1.0)
+
+    def test_follows_rows(self):
+        self.stats.years() # counted before the changes
+        version = self.stats.version
+        book = Book(u"New", u"Author 9", u"2017/06/01")
+        self.books.append(book)
+        self.stats.rows_inserted(len(self.books) - 1, [book])
+        self.assertSameAsRebuilt()
+
+        old_book = self.books[3]
+        self.books.set_field(3, 1, u"Author 9")
+        self.stats.row_changed(3, old_book, self.books[3])
+        old_book = self.books[4]
+        self.books.set_field(4, 2, u"2014/12/31")
+        self.stats.row_changed(4, old_book, self.books[4])
+        self.assertSameAsRebuilt()
+
+        removed = [self.books[0], self.books[1], self.books[2]]
+        self.books.delete(0, 3)
+        self.stats.rows_removed(0, removed)
+        self.assertSameAsRebuilt()
+        self.assertEqual(self.stats.authors[u"Author 0"], 1)
+        self.assertNotIn(u"2015/01", self.stats.months)
+        self.assertGreater(self.stats.version, version)
+
+class TrigramIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.books = BookStore([Book(u"History of {0}".format(name), author, u"2015/01/01") for name, author in [(u"Rome", u"Gibbon"), (u"Greece", u"Grote"), (u"Western Philosophy", u"Russell")]])
+        self.index = TrigramIndex([0, 1])
+        self.index.reset(self.books)
+
+    def test_adopt_built_copy(self):
+        version, texts = self.index.snapshot()
+        built = TrigramIndex.from_texts(self.index.columns, texts)
+        self.assertTrue(self.index.adopt(version, built))
+        self.assertTrue(self.index.built())
+        self.index.set_query(u"Histroy of Rome")
+        self.assertEqual(self.index.scores[0], max(self.index.scores))
+
+    def test_adopt_after_change(self):
+        version, texts = self.index.snapshot()
+        built = TrigramIndex.from_texts(self.index.columns, texts)
+        self.books.append(Book(u"Rome", u"Beard", u"2016/01/01"))
+        self.index.rows_inserted(3, [self.books[3]])
+        self.assertFalse(self.index.adopt(version, built))
+        self.assertFalse(self.index.built())
+
+    def test_scores_follow_rows(self):
+        self.index.set_query(u"Gibon")
+        removed = [self.books[0]]
+        self.books.delete(0)
+        self.index.rows_removed(0, removed)
+        self.books.insert(1, Book(u"Decline and Fall", u"Gibbon", u"2016/01/01"))
+        self.index.rows_inserted(1, [self.books[1]])
+        self.index.set_query(u"Gibon")
+        self.assertEqual([score > 0 for score in self.index.scores], [False, True, False])
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.list_file = os.path.join(self.directory, "books.txt")
+        self.books = [Book(u"Emma", u"Jane Austen", u"2015/01/01"), Book(u"Persuasion", u"Jane Austen", u"2015/02/01"), Book(u"Emma", u"Jane Austen", u"2015/01/01")]
+        write_json_list(self.list_file, self.books)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self):
+        journal = BookJournal()
+        journal.open(self.list_file)
+        journal.rows_inserted(3, [Book(u"Sanditon", u"Jane Austen", u"2016/01/01")])
+        journal.row_changed(1, self.books[1], Book(u"Persuasion", u"Jane Austen", u"2015/03/01"))
+        journal.rows_removed(0, [self.books[0]])
+        journal.close()
+        return journal
+
+    def test_replay(self):
+        self.record()
+        entries, path = BookJournal.read(self.list_file)
+        self.assertEqual(path, BookJournal.journal_path(self.list_file))
+        edited, added, removed = replay_journal(entries, self.books)
+        self.assertEqual(list(edited), [1])
+        self.assertEqual(edited[1].date, u"2015/03/01")
+        self.assertEqual([book.title for book in added], [u"Sanditon"])
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(self.books[removed[0]].title, u"Emma") # either copy
+
+    def test_replay_chain(self):
+        # an added book which is edited and then removed leaves no trace
+        sanditon = {"title": u"Sanditon", "author": u"Jane Austen", "date": u"2016/01/01"}
+        finished = dict(sanditon, title=u"Sanditon (finished)")
+        entries = [{"op": "add", "book": sanditon}, {"op": "edit", "old": sanditon, "new": finished}, {"op": "remove", "book": finished},
+                   {"op": "remove", "book": {"title": u"Not", "author": u"In", "date": u"The list"}}]
+        self.assertEqual(replay_journal(entries, self.books), ({}, [], []))
+
+    def test_cut_off_line(self):
+        self.record()
+        with io.open(BookJournal.journal_path(self.list_file), 'ab') as f:
+            f.write(b'{"op": "add", "book": {"title": "Lady Su\n')
+            f.write(b'{"op": "remove", "book": {"title": "Emma", "author": "Jane Austen", "date": "2015/01/01"}}\n')
+        entries, path = BookJournal.read(self.list_file)
+        self.assertEqual([entry["op"] for entry in entries], ["add", "edit", "remove"]) # nothing after the bad line
+
+    def test_other_list_file(self):
+        self.record()
+        write_json_list(self.list_file, self.books[:1])
+        self.assertEqual(BookJournal.read(self.list_file), ([], None))
+
+    def changed_on_disk(self, theirs):
+        # the journal recorded against self.books, then the file replaced with theirs
+        journal = BookJournal()
+        journal.open(self.list_file, base=BookKeys(self.books))
+        journal.rows_inserted(3, [Book(u"Sanditon", u"Jane Austen", u"2016/01/01")])
+        journal.row_changed(1, self.books[1], Book(u"Persuasion", u"Jane Austen", u"2015/03/01"))
+        journal.rows_removed(0, [self.books[0]])
+        journal.close()
+        write_json_list(self.list_file, theirs)
+        books = BookStore(theirs)
+        entries, path, merged = BookJournal.recover(self.list_file, books)
+        self.assertTrue(merged)
+        self.assertEqual(path, BookJournal.journal_path(self.list_file))
+        apply_journal(books, entries)
+        return sorted((book.title, book.date) for book in books)
+
+    def test_merge_into_changed_file(self):
+        theirs = self.books + [Book(u"Mansfield Park", u"Jane Austen", u"2016/02/01")]
+        self.assertEqual(self.changed_on_disk(theirs), [(u"Emma", u"2015/01/01"), (u"Mansfield Park", u"2016/02/01"), (u"Persuasion", u"2015/03/01"), (u"Sanditon", u"2016/01/01")])
+
+    def test_merge_same_books_changed(self):
+        # the journal's changes win over the file's
+        theirs = [Book(u"Emma", u"Jane Austen", u"2015/01/09"), Book(u"Persuasion", u"Jane Austen", u"2015/04/01"), self.books[2]]
+        self.assertEqual(self.changed_on_disk(theirs), [(u"Emma", u"2015/01/01"), (u"Persuasion", u"2015/03/01"), (u"Sanditon", u"2016/01/01")])
+
+    def test_merge_edited_book_removed(self):
+        # both removed one of the two copies of Emma, which is the same change
+        theirs = [self.books[0]]
+        self.assertEqual(self.changed_on_disk(theirs), [(u"Emma", u"2015/01/01"), (u"Persuasion", u"2015/03/01"), (u"Sanditon", u"2016/01/01")])
+
+    def test_unmerged_set_aside(self):
+        self.record() # no BookKeys to merge with
+        os.utime(self.list_file, ns=(0, 0))
+        entries, path, merged = BookJournal.recover(self.list_file, BookStore(self.books))
+        self.assertEqual((entries, path, merged), ([], None, False))
+        aside = BookJournal.journal_path(self.list_file) + ".unmerged"
+        self.assertEqual(len(BookJournal._read_file(aside)[1]), 3)
+        BookJournal().open(self.list_file) # doesn't remove it
+        self.assertTrue(os.path.exists(aside))
+
+    def test_bad_header(self):
+        with io.open(BookJournal.journal_path(self.list_file), 'wb') as f:
+            f.write(b'{"base": \n')
+        self.assertEqual(BookJournal.read(self.list_file), ([], None))
+
+class DiffBooksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old = [Book(u"Emma", u"Jane Austen", u"2015/01/01"), Book(u"Persuasion", u"Jane Austen", u"2015/02/01"), Book(u"Dracula", u"Bram Stoker", u"2015/03/01")]
+
+    def apply(self, old, entries):
+        edited, added, removed = replay_journal(entries, old)
+        books = [edited.get(row, book) for row, book in enumerate(old) if row not in removed]
+        return books + added
+
+    def assertDiff(self, new):
+        entries = diff_books(self.old, new)
+        self.assertEqual(sorted((book.title, book.author, book.date) for book in self.apply(self.old, entries)), sorted((book.title, book.author, book.date) for book in new))
+        return entries
+
+    def test_same(self):
+        self.assertEqual(diff_books(self.old, list(reversed(self.old))), [])
+
+    def test_edit(self):
+        entries = self.assertDiff([self.old[0], Book(u"Persuasion", u"Jane Austen", u"2016/02/01"), self.old[2]])
+        self.assertEqual([entry["op"] for entry in entries], ["edit"])
+        self.assertEqual(entries[0]["old"], self.old[1].to_dict())
+
+    def test_add_and_remove(self):
+        # only one field in common, so not an edit
+        entries = self.assertDiff([self.old[0], self.old[1], Book(u"Dracula's Guest", u"Stoker", u"2015/03/01"), Book(u"Sanditon", u"Jane Austen", u"2016/01/01")])
+        self.assertEqual(sorted(entry["op"] for entry in entries), ["add", "add", "remove"])
+
+    def test_duplicates(self):
+        self.old.append(self.old[0])
+        entries = self.assertDiff(self.old[1:])
+        self.assertEqual(entries, [{"op": "remove", "book": self.old[0].to_dict()}])
+        self.assertDiff(self.old + [self.old[0]])
+
+    def test_each_new_book_edited_once(self):
+        # two removed books which could both be edited into the same new book
+        self.old.append(Book(u"Emma", u"Jane Austen", u"2015/05/01"))
+        self.assertDiff([Book(u"Emma", u"Jane Austen", u"2016/01/01"), self.old[1], self.old[2]])
+
+class JsonArrayTest(unittest.TestCase):
+
+    def parse(self, data, chunk_size=3):
+        return [element for element, _ in iter_json_array(io.BytesIO(data), chunk_size)]
+
+    def test_elements(self):
+        data = u' [ {"title": "Ænéid", "n": [1, 2]} ,"x\\"]" , 12345, [] ]\n'.encode("utf-8")
+        expected = [{"title": u"Ænéid", "n": [1, 2]}, u'x"]', 12345, []]
+        for chunk_size in (1, 2, 3, 7, 1 << 16): # splitting numbers, strings and UTF-8 sequences
+            self.assertEqual(self.parse(data, chunk_size), expected)
+
+    def test_empty(self):
+        self.assertEqual(self.parse(b""), [])
+        self.assertEqual(self.parse(b" \n"), [])
+        self.assertEqual(self.parse(b"[]"), [])
+
+    def test_bytes_read(self):
+        data = b'[1, 2, 3]'
+        progress = [bytes_read for _, bytes_read in iter_json_array(io.BytesIO(data), 4)]
+        self.assertEqual(progress, sorted(progress))
+        self.assertTrue(all(0 < bytes_read <= len(data) for bytes_read in progress))
+
+    def test_not_an_array(self):
+        for data in (b'{"title": "Emma"}', b'"[]"'):
+            self.assertRaises(ValueError, self.parse, data)
+
+    def test_commas(self):
+        for data in (b'[1, 2 3]', b'[1 [2]]', b'[1,, 2]', b'[, 1]', b'[1, 2,]', b'[,]'):
+            with self.assertRaises(ValueError):
+                self.parse(data)
+
+    def test_unbalanced(self):
+        for data in (b'[', b'[1, 2', b'[1, 2,', b'[{"title": "Emma"}', b'[[1, 2]', b'[{"title": "Em'):
+            with self.assertRaises(ValueError):
+                self.parse(data)
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        authors = [u"Jane Austen", u"jane austen", u"Isaac Asimov", u"Isaac Asimov", u"Isaac Asimov", u"Ayn Rand", u"Aldous Huxley", u"Aldous Huxley", u"Émile Zola"]
+        self.books = BookStore([Book(u"Title {0}".format(i), author, u"") for i, author in enumerate(authors)])
+        self.index = PrefixIndex(1)
+        self.index.reset(self.books)
+
+    def test_most_used_first(self):
+        self.assertEqual(self.index.complete(u"a"), [u"Aldous Huxley", u"Ayn Rand"])
+        self.assertEqual(self.index.complete(u"I"), [u"Isaac Asimov"])
+        self.assertEqual(self.index.complete(u""), [])
+        self.assertEqual(self.index.complete(u"x"), [])
+
+    def test_case_folded(self):
+        # the values keep their case, and count separately
+        self.assertEqual(self.index.complete(u"JANE"), [u"Jane Austen", u"jane austen"])
+        self.assertEqual(self.index.complete(u"émile"), [u"Émile Zola"])
+        self.assertEqual(self.index.complete(u"a", limit=1), [u"Aldous Huxley"])
+
+    def test_follows_rows(self):
+        self.index.complete(u"a") # built before the changes
+        book = Book(u"Title", u"Ayn Rand", u"")
+        for _ in range(2):
+            self.books.append(book)
+            self.index.rows_inserted(len(self.books) - 1, [book])
+        self.assertEqual(self.index.complete(u"a"), [u"Ayn Rand", u"Aldous Huxley"])
+
+        old_book = self.books[2]
+        self.books.set_field(2, 1, u"Ayn Rand")
+        self.index.row_changed(2, old_book, self.books[2])
+        removed = [self.books[0]]
+        self.books.delete(0)
+        self.index.rows_removed(0, removed)
+        self.assertEqual(self.index.complete(u"a"), [u"Ayn Rand", u"Aldous Huxley"])
+        self.assertEqual(self.index.complete(u"j"), [u"jane austen"])
+
+        rebuilt = PrefixIndex(1)
+        rebuilt.reset(self.books)
+        for text in [u"a", u"i", u"j", u"é", u"ayn"]:
+            self.assertEqual(self.index.complete(text), rebuilt.complete(text), text)
+        self.assertEqual(self.index._counts, rebuilt._counts)
+        self.assertEqual(self.index._levels, rebuilt._levels)
+
+class DateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.books = BookStore([Book(u"Title {0}".format(i), u"Author", u"2015/{0:02d}/01".format(i % 4 + 1) if i % 5 else u"") for i in range(20)])
+        self.index = DateIndex()
+        self.index.reset(self.books)
+        self.index.count_between(1, 1) # sorted before the changes
+
+    def assertSameAsRebuilt(self):
+        rebuilt = DateIndex()
+        rebuilt.reset(self.books)
+        low, high = date_to_ordinal(u"2015/01/01"), date_to_ordinal(u"2015/12/31")
+        self.assertEqual(list(self.index.rows_between(low, high)), list(rebuilt.rows_between(low, high)))
+        self.assertEqual(list(self.index.ordinals), list(rebuilt.ordinals))
+        self.assertEqual(list(self.index._sorted), list(rebuilt._sorted))
+        self.assertEqual(list(self.index._order), list(rebuilt._order))
+
+    def insert(self, row, books):
+        for offset, book in enumerate(books):
+            self.books.insert(row + offset, book)
+        self.index.rows_inserted(row, books)
+
+    def remove(self, row, count):
+        books = [self.books[other] for other in range(row, row + count)]
+        self.books.delete(row, count)
+        self.index.rows_removed(row, books)
+
+    def change(self, row, date):
+        old_book = self.books[row]
+        self.books.set_field(row, 2, date)
+        self.index.row_changed(row, old_book, self.books[row])
+
+    def test_follows_rows(self):
+        self.insert(3, [Book(u"New", u"Author", u"2015/02/01"), Book(u"Undated", u"Author", u"")])
+        self.assertSameAsRebuilt()
+        self.insert(len(self.books), [Book(u"Last", u"Author", u"2015/03/01")])
+        self.assertSameAsRebuilt()
+        self.change(0, u"2015/02/01")
+        self.change(7, u"someday")
+        self.change(8, u"2015/08/08")
+        self.assertSameAsRebuilt()
+        self.remove(2, 3)
+        self.assertSameAsRebuilt()
+        self.remove(len(self.books) - 2, 2)
+        self.assertSameAsRebuilt()
+        self.assertEqual(self.index.count_between(date_to_ordinal(u"2015/02/01"), date_to_ordinal(u"2015/02/01")), sum(1 for book in self.books if book.date == u"2015/02/01"))
+
+    def test_many_rows(self):
+        self.insert(5, [Book(u"New", u"Author", u"2015/02/01")] * (DateIndex.max_moved_rows + 1))
+        self.assertIsNone(self.index._order)
+        self.assertSameAsRebuilt()
+
+class BookQueryTest(unittest.TestCase):
+
+    def terms(self, text):
+        return [(term.column, term.value) for term in BookQuery.parse(text).terms]
+
+    def test_not_a_query(self):
+        for text in [u"", u"animal farm", u"http://example.com", u"series: foundation"]:
+            self.assertIsNone(BookQuery.parse(text), text)
+
+    def test_terms(self):
+        self.assertEqual(self.terms(u'Author:orwell farm title:"animal f" date:2015'), [(1, u"orwell"), (None, u"farm"), (0, u"animal f"), (2, u"2015")])
+        self.assertEqual(self.terms(u'title:"animal f'), [(0, u"animal f")]) # still being typed
+        self.assertEqual(self.terms(u'title:"" author:orwell'), [(1, u"orwell")])
+        self.assertEqual(self.terms(u"see:also author:orwell"), [(None, u"see:also"), (1, u"orwell")])
+
+    def test_dates(self):
+        def days(first, last):
+            return (date_to_ordinal(first), date_to_ordinal(last))
+        self.assertEqual(BookQuery.date_range(u"2015"), days(u"2015/01/01", u"2015/12/31"))
+        self.assertEqual(BookQuery.date_range(u"2016-2"), days(u"2016/02/01", u"2016/02/29"))
+        self.assertEqual(BookQuery.date_range(u"2015/02/03"), days(u"2015/02/03", u"2015/02/03"))
+        self.assertEqual(BookQuery.date_range(u"2015-01..2015-03"), days(u"2015/01/01", u"2015/03/31"))
+        for value in [u"2015-13", u"2015-02-30", u"15", u"someday", u"2015..later"]:
+            self.assertIsNone(BookQuery.date_range(value), value)
+
+    def test_open_ended_dates(self):
+        low, high = BookQuery.date_range(u"2015-06..")
+        self.assertEqual(low, date_to_ordinal(u"2015/06/01"))
+        self.assertGreater(high, date_to_ordinal(u"9999/12/01"))
+        low, high = BookQuery.date_range(u"..2015")
+        self.assertLess(low, date_to_ordinal(u"0001/01/02"))
+        self.assertEqual(high, date_to_ordinal(u"2015/12/31"))
+        self.assertEqual(BookQuery.parse(u"date:..2015").terms[0].dates, (low, high))
+        self.assertIsNone(BookQuery.parse(u"date:someday").terms[0].dates) # matched as text
+
+    def test_matching(self):
+        books = BookStore([Book(u"Animal Farm", u"George Orwell", u"2015/01/05"), Book(u"Burmese Days", u"George Orwell", u"2016/03/01"), Book(u"Orwell's Road", u"Someone Else", u"2015/02/01"), Book(u"Emma", u"Jane Austen", u"someday")])
+        index = SearchIndex([0, 1, 2])
+        index.reset(books)
+        for query, rows in [(u"author:orwell", [0, 1]), (u"author:orwell date:2015", [0]), (u"date:2015-02..", [1, 2]), (u"date:..2015-01", [0]),
+                            (u"date:someday", [3]), (u"orwell date:2015", [0, 2]), (u"author:^g.*l$", [0, 1]), (u'title:"burmese d"', [1])]:
+            index.set_query(query)
+            self.assertEqual([row for row, accepted in enumerate(index.accepted_rows()) if accepted], rows, query)
+
+if __name__ == '__main__':
+    unittest.main()